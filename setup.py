@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # coding = utf-8
 
+import sys
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 
 PACKAGE = "vavava"
 NAME = "vavava"
@@ -10,6 +12,17 @@ AUTHOR = "vavava"
 AUTHOR_EMAIL = "pk13610@gmail.com"
 URL = "http://www.github.com/pkhopper"
 VERSION = __import__(PACKAGE).__version__
+REQUIRES = ["futures"] if sys.version < "3" else []
+
+
+class BuildPy(build_py):
+    """ asyncutil is python 3 only (asyncio), python 2 builds leave it out """
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version < "3":
+            modules = [m for m in modules if m[:2] != (PACKAGE, "asyncutil")]
+        return modules
+
 
 setup(
     name = NAME,
@@ -32,5 +45,6 @@ setup(
         "Framework :: Django",
     ],
     zip_safe = False,
-    # requires = []
+    install_requires = REQUIRES,
+    cmdclass = {"build_py": BuildPy},
 )
@@ -4,6 +4,11 @@
 import sys
 import unittest
 import os
+import time
+import logging
+import threading
+import tempfile
+import shutil
 
 from vavava import util
 from vavava import httputil
@@ -15,6 +20,9 @@ sys.path.insert(0, '.')
 __all__ = ['TestHttputil', 'TestUtil', 'TestSqliteutil']
 
 util.set_default_utf8()
+log = logging.getLogger('vavava.test')
+log.setLevel(logging.ERROR)
+MUTEX = threading.Lock()
 
 
 class TestHttputil(unittest.TestCase):
@@ -32,6 +40,96 @@ class TestHttputil(unittest.TestCase):
         print 'test httputil.fetch()'
         httputil.main_test()
 
+    def test_pool(self):
+        print 'test httputil.ConnectionPool'
+        server = httputil.serve_local(body='pooled')
+        host = '%s:%d' % server.server_address
+        try:
+            created = httputil.POOL.info()['created']
+            client = httputil.HttpUtil()
+            for i in range(5):
+                self.assertEqual(client.get('http://%s/' % host), 'pooled')
+            self.assertEqual(client.head('http://%s/' % host).status, 200)
+            self.assertEqual(httputil.POOL.info()['created'], created + 1)
+
+            # more responses open than pooled connections: the others overflow
+            responses = [client.get_response('http://%s/' % host) for i in range(12)]
+            self.assertEqual([resp.read() for resp in responses], ['pooled'] * 12)
+            info = httputil.POOL.info()
+            self.assertEqual((info['open'], info['overflow']), (10, 2))
+
+            pool = httputil.ConnectionPool(maxsize=1, idle_timeout=0.2)
+            pool.EVICT_INTERVAL = 0
+            conn, reused = pool.get('http', host, timeout=1)
+            self.assertFalse(reused)
+            extra, reused = pool.get('http', host, timeout=1)
+            self.assertFalse(reused)
+            pool.put(extra)
+            self.assertEqual(pool.info()['idle'], 0)
+            pool.put(conn)
+            conn, reused = pool.get('http', host, timeout=1)
+            self.assertTrue(reused)
+            pool.put(conn)
+            time.sleep(0.3)
+            conn, reused = pool.get('http', host, timeout=1)
+            self.assertFalse(reused)
+            self.assertEqual(pool.info()['open'], 1)
+            pool.discard(conn)
+            self.assertEqual(pool.info()['open'], 0)
+            # an idle pool closes its connections by itself
+            pool.put(pool.get('http', host, timeout=1)[0])
+            self.assertTrue(wait_until(lambda: pool.info()['open'] == 0, timeout=2))
+            # responses dropped unread give back their connection
+            overflow = pool.info()['overflow']
+            for i in range(3):
+                pool.request('http', host, 'GET', '/', timeout=1)
+            info = pool.info()
+            self.assertEqual((info['open'], info['overflow']), (0, overflow))
+        finally:
+            httputil.POOL.clear()
+            server.shutdown()
+            server.server_close()
+
+    def test_pool_retry(self):
+        print 'test httputil.ConnectionPool retry'
+        import socket
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(8)
+        host = '%s:%d' % sock.getsockname()
+        requests = []
+
+        def hang_up():
+            # read a request, close without answering
+            while True:
+                try:
+                    conn = sock.accept()[0]
+                except socket.error:
+                    return
+                data = ''
+                while '\r\n\r\n' not in data:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                requests.append(data.split(' ', 1)[0])
+                conn.close()
+        th = threading.Thread(target=hang_up)
+        th.setDaemon(True)
+        th.start()
+        try:
+            pool = httputil.ConnectionPool()
+            for method, sent in (('POST', ['POST']), ('GET', ['GET', 'GET'])):
+                del requests[:]
+                pool.put(pool.get('http', host, timeout=1)[0])  # reused next
+                self.assertRaises(httputil.httplib.HTTPException,
+                                  pool.request, 'http', host, method, '/', 'x', timeout=1)
+                self.assertTrue(wait_until(lambda: len(requests) >= len(sent)))
+                time.sleep(0.1)
+                self.assertEqual(requests, sent)
+        finally:
+            sock.close()
+
 
 class TestUtil(unittest.TestCase):
     def test_assure_path(self):
@@ -52,14 +150,1079 @@ class TestSqliteutil(unittest.TestCase):
         print 'test sqliteutil ok'
 
 
+class StampWork(threadutil.WorkBase):
+    def __init__(self, name='stamp'):
+        threadutil.WorkBase.__init__(self, name=name)
+        self.queued_at = None
+        self.started_at = None
+
+    def work(self, this_thread, log):
+        self.started_at = time.time()
+
+
+class NopWork(threadutil.WorkBase):
+    def work(self, this_thread, log):
+        pass
+
+
+class ValueWork(threadutil.WorkBase):
+    def __init__(self, value):
+        threadutil.WorkBase.__init__(self, name='value')
+        self.value = value
+
+    def work(self, this_thread, log):
+        return self.value
+
+
+class PidWork(threadutil.WorkBase):
+    def __init__(self, fail=False):
+        threadutil.WorkBase.__init__(self, name='pid')
+        self.fail = fail
+        self.pid = None
+
+    def work(self, this_thread, log):
+        self.pid = os.getpid()
+        if self.fail:
+            raise ValueError('PidWork')
+        return self.pid
+
+
+class OrderWork(threadutil.WorkBase):
+    def __init__(self, order, priority=None, deadline=None):
+        threadutil.WorkBase.__init__(self, name='order', priority=priority, deadline=deadline)
+        self.order = order
+
+    def work(self, this_thread, log):
+        self.order.append(self)
+
+
+class ErrWork(threadutil.WorkBase):
+    def work(self, this_thread, log):
+        raise RuntimeError('ErrWork')
+
+
+class LiteValueWork(threadutil.LiteWorkBase):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        threadutil.LiteWorkBase.__init__(self)
+        self.value = value
+
+    def work(self, this_thread, log):
+        if self.value < 0:
+            raise RuntimeError('LiteValueWork')
+        return self.value
+
+
+class KeyWork(threadutil.SleepWork):
+    running = {}
+    peak = {}
+
+    def __init__(self, key, duration=0.05):
+        threadutil.SleepWork.__init__(self, duration)
+        self.limit_key = key
+
+    def work(self, this_thread, log):
+        with MUTEX:
+            KeyWork.running[self.limit_key] = KeyWork.running.get(self.limit_key, 0) + 1
+            KeyWork.peak[self.limit_key] = max(KeyWork.peak.get(self.limit_key, 0),
+                                               KeyWork.running[self.limit_key])
+        threadutil.SleepWork.work(self, this_thread, log)
+        with MUTEX:
+            KeyWork.running[self.limit_key] -= 1
+
+
+class FlakyWork(threadutil.WorkBase):
+    def __init__(self, fails, error=RuntimeError, retry=None):
+        threadutil.WorkBase.__init__(self, retry=retry)
+        self.fails = fails
+        self.error = error
+        self.runs = 0
+
+    def work(self, this_thread, log):
+        self.runs += 1
+        if self.runs <= self.fails:
+            raise self.error('FlakyWork')
+        return self.runs
+
+
+class LaneWork(KeyWork):
+    order = {}
+
+    def __init__(self, key, seq):
+        KeyWork.__init__(self, 'lane-' + key, 0.01)
+        self.lane_key = key
+        self.seq = seq
+
+    def work(self, this_thread, log):
+        KeyWork.work(self, this_thread, log)
+        with MUTEX:
+            LaneWork.order.setdefault(self.lane_key, []).append(self.seq)
+
+
+class FetchWork(threadutil.WorkBase):
+    runs = 0
+
+    def __init__(self, url, duration=0.1, fail=False):
+        threadutil.WorkBase.__init__(self)
+        self.dedup_key = url
+        self.duration = duration
+        self.fail = fail
+
+    def work(self, this_thread, log):
+        with MUTEX:
+            FetchWork.runs += 1
+        time.sleep(self.duration)
+        if self.fail:
+            raise RuntimeError('FetchWork')
+        return 'page of %s' % self.dedup_key
+
+
+GATE = threading.Event()
+
+
+class DurableWork(threadutil.WorkBase):
+    runs = {}
+
+    def __init__(self, value, gated=False):
+        threadutil.WorkBase.__init__(self)
+        self.value = value
+        self.gated = gated
+
+    def work(self, this_thread, log):
+        with MUTEX:
+            DurableWork.runs[self.value] = DurableWork.runs.get(self.value, 0) + 1
+        if self.gated:
+            GATE.wait(5)
+        return self.value * 10
+
+
+def spin_profiled(seconds):
+    end_at = time.time() + seconds
+    while time.time() < end_at:
+        sum(i * i for i in range(100))
+
+
+class SpinWork(threadutil.WorkBase):
+    def work(self, this_thread, log):
+        spin_profiled(0.2)
+
+
+class HangWork(threadutil.WorkBase):
+    def __init__(self, seconds, timeout=None, polite=True):
+        threadutil.WorkBase.__init__(self, timeout=timeout)
+        self.seconds = seconds
+        self.polite = polite
+        self.returned = False
+
+    def work(self, this_thread, log):
+        end_at = time.time() + self.seconds
+        while time.time() < end_at and not (self.polite and self.isSetStop()):
+            time.sleep(0.01)
+        self.returned = True
+        return 'late'
+
+
+class FailWork(HangWork):
+    def work(self, this_thread, log):
+        HangWork.work(self, this_thread, log)
+        raise ValueError('FailWork')
+
+
+class CountTask(threadutil.TaskBase):
+    def __init__(self, subworks, name='<count>'):
+        threadutil.TaskBase.__init__(self, name=name, log=log)
+        self.addSubWorks(subworks)
+        self.cleaned = 0
+
+    def cleanup(self):
+        self.cleaned += 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def wait_until(cond, timeout=10):
+    end_at = time.time() + timeout
+    while not cond() and time.time() < end_at:
+        time.sleep(0.01)
+    return cond()
+
+
 class TestThreadutil(unittest.TestCase):
     def test_ok(self):
         print 'test threadutil ok'
         threadutil.ws_test()
 
+    def test_work_start_latency(self):
+        print 'test threadutil work start latency'
+        wd = threadutil.WorkDispatcher(tmin=4, tmax=4, log=log)
+        wd.serve()
+        try:
+            self.assertTrue(wait_until(lambda: 'busy' not in wd.info().values()))
+            works = []
+            for i in range(500):
+                wk = StampWork()
+                wk.queued_at = time.time()
+                wd.addWork(wk)
+                works.append(wk)
+                time.sleep(0.001)
+            self.assertTrue(wait_until(
+                lambda: all(wk.status == threadutil.ST_FINISHED for wk in works)))
+            p99 = percentile([wk.started_at - wk.queued_at for wk in works], 0.99)
+            print 'p99 start latency: %.6fs' % p99
+            self.assertLess(p99, 0.005)
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+    def test_task_tracking(self):
+        print 'test threadutil task tracking'
+        ws = threadutil.WorkShop(tmin=4, tmax=4, log=log)
+        ws.serve()
+        try:
+            tasks = [CountTask([NopWork() for i in range(3)]) for j in range(2000)]
+            err_task = CountTask([NopWork(), ErrWork(), NopWork()])
+            ws.addTasks(tasks + [err_task])
+            self.assertTrue(wait_until(lambda: all(tk.cleaned for tk in tasks + [err_task])))
+            self.assertEqual(ws.currTaskSize, 0)
+            self.assertTrue(all(tk.status == threadutil.ST_FINISHED for tk in tasks))
+            self.assertEqual(err_task.status, threadutil.ST_ERROR)
+        finally:
+            ws.setToStop()
+            ws.join()
+        self.assertTrue(all(tk.cleaned == 1 for tk in tasks + [err_task]))
+
+    def test_futures(self):
+        print 'test threadutil futures'
+        wd = threadutil.WorkDispatcher(tmin=1, tmax=1, log=log, shared_queue=True)
+        wd.serve()
+        try:
+            blocker = threadutil.SleepWork(0.3)
+            wd.addWork(blocker)
+            futures = wd.addWorks([ValueWork(i) for i in range(10)])
+            err_future = wd.addWork(ErrWork())
+            canceled = wd.addWork(ValueWork(-1))
+            self.assertTrue(canceled.cancel())
+            done = []
+            canceled.add_done_callback(done.append)
+            self.assertEqual(done, [canceled])
+            results = [f.result() for f in threadutil.as_completed(futures, timeout=5)]
+            self.assertEqual(sorted(results), list(range(10)))
+            self.assertRaises(RuntimeError, err_future.result, 5)
+            threadutil.wait([err_future, canceled], timeout=5)
+            self.assertEqual(canceled.work.status, threadutil.ST_CANCEL)
+            blocker.waitForStop(timeout=5)
+            self.assertEqual(blocker.status, threadutil.ST_FINISHED)
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+    def test_task_future(self):
+        print 'test threadutil task future'
+        ws = threadutil.WorkShop(tmin=2, tmax=2, log=log)
+        ws.serve()
+        try:
+            ok = ws.addTask(CountTask([ValueWork(i) for i in range(5)]))
+            err = ws.addTask(CountTask([ValueWork(1), ErrWork()]))
+            empty = ws.addTask(CountTask([]))
+            self.assertEqual(ok.result(5), list(range(5)))
+            self.assertRaises(RuntimeError, err.result, 5)
+            self.assertEqual(err.task.status, threadutil.ST_ERROR)
+            self.assertEqual(empty.result(5), [])
+        finally:
+            ws.setToStop()
+            ws.join()
+
+    def test_process_backend(self):
+        print 'test threadutil process backend'
+        wd = threadutil.WorkDispatcher(tmin=2, tmax=2, log=log, shared_queue=True,
+                                       backend=threadutil.BACKEND_PROCESS, processes=2)
+        wd.serve()
+        try:
+            wk = PidWork()
+            err_wk = PidWork(fail=True)
+            thread_wk = PidWork()
+            thread_wk.backend = threadutil.BACKEND_THREAD
+            futures = wd.addWorks([wk, err_wk, thread_wk])
+            threadutil.wait(futures, timeout=30)
+            self.assertEqual(wk.status, threadutil.ST_FINISHED)
+            self.assertNotEqual(futures[0].result(), os.getpid())
+            self.assertEqual(wk.pid, futures[0].result())
+            self.assertEqual(err_wk.status, threadutil.ST_ERROR)
+            self.assertRaises(ValueError, futures[1].result)
+            self.assertEqual(futures[2].result(), os.getpid())
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+    def test_priority_deadline(self):
+        print 'test threadutil priority and deadline'
+        wd = threadutil.WorkDispatcher(tmin=1, tmax=1, log=log, shared_queue=True)
+        wd.serve()
+        try:
+            order = []
+            blocker = threadutil.SleepWork(0.2)
+            wd.addWork(blocker)
+            self.assertTrue(wait_until(lambda: blocker.status == threadutil.ST_WORKING))
+            low = OrderWork(order, priority=threadutil.PRI_LOW)
+            normal = OrderWork(order)
+            late = OrderWork(order, deadline=time.time() + 0.1)
+            soon = OrderWork(order, deadline=time.time() + 60)
+            high = OrderWork(order, priority=threadutil.PRI_HIGH)
+            futures = wd.addWorks([low, normal, late, soon, high])
+            threadutil.wait(futures, timeout=5)
+            self.assertEqual(order, [high, soon, normal, low])
+            self.assertEqual(late.status, threadutil.ST_CANCEL)
+            self.assertEqual(wd.missedDeadlines(), 1)
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+    def test_task_deadline(self):
+        print 'test threadutil task deadline'
+        ws = threadutil.WorkShop(tmin=1, tmax=1, log=log)
+        ws.serve()
+        try:
+            expired = CountTask([NopWork()])
+            expired.deadline = time.time() - 1
+            high = CountTask([NopWork()])
+            high.priority = threadutil.PRI_HIGH
+            futures = ws.addTasks([expired, high])
+            threadutil.wait(futures, timeout=5)
+            self.assertTrue(futures[0].cancelled())
+            self.assertEqual(expired.status, threadutil.ST_CANCEL)
+            self.assertEqual(high.subWorks[0].priority, threadutil.PRI_HIGH)
+            self.assertEqual(ws.info()['missed_deadlines'], 1)
+        finally:
+            ws.setToStop()
+            ws.join()
+
+    def test_elastic_pool(self):
+        print 'test threadutil elastic pool'
+        wd = threadutil.WorkDispatcher(tmin=1, tmax=4, log=log, shared_queue=True,
+                                       idle_timeout=0.2)
+        wd.serve()
+        try:
+            self.assertTrue(wait_until(lambda: 'busy' not in wd.info().values()))
+            threadutil.wait(wd.addWorks([threadutil.SleepWork(0.1) for i in range(8)]), timeout=5)
+            self.assertEqual(wd.info()['pool']['peak'], 4)
+            self.assertTrue(wait_until(lambda: wd.info()['pool']['current'] == 1))
+            self.assertEqual(wd.info()['pool']['retired'], 3)
+            self.assertEqual(wd.mgr.count(), 1)
+            futures = wd.addWorks([ValueWork(i) for i in range(4)])
+            self.assertEqual([f.result(5) for f in futures], list(range(4)))
+            self.assertEqual(threadutil.QueuePolicy(target_wait=0.1).size(2, 10, 0.05), 7)
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+    def test_backpressure(self):
+        print 'test threadutil backpressure'
+        wd = threadutil.WorkDispatcher(tmin=1, tmax=1, log=log, shared_queue=True, capacity=2)
+        wd.serve()
+        try:
+            blocker = threadutil.SleepWork(0.3)
+            wd.addWork(blocker)
+            self.assertTrue(wait_until(lambda: blocker.status == threadutil.ST_WORKING))
+            wd.addWorks([NopWork(), NopWork()])
+            self.assertTrue(wd.tryAddWork(NopWork()) is None)
+            self.assertRaises(threadutil.Full, wd.addWork, NopWork(), timeout=0.05)
+            self.assertTrue(wd.addWork(NopWork()).result(5) is None)
+            self.assertEqual(wd.info()['pool']['queue_high'], 2)
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+        ws = threadutil.WorkShop(tmin=1, tmax=1, log=log, task_capacity=1, work_capacity=1)
+        ws.serve()
+        try:
+            blocker = threadutil.SleepWork(0.3)
+            tasks = [CountTask([blocker])] + [CountTask([NopWork()]) for i in range(2)]
+            ws.addTasks(tasks)
+            self.assertTrue(wait_until(lambda: ws.info()['buffering'] == 0))
+            self.assertTrue(ws.tryAddTask(CountTask([NopWork()])) is not None)
+            self.assertTrue(ws.tryAddTask(CountTask([NopWork()])) is None)
+            self.assertEqual(ws.info()['buffer_high'], 1)
+            self.assertTrue(ws.addTask(CountTask([NopWork()]), timeout=5).result(5))
+        finally:
+            ws.setToStop()
+            ws.join()
+
+    def test_aging(self):
+        print 'test threadutil aging'
+        qu = threadutil.WorkQueue(aging=0.05)
+        low = NopWork(priority=threadutil.PRI_LOW)
+        high = NopWork(priority=threadutil.PRI_HIGH)
+        qu.put(low)
+        time.sleep(0.1)
+        qu.put(high)
+        with qu.cond:
+            self.assertTrue(qu.get() is low)
+            self.assertTrue(qu.get() is high)
+        self.assertTrue(qu.empty())
+
+    def test_shared_queue(self):
+        print 'test threadutil shared run queue'
+        wd = threadutil.WorkDispatcher(tmin=2, tmax=2, log=log, shared_queue=True)
+        wd.serve()
+        try:
+            long_wk = threadutil.SleepWork(1)
+            short_wks = [threadutil.SleepWork(0.01) for i in range(20)]
+            wd.addWork(long_wk)
+            wd.addWorks(short_wks)
+            self.assertTrue(wait_until(
+                lambda: all(wk.status == threadutil.ST_FINISHED for wk in short_wks)))
+            self.assertEqual(long_wk.status, threadutil.ST_WORKING)
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+    def test_lite_work(self):
+        print 'test threadutil lite work'
+        self.assertFalse(hasattr(LiteValueWork(0), '__dict__'))
+        ws = threadutil.WorkShop(tmin=2, tmax=2, log=log)
+        ws.serve()
+        try:
+            task = CountTask([LiteValueWork(i) for i in range(5)])
+            err_task = CountTask([LiteValueWork(-1), LiteValueWork(1)])
+            self.assertEqual(ws.addTask(task).result(5), [0, 1, 2, 3, 4])
+            self.assertRaises(RuntimeError, ws.addTask(err_task).result, 5)
+            self.assertEqual(err_task.subWorks[0].status, threadutil.ST_ERROR)
+        finally:
+            ws.setToStop()
+            ws.join()
+        wd = threadutil.WorkDispatcher(tmin=2, tmax=2, log=log)
+        wd.serve()
+        try:
+            works = [LiteValueWork(i) for i in range(100)]
+            futures = wd.addWorks(works)
+            works[-1].waitForStop(timeout=5)
+            self.assertEqual([f.result(5) for f in futures], list(range(100)))
+            self.assertTrue(all(wk.status == threadutil.ST_FINISHED for wk in works))
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+    def test_serve_readiness(self):
+        print 'test threadutil serve readiness'
+        shops = [threadutil.WorkShop(tmin=1, tmax=1, log=log) for i in range(10)]
+        start_at = time.time()
+        try:
+            self.assertTrue(shops[0].serve(timeout=5))
+            self.assertTrue(threadutil.serveAll(shops[1:], timeout=5))
+            self.assertLess(time.time() - start_at, 0.5)
+            self.assertTrue(all(ws.isAvailable() for ws in shops))
+        finally:
+            for ws in shops:
+                ws.setToStop()
+            for ws in shops:
+                ws.join()
+        stopped = threadutil.WorkShop(tmin=1, tmax=1, log=log)
+        stopped.setToStop()
+        self.assertFalse(stopped.serve())
+        self.assertFalse(stopped.isAlive())
+
+    def test_metrics(self):
+        print 'test threadutil metrics'
+        ws = threadutil.WorkShop(tmin=2, tmax=2, log=log)
+        ws.serve()
+        try:
+            ok = ws.addTask(CountTask([ValueWork(i) for i in range(4)]))
+            err = ws.addTask(CountTask([ErrWork()]))
+            ok.result(5)
+            self.assertRaises(RuntimeError, err.result, 5)
+            # a thread records its work after the work's future is resolved
+            self.assertTrue(wait_until(lambda: ws.metrics()['tasks']['error'] == 1
+                                       and ws.metrics()['works']['works']['error'] == 1
+                                       and ws.metrics()['works']['works']['finished'] == 4))
+            metrics = ws.metrics()
+            tasks, works = metrics['tasks'], metrics['works']['works']
+            self.assertEqual(tasks['finished'], 1)
+            self.assertEqual(tasks['classes']['CountTask']['run']['count'], 2)
+            self.assertEqual(tasks['wait']['count'], 2)
+            self.assertEqual(works['classes']['ValueWork']['finished'], 4)
+            self.assertEqual(works['classes']['ErrWork']['error'], 1)
+            self.assertEqual(works['wait']['count'], 5)
+            self.assertAlmostEqual(works['error_rate'], 0.2)
+            self.assertEqual(len(metrics['works']['threads']), 2)
+            self.assertEqual(metrics['works']['pool']['current'], 2)
+            text = ws.metricsText()
+            self.assertIn('vavava_ws_tasks_total{task="CountTask",status="error"} 1', text)
+            self.assertIn('vavava_ws_wd_works_total{work="ValueWork",status="finished"} 4', text)
+            self.assertIn('vavava_ws_wd_work_seconds_bucket{work="ErrWork",le="+Inf"} 1', text)
+            self.assertIn('vavava_ws_wd_queue_wait_seconds_count 5', text)
+        finally:
+            ws.setToStop()
+            ws.join()
+
+    def test_task_graph(self):
+        print 'test threadutil task graph'
+        ws = threadutil.WorkShop(tmin=3, tmax=3, log=log)
+        ws.serve()
+        try:
+            task = threadutil.TaskBase(name='dag', log=log)
+            fetch = [threadutil.SleepWork(0.05 * (i + 1)) for i in range(3)]
+            task.addSubWorks(fetch)
+            check = [threadutil.SleepWork(0.01) for i in range(3)]
+            for pre, sw in zip(fetch, check):
+                task.addSubWork(sw, after=[pre])
+            merge = threadutil.SleepWork(0.01)
+            task.addSubWork(merge, after=check)
+            ws.addTask(task).result(5)
+            for pre, sw in zip(fetch, check):
+                self.assertGreaterEqual(sw.started_at, pre.stopped_at)
+            # check[0] did not wait for the slower fetches
+            self.assertLess(check[0].started_at, fetch[2].stopped_at)
+            self.assertGreaterEqual(merge.started_at, max(sw.stopped_at for sw in check))
+
+            task = threadutil.TaskBase(name='dag_err', log=log)
+            err, other = ErrWork(), threadutil.SleepWork(0.01)
+            task.addSubWorks([err, other])
+            skipped = threadutil.SleepWork(0.01)
+            task.addSubWork(skipped, after=[err, other])
+            task.addSubWork(threadutil.SleepWork(0.01), after=[skipped])
+            self.assertRaises(RuntimeError, ws.addTask(task).result, 5)
+            self.assertEqual(task.status, threadutil.ST_ERROR)
+            for sw in task.subWorks[2:]:
+                self.assertEqual(sw.status, threadutil.ST_CANCEL)
+                self.assertIsNone(sw.started_at)
+            self.assertRaises(ValueError, task.addSubWork, ErrWork(), [ErrWork()])
+        finally:
+            ws.setToStop()
+            ws.join()
+
+    def test_bulk_submit(self):
+        print 'test threadutil bulk submit'
+        for shared in (False, True):
+            wd = threadutil.WorkDispatcher(tmin=4, tmax=4, log=log, shared_queue=shared,
+                                           capacity=7)
+            wd.serve()
+            try:
+                futures = wd.addWorks([ValueWork(i) for i in range(50)])
+                self.assertEqual([f.result(5) for f in futures], list(range(50)))
+                self.assertLessEqual(wd.info()['pool']['queue_high'], 7)
+                self.assertRaises(ValueError, wd.addWorks, [ValueWork(0), object()])
+            finally:
+                wd.setToStop()
+                wd.joinAll()
+        ws = threadutil.WorkShop(tmin=2, tmax=2, log=log, task_capacity=3)
+        ws.serve()
+        try:
+            tasks = [CountTask([ValueWork(i), ValueWork(-i)]) for i in range(10)]
+            tasks.append(CountTask([]))
+            futures = ws.addTasks(tasks)
+            self.assertEqual([f.result(5) for f in futures[:-1]],
+                             [[i, -i] for i in range(10)])
+            self.assertEqual(futures[-1].result(5), [])
+            self.assertLessEqual(ws.info()['buffer_high'], 3)
+        finally:
+            ws.setToStop()
+            ws.join()
+
+    def test_key_limits(self):
+        print 'test threadutil key limits'
+        wd = threadutil.WorkDispatcher(tmin=4, tmax=4, log=log, shared_queue=True)
+        wd.setLimit('slow', concurrency=1)
+        wd.setLimit('rated', rate=20, burst=1)
+        wd.serve()
+        try:
+            slow = [KeyWork('slow') for i in range(8)]
+            rated = [KeyWork('rated', 0) for i in range(6)]
+            free = [KeyWork('free', 0.01) for i in range(20)]
+            start_at = time.time()
+            futures = wd.addWorks(slow + rated + free)
+            threadutil.wait(futures[len(slow) + len(rated):], timeout=5)
+            # the parked works did not hold the threads
+            self.assertLess(time.time() - start_at, 0.3)
+            self.assertGreater(wd.parkedSize(), 0)
+            threadutil.wait(futures, timeout=5)
+            self.assertTrue(all(f.done() and not f.exception() for f in futures))
+            self.assertEqual(KeyWork.peak['slow'], 1)
+            self.assertGreater(KeyWork.peak['free'], 1)
+            starts = sorted(wk.started_at for wk in rated)
+            self.assertGreater(starts[-1] - starts[0], 0.2)
+            self.assertEqual(wd.metrics()['limits']['slow']['running'], 0)
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+    def test_retry(self):
+        print 'test threadutil retry'
+        policy = threadutil.RetryPolicy(attempts=3, backoff=0.1, jitter=0, retry_on=(RuntimeError,))
+        wd = threadutil.WorkDispatcher(tmin=1, tmax=1, log=log)
+        wd.serve()
+        try:
+            flaky = FlakyWork(2, retry=policy)
+            fut = wd.addWork(flaky)
+            # the thread is free while the flaky work backs off
+            quick = wd.addWork(threadutil.SleepWork(0))
+            self.assertTrue(threadutil.wait([quick], timeout=0.08)[0])
+            self.assertFalse(fut.done())
+            self.assertEqual(fut.result(timeout=5), 3)
+            self.assertEqual(flaky.retries, 2)
+            self.assertEqual(flaky.status, threadutil.ST_FINISHED)
+            exhausted = FlakyWork(5, retry=policy)
+            other = FlakyWork(1, error=ValueError, retry=policy)
+            self.assertRaises(RuntimeError, wd.addWork(exhausted).result, 5)
+            self.assertRaises(ValueError, wd.addWork(other).result, 5)
+            self.assertEqual((exhausted.runs, exhausted.retries), (3, 2))
+            self.assertEqual((other.runs, other.retries), (1, 0))
+            self.assertTrue(wait_until(lambda: wd.metrics()['works']['retries'] == 4))
+            self.assertEqual(wd.metrics()['works']['classes']['FlakyWork']['error'], 2)
+            self.assertIn('vavava_wd_work_retries_total{work="FlakyWork"} 4', wd.metricsText())
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+        ws = threadutil.WorkShop(tmin=2, tmax=2, log=log)
+        ws.serve()
+        try:
+            task = CountTask([FlakyWork(1), FlakyWork(0)])
+            task.retry = threadutil.RetryPolicy(backoff=0.01)
+            ws.addTask(task).result(timeout=5)
+            self.assertEqual(task.retries, 1)
+            self.assertEqual([sw.runs for sw in task.subWorks], [2, 1])
+        finally:
+            ws.setToStop()
+            ws.join()
+
+    def test_lanes(self):
+        print 'test threadutil lanes'
+        for shared in (False, True):
+            LaneWork.order.clear()
+            KeyWork.peak.clear()
+            wd = threadutil.WorkDispatcher(tmin=4, tmax=4, log=log, shared_queue=shared)
+            wd.serve()
+            try:
+                works = [LaneWork(key, i) for i in range(10) for key in 'abc']
+                futures = wd.addWorks(works[:15]) + [wd.addWork(wk) for wk in works[15:]]
+                self.assertGreater(wd.metrics()['lanes']['waiting'], 0)
+                threadutil.wait(futures, timeout=5)
+                self.assertTrue(all(f.done() and not f.exception() for f in futures))
+                for key in 'abc':
+                    self.assertEqual(LaneWork.order[key], range(10))
+                    self.assertEqual(KeyWork.peak['lane-' + key], 1)
+                # a lane is closed after its last future resolved
+                self.assertTrue(wait_until(lambda: wd.metrics()['lanes']['active'] == 0))
+                self.assertEqual(wd.queueSize(), 0)
+            finally:
+                wd.setToStop()
+                wd.joinAll()
+
+    def test_schedule(self):
+        print 'test threadutil schedule'
+        wd = threadutil.WorkDispatcher(tmin=2, tmax=2, log=log)
+        wd.serve()
+        try:
+            start_at = time.time()
+            later = wd.scheduleAfter(0.1, threadutil.SleepWork(0))
+            past = wd.scheduleAt(start_at - 1, threadutil.SleepWork(0))
+            dropped = wd.scheduleAfter(0.1, threadutil.SleepWork(0))
+            dropped.cancel()
+            past.future.result(timeout=5)
+            self.assertLess(time.time() - start_at, 0.1)
+            later.future.result(timeout=5)
+            self.assertGreaterEqual(time.time() - start_at, 0.1)
+            self.assertTrue(dropped.future.cancelled())
+
+            ticks = []
+            every = wd.scheduleEvery(0.05, lambda: ticks.append(1) or threadutil.SleepWork(0))
+            time.sleep(0.33)
+            every.cancel()
+            self.assertTrue(5 <= len(ticks) <= 7)
+            time.sleep(0.1)
+            self.assertEqual(len(ticks), every.runs)
+
+            late = time.time() - 0.22
+            catch_up = wd.scheduleEvery(1, lambda: threadutil.SleepWork(0), start=late - 4,
+                                        missed=threadutil.MISSED_CATCH_UP)
+            skip = wd.scheduleEvery(1, lambda: threadutil.SleepWork(0), start=late - 4)
+            self.assertTrue(wait_until(lambda: catch_up.runs and skip.runs))
+            self.assertEqual((catch_up.runs, catch_up.skipped), (5, 0))
+            self.assertEqual((skip.runs, skip.skipped), (1, 4))
+            self.assertAlmostEqual(skip.due_at, late + 1, places=3)
+
+            many = [wd.scheduleAfter(60, LiteValueWork(i)) for i in range(20000)]
+            self.assertEqual(wd.metrics()['schedules'], 20002)
+            for schedule in many:
+                schedule.cancel()
+            self.assertEqual(wd.scheduledSize(), 2)
+            self.assertIn('vavava_wd_schedules 2', wd.metricsText())
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+        self.assertEqual(wd.scheduledSize(), 0)
+        self.assertRaises(ValueError, wd.scheduleAfter, 1, threadutil.SleepWork(0))
+
+    def test_dedup(self):
+        print 'test threadutil dedup'
+        FetchWork.runs = 0
+        wd = threadutil.WorkDispatcher(tmin=4, tmax=4, log=log, memo_ttl=0.3)
+        wd.serve()
+        try:
+            works = [FetchWork(url) for url in ('a', 'b', 'a', 'a', 'b')]
+            futures = [wd.addWork(works[0])] + wd.addWorks(works[1:])
+            self.assertEqual(wd.metrics()['dedup']['attached'], 3)
+            results = [f.result(timeout=5) for f in futures]
+            self.assertEqual(results, ['page of a', 'page of b', 'page of a', 'page of a', 'page of b'])
+            self.assertEqual(FetchWork.runs, 2)
+            self.assertTrue(all(wk.status == threadutil.ST_FINISHED for wk in works))
+            # repeats within memo_ttl are served from the memo
+            self.assertEqual(wd.addWork(FetchWork('a')).result(timeout=1), 'page of a')
+            self.assertEqual(FetchWork.runs, 2)
+            wd.clearMemo('a')
+            wd.addWork(FetchWork('a', 0)).result(timeout=5)
+            self.assertEqual(FetchWork.runs, 3)
+            time.sleep(0.35)
+            wd.addWork(FetchWork('b', 0)).result(timeout=5)
+            self.assertEqual(FetchWork.runs, 4)
+            # errors are shared but not memoized
+            failed = [wd.addWork(FetchWork('c', fail=True)) for i in range(3)]
+            for f in failed:
+                self.assertRaises(RuntimeError, f.result, 5)
+            self.assertEqual(FetchWork.runs, 5)
+            wd.addWork(FetchWork('c', 0)).result(timeout=5)
+            self.assertEqual(FetchWork.runs, 6)
+            self.assertEqual(wd.metrics()['dedup']['deduped'], 6)
+            self.assertEqual(wd.metrics()['pool']['queued'], 0)
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+    def test_journal(self):
+        print 'test threadutil journal'
+        path = os.path.join(tempfile.mkdtemp(), 'journal.db')
+        try:
+            DurableWork.runs.clear()
+            GATE.clear()
+            ws = threadutil.WorkShop(tmin=1, tmax=1, log=log, journal=path)
+            ws.serve()
+            done = threadutil.TaskBase(name='done', log=log)
+            done.addSubWorks([DurableWork(1), DurableWork(2)])
+            ws.addTask(done).result(timeout=5)
+            # one thread: 3 finishes, 4 blocks it, 5 and 6 wait in the queue
+            task = threadutil.TaskBase(name='resumed', log=log)
+            task.addSubWorks([DurableWork(3), DurableWork(4, gated=True), DurableWork(5)])
+            task.addSubWork(DurableWork(6), after=task.subWorks[:1])
+            ws.addTask(task)
+            self.assertTrue(wait_until(lambda: DurableWork.runs.get(4)))
+            ws.setToStop()
+            GATE.set()
+            ws.join()
+            self.assertEqual(task.status, threadutil.ST_CANCEL)
+
+            ws = threadutil.WorkShop(tmin=2, tmax=2, log=log, journal=path)
+            self.assertEqual([tk.name for tk in ws.resumed], ['resumed'])
+            ws.serve()
+            try:
+                resumed = ws.resumed[0]
+                self.assertEqual(resumed.future.result(timeout=5), [30, 40, 50, 60])
+                self.assertEqual(DurableWork.runs, {1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1})
+                self.assertTrue(wait_until(lambda: ws.metrics()['journal']['queued'] == 0))
+            finally:
+                ws.setToStop()
+                ws.join()
+            self.assertEqual(threadutil.TaskJournal(path, log=log).load(), [])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_journal_rejected(self):
+        print 'test threadutil journal rejected tasks'
+        path = os.path.join(tempfile.mkdtemp(), 'journal.db')
+
+        def task(name, *values):
+            tk = threadutil.TaskBase(name=name, log=log)
+            tk.addSubWorks([DurableWork(value, gated=True) for value in values])
+            return tk
+        try:
+            GATE.clear()
+            ws = threadutil.WorkShop(tmin=1, tmax=1, log=log, journal=path,
+                                     task_capacity=1, work_capacity=1)
+            ws.serve()
+            try:
+                ws.addTasks([task('running', 1), task('queued', 2), task('taken', 3)])
+                self.assertTrue(wait_until(lambda: ws.info()['buffering'] == 0))
+                self.assertTrue(ws.tryAddTask(task('accepted', 4)) is not None)
+                self.assertTrue(ws.tryAddTask(task('rejected', 5)) is None)
+                self.assertRaises(threadutil.Full, ws.addTask, task('timed_out', 6), timeout=0.1)
+                self.assertRaises(threadutil.Full, ws.addTasks, [task('batch', 7)], timeout=0.1)
+            finally:
+                ws.setToStop()
+                GATE.set()
+                ws.join()
+            names = [tk.name for tk in threadutil.TaskJournal(path, log=log).load()]
+            self.assertTrue('accepted' in names)
+            for name in ('rejected', 'timed_out', 'batch'):
+                self.assertFalse(name in names)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_journal_unpicklable(self):
+        print 'test threadutil journal unpicklable tasks'
+        path = os.path.join(tempfile.mkdtemp(), 'journal.db')
+
+        def task(name, value):
+            tk = threadutil.TaskBase(name=name, log=log)
+            tk.addSubWorks([ValueWork(value)])
+            return tk
+        try:
+            ws = threadutil.WorkShop(tmin=1, tmax=1, log=log, journal=path, task_capacity=2)
+            ws.serve()
+            try:
+                import cPickle
+                for i in range(2):
+                    self.assertRaises(cPickle.PicklingError, ws.addTask, task('lambda', lambda: i))
+                    self.assertRaises(cPickle.PicklingError, ws.addTasks,
+                                      [task('valid', 0), task('lambdas', lambda: i)])
+                self.assertEqual(ws.info()['buffering'], 0)
+                self.assertEqual(ws.addTask(task('valid', 1), timeout=1).result(5), [1])
+            finally:
+                ws.setToStop()
+                ws.join()
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_profiler(self):
+        print 'test threadutil profiler'
+        ws = threadutil.WorkShop(tmin=2, tmax=2, log=log)
+        ws.serve()
+        try:
+            profiler = ws.startProfiler(interval=0.005, trace=True)
+            self.assertRaises(ValueError, ws.startProfiler)
+            task = CountTask([SpinWork(), SpinWork()], name='prof_task')
+            ws.addTask(task).result(timeout=5)
+            self.assertIs(ws.stopProfiler(), profiler)
+            self.assertIsNone(ws.stopProfiler())
+            self.assertFalse(profiler.isAlive())
+            self.assertGreater(profiler.byWork()['SpinWork'], 10)
+            self.assertEqual(profiler.byTask().keys(), ['prof_task'])
+            lines = profiler.collapsed().splitlines()
+            self.assertTrue(lines)
+            for line in lines:
+                stack, count = line.rsplit(' ', 1)
+                self.assertTrue(stack.startswith('prof_task;SpinWork;work ('))
+                self.assertGreater(int(count), 0)
+            self.assertTrue(any('spin_profiled' in line for line in lines))
+            self.assertTrue(profiler.collapsed(by_task=False).startswith('SpinWork;'))
+            events = profiler.chromeTrace()['traceEvents']
+            slices = [e for e in events if e['ph'] == 'X' and e['name'].startswith('spin_profiled')]
+            self.assertEqual(len(slices), 2)
+            self.assertTrue(all(100000 < e['dur'] < 300000 for e in slices))
+            self.assertEqual(len([e for e in events if e['ph'] == 'M']), 2)
+            # a new profiler starts from scratch
+            self.assertEqual(ws.startProfiler().byWork(), {})
+        finally:
+            ws.setToStop()
+            ws.join()
+
+    def test_delay_queue(self):
+        print 'test threadutil DelayQueue'
+        dq = threadutil.DelayQueue(log=log)
+        dq.serve()
+        try:
+            fired = threading.Event()
+            entry = dq.put(0.01, fired.set)
+            self.assertTrue(fired.wait(5))
+            dq.cancel(entry)  # fired already
+            later = dq.put(5, fired.set)
+            self.assertEqual(dq.size(), 1)
+            dq.cancel(later)
+            dq.cancel(later)
+            self.assertEqual(dq.size(), 0)
+            entries = [dq.put(5, fired.set) for i in range(100)]
+            for entry in entries[:80]:
+                dq.cancel(entry)
+            self.assertEqual(dq.size(), 20)
+        finally:
+            dq.setToStop()
+            dq.join()
+
+    def test_timeout(self):
+        print 'test threadutil timeout'
+        wd = threadutil.WorkDispatcher(tmin=1, tmax=1, log=log, timeout_grace=0.2)
+        wd.serve()
+        try:
+            start_at = time.time()
+            polite = HangWork(5, timeout=0.1)
+            self.assertRaises(threadutil.TimeoutError, wd.addWork(polite).result, 5)
+            self.assertLess(time.time() - start_at, 0.5)
+            self.assertEqual(polite.status, threadutil.ST_ERROR)
+            self.assertTrue(wait_until(lambda: polite.returned))
+            # ignores its stop flag: the thread is replaced, the queued work moves
+            hung = HangWork(0.8, timeout=0.1, polite=False)
+            start_at = time.time()
+            futures = wd.addWorks([hung, threadutil.SleepWork(0)])
+            self.assertRaises(threadutil.TimeoutError, futures[0].result, 5)
+            futures[1].result(timeout=5)
+            self.assertLess(time.time() - start_at, 0.6)
+            self.assertFalse(hung.returned)
+            metrics = wd.metrics()
+            self.assertEqual((metrics['timeouts'], metrics['threads_replaced']), (2, 1))
+            self.assertEqual(wd.mgr.count(), 1)
+            self.assertTrue(wait_until(lambda: hung.returned))
+            self.assertEqual(hung.status, threadutil.ST_ERROR)
+            # a dedup leader timed out: its followers fail with it, new works fly again
+            leader = HangWork(1, timeout=0.1, polite=False)
+            follower = HangWork(0)
+            leader.dedup_key = follower.dedup_key = 'hung'
+            start_at = time.time()
+            futures = wd.addWorks([leader, follower])
+            self.assertRaises(threadutil.TimeoutError, futures[1].result, 5)
+            self.assertLess(time.time() - start_at, 0.5)
+            again = HangWork(0)
+            again.dedup_key = 'hung'
+            self.assertEqual(wd.addWork(again).result(timeout=0.8), 'late')
+            self.assertFalse(leader.returned)
+            self.assertTrue(wait_until(lambda: leader.returned))
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+
+        ws = threadutil.WorkShop(tmin=1, tmax=1, log=log)
+        ws.serve()
+        try:
+            task = threadutil.TaskBase(name='slow', log=log, timeout=0.2)
+            task.addSubWorks([HangWork(5), HangWork(5)])
+            task.addSubWork(HangWork(0), after=task.subWorks[:1])
+            start_at = time.time()
+            self.assertRaises(threadutil.TimeoutError, ws.addTask(task).result, 5)
+            self.assertLess(time.time() - start_at, 0.5)
+            self.assertEqual(task.status, threadutil.ST_ERROR)
+            self.assertTrue(all(sw.status > threadutil.ST_WORKING for sw in task.subWorks))
+            fast = threadutil.TaskBase(name='fast', log=log, timeout=0.2)
+            fast.addSubWorks([HangWork(0)])
+            self.assertEqual(ws.addTask(fast).result(timeout=5), ['late'])
+        finally:
+            ws.setToStop()
+            ws.join()
+
+    def test_broker(self):
+        print 'test threadutil broker'
+        import signal
+        from vavava import brokerutil
+        broker = brokerutil.WorkBroker(lease=1.0, log=log)
+        broker.serve()
+        procs = [brokerutil.spawnWorker(broker.address, threads=2) for i in range(2)]
+        ws = threadutil.WorkShop(tmin=8, tmax=8, log=log,
+                                 backend=threadutil.BACKEND_BROKER, broker=broker.address)
+        ws.serve()
+        try:
+            # the messages signed with another key are dropped unread
+            stranger = brokerutil.BrokerPool(broker.address, log=log, authkey=b'not the key')
+            self.assertRaises(brokerutil.BrokerError, stranger.run, threadutil.SleepWork(0))
+            self.assertTrue(wait_until(lambda: broker.info()['workers'] == 2))
+            task = threadutil.TaskBase(name='remote', log=log)
+            task.addSubWorks([threadutil.CpuWork(10), threadutil.CpuWork(n='x')])
+            self.assertRaises(TypeError, ws.addTask(task).result, 10)
+            self.assertEqual(task.subWorks[0].future.result(), sum(i * i for i in range(10)))
+            self.assertEqual(task.status, threadutil.ST_ERROR)
+            # a killed worker: its leased works go to the other one
+            works = [threadutil.SleepWork(1) for i in range(4)]
+            task = threadutil.TaskBase(name='killed', log=log)
+            task.addSubWorks(works)
+            future = ws.addTask(task)
+            self.assertTrue(wait_until(lambda: broker.info()['leased'] == 4), broker.info())
+            procs[0].kill()
+            future.result(timeout=10)
+            self.assertEqual(broker.info()['requeued'], 2)
+            # a stopped worker: its lease expires
+            procs.append(brokerutil.spawnWorker(broker.address, threads=2))
+            self.assertTrue(wait_until(lambda: broker.info()['workers'] == 2))
+            task = threadutil.TaskBase(name='stopped', log=log)
+            task.addSubWorks([threadutil.SleepWork(1) for i in range(4)])
+            future = ws.addTask(task)
+            self.assertTrue(wait_until(lambda: broker.info()['leased'] == 4))
+            procs[1].send_signal(signal.SIGSTOP)
+            future.result(timeout=10)
+            info = broker.info()
+            self.assertEqual((info['workers'], info['requeued'], info['lost']), (1, 4, 0))
+            self.assertEqual(task.status, threadutil.ST_FINISHED)
+        finally:
+            ws.setToStop()
+            ws.join()
+            for proc in procs:
+                proc.kill()
+                proc.wait()
+            broker.setToStop()
+            broker.join()
+
+    def test_cancel(self):
+        print 'test threadutil cancel'
+        ws = threadutil.WorkShop(tmin=2, tmax=2, log=log)
+        ws.serve()
+        try:
+            task = threadutil.TaskBase(name='failed', log=log)
+            task.addSubWorks([HangWork(5), FailWork(0.2)])
+            task.addSubWorks([threadutil.SleepWork(0.01) for i in range(2000)])
+            task.addSubWork(threadutil.SleepWork(0), after=task.subWorks[-1:])
+            start_at = time.time()
+            self.assertRaises(ValueError, ws.addTask(task).result, 5)
+            self.assertLess(time.time() - start_at, 1)
+            canceled = [sw for sw in task.subWorks if sw.status == threadutil.ST_CANCEL]
+            self.assertGreater(len(canceled), 1900)
+            self.assertTrue(all(sw.status > threadutil.ST_WORKING for sw in task.subWorks))
+            metrics = ws.metrics()
+            self.assertEqual(metrics['cancel']['count'], 1)
+            self.assertGreater(metrics['works']['canceled_queued'], 1900)
+            self.assertEqual(metrics['works']['pool']['queued'], 0)
+            self.assertTrue(wait_until(lambda: task.subWorks[0].returned))
+
+            task = threadutil.TaskBase(name='canceled', log=log)
+            task.addSubWorks([HangWork(5), HangWork(5), HangWork(0)])
+            ws.addTask(task)
+            self.assertTrue(wait_until(lambda: task.subWorks[1].status == threadutil.ST_WORKING))
+            self.assertTrue(ws.cancelTask(task))
+            self.assertRaises(threadutil.CancelledError, task.future.result, 5)
+            self.assertEqual(task.status, threadutil.ST_CANCEL)
+            self.assertEqual(task.subWorks[2].status, threadutil.ST_CANCEL)
+            self.assertFalse(ws.cancelTask(task))
+            self.assertEqual(ws.metrics()['cancel']['count'], 2)
+            self.assertIn('vavava_ws_cancel_seconds_count 2', ws.metricsText())
+
+            # a work waiting for a retry gives back its lane and dedup flight
+            def keyed(fails, retry=None):
+                work = FlakyWork(fails, retry=retry)
+                work.lane_key = work.dedup_key = 'retried'
+                return work
+            retried = keyed(5, threadutil.RetryPolicy(attempts=10, backoff=1, jitter=0))
+            task = threadutil.TaskBase(name='retried', log=log)
+            task.addSubWorks([retried, FailWork(0.2)])
+            self.assertRaises(ValueError, ws.addTask(task).result, 5)
+            self.assertEqual(retried.status, threadutil.ST_CANCEL)
+            works = ws.metrics()['works']
+            self.assertEqual((works['lanes']['active'], works['dedup']['flights']), (0, 0))
+            task = threadutil.TaskBase(name='after', log=log)
+            task.addSubWorks([keyed(0)])
+            self.assertEqual(ws.addTask(task).result(3), [1])
+        finally:
+            ws.setToStop()
+            ws.join()
+
+
+class TestAsyncutil(unittest.TestCase):
+    """ asyncutil is python 3 only: its self test runs in $PYTHON3, if any """
+    def test_aws(self):
+        print 'test asyncutil'
+        import subprocess
+        python3 = os.environ.get('PYTHON3', 'python3')
+        here = os.path.dirname(os.path.abspath(__file__))
+        try:
+            found = subprocess.call([python3, '-c', 'import vavava.asyncutil, vavava.util'],
+                                    cwd=here, stdout=open(os.devnull, 'w'),
+                                    stderr=subprocess.STDOUT) == 0
+        except OSError:
+            found = False
+        if not found:
+            self.skipTest('no python 3 with the vavava requirements (set $PYTHON3)')
+        self.assertEqual(subprocess.call([python3, '-m', 'vavava.asyncutil'], cwd=here), 0)
+
 
 def make_suites():
     test_cases = {
+        'asyncutil': 'TestAsyncutil',
         'httputil': 'TestHttputil',
         'util': 'TestUtil',
         'sqliteuitl': 'TestSqliteutil',
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+asyncio counterparts of threadutil.WorkDispatcher and threadutil.WorkShop,
+python3 only. Coroutine works share one event loop, plain WorkBase works are
+bridged to an executor.
+"""
+
+import asyncio
+from time import time as _time
+from .threadutil import WorkBase, TaskBase, WORK_TYPES, \
+    ST_WORKING, ST_FINISHED, ST_CANCEL, ST_ERROR
+
+
+class AsyncWorkBase(WorkBase):
+    """ work() is a coroutine, this_shop is the AsyncWorkDispatcher """
+    async def work(self, this_shop, log):
+        raise NotImplementedError('AsyncWorkBase')
+
+
+class AsyncTaskBase(TaskBase):
+    """ cleanup() may be a coroutine """
+    async def cleanup(self):
+        pass
+
+
+class AsyncWorkDispatcher:
+    """
+    runs works on the running event loop, at most `limit` of them at the same
+    time. Not thread safe, call it from the loop.
+    AsyncWorkBase.work() is awaited, WorkBase.work() runs in `executor`
+    (None: the loop's default executor).
+    """
+    def __init__(self, limit=1000, executor=None, log=None):
+        self.limit = limit
+        self.log = log
+        self.__executor = executor
+        self.__sem = None
+        self.__tasks = {}
+        self.__started = set()
+        self.__stopped = False
+
+    def getName(self):
+        return 'async_wd'
+
+    def isSetStop(self):
+        return self.__stopped
+
+    def addWork(self, work):
+        """ return an asyncio future of work """
+        if not isinstance(work, WORK_TYPES):
+            raise ValueError('not a Work class')
+        self._call_by_ws_dispatch(work)
+        return asyncio.wrap_future(work.future)
+
+    def addWorks(self, works):
+        return [self.addWork(work) for work in works]
+
+    def _call_by_ws_dispatch(self, work):
+        if self.__sem is None:
+            self.__sem = asyncio.Semaphore(self.limit)
+        work._call_by_wd_future()
+        self.__tasks[work] = asyncio.ensure_future(self.__run(work))
+
+    def cancel(self, work):
+        """ cancel a waiting or running work """
+        work.cancel()
+        task = self.__tasks.get(work)
+        if task:
+            task.cancel()
+
+    def info(self):
+        return {'running': len(self.__started),
+                'waiting': len(self.__tasks) - len(self.__started),
+                'limit': self.limit}
+
+    def setToStop(self):
+        """ waiting works are canceled, running ones are set to stop """
+        self.__stopped = True
+        for work, task in list(self.__tasks.items()):
+            work.setToStop()
+            if work not in self.__started:
+                task.cancel()
+
+    async def join(self):
+        while self.__tasks:
+            await asyncio.wait(list(self.__tasks.values()))
+
+    async def __run(self, work):
+        try:
+            async with self.__sem:
+                if work.canceled:
+                    self.log.debug('[awd] canceled a work')
+                    work._call_by_work_thread_set_status(ST_CANCEL)
+                    return
+                if work._call_by_work_thread_set_status(ST_WORKING) == ST_CANCEL:
+                    self.log.debug('[awd] canceled a work')
+                    return
+                self.__started.add(work)
+                try:
+                    result = await self.__call(work)
+                except asyncio.CancelledError:
+                    work.setToStop()
+                    work._call_by_work_thread_set_status(ST_CANCEL)
+                except Exception as e:
+                    self.log.exception(e)
+                    work._call_by_work_thread_set_status(ST_ERROR, exception=e)
+                else:
+                    work._call_by_work_thread_set_status(ST_FINISHED, result=result)
+        except asyncio.CancelledError:
+            # canceled while waiting for the semaphore
+            work._call_by_work_thread_set_status(ST_CANCEL)
+        finally:
+            self.__started.discard(work)
+            self.__tasks.pop(work, None)
+
+    def __call(self, work):
+        if isinstance(work, AsyncWorkBase):
+            return work.work(self, self.log)
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(
+            self.__executor, work._call_by_work_thread_run, self, self.log)
+
+    def runInExecutor(self, func, *args):
+        """ bridge for blocking calls made by coroutine works """
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.__executor, func, *args)
+
+
+class AsyncWorkShop:
+    """ WorkShop on the event loop, subworks go to an AsyncWorkDispatcher """
+    def __init__(self, limit=1000, executor=None, log=None):
+        self.log = log
+        self.__wd = AsyncWorkDispatcher(limit=limit, executor=executor, log=log)
+        self.__curr_tasks = set()
+        self.__cleaning = set()
+        self.__stopped = False
+
+    def addTasks(self, tasks):
+        return [self.addTask(task) for task in tasks]
+
+    def addTask(self, task):
+        """ return an asyncio future of task """
+        assert isinstance(task, TaskBase)
+        if task.subWorks is None:
+            raise ValueError('[aws] can not add task, subwork is None (task not initialised)')
+        for sw in task.subWorks:
+            if not isinstance(sw, WORK_TYPES):
+                raise ValueError('[aws] can not add task, subwork is not a Work class')
+        if self.__stopped:
+            raise ValueError('[aws] can not add task, server is not available')
+        future = task._call_by_ws_future()
+        future._start()
+        if len(task.subWorks) == 0:
+            # empty task
+            task._call_by_ws_set_status(ST_FINISHED)
+            self.__add_cleanup(task)
+            return asyncio.wrap_future(future)
+        self.__curr_tasks.add(task)
+        task._call_by_ws_set_status(ST_WORKING)
+        for sw in task._call_by_ws_track(self.__task_done, self.__release):
+            self.__wd._call_by_ws_dispatch(sw)
+        self.log.debug('[aws] add a task: %s', task.name)
+        return asyncio.wrap_future(future)
+
+    def info(self):
+        info = self.__wd.info()
+        info['tasks'] = len(self.__curr_tasks)
+        info['cleaning'] = len(self.__cleaning)
+        return info
+
+    @property
+    def currTaskSize(self):
+        return len(self.__curr_tasks)
+
+    def idel(self):
+        return not self.__stopped and not self.__curr_tasks
+
+    def setToStop(self):
+        self.__stopped = True
+        self.__wd.setToStop()
+
+    async def join(self):
+        """ wait for the subworks, then for all cleanup() calls """
+        await self.__wd.join()
+        while self.__cleaning:
+            await asyncio.wait(list(self.__cleaning))
+
+    def __release(self, works):
+        for sw in works:
+            self.__wd._call_by_ws_dispatch(sw)
+
+    def __task_done(self, task, status):
+        if task not in self.__curr_tasks:
+            return
+        self.__curr_tasks.remove(task)
+        task._call_by_ws_set_status(status)
+        self.log.debug('[aws] Task end: %s, status=%d', task.name, status)
+        self.__add_cleanup(task)
+
+    def __add_cleanup(self, task):
+        cleaning = asyncio.ensure_future(self.__cleanup(task))
+        self.__cleaning.add(cleaning)
+        cleaning.add_done_callback(self.__cleaning.discard)
+
+    async def __cleanup(self, task):
+        try:
+            if asyncio.iscoroutinefunction(task.cleanup):
+                await task.cleanup()
+            else:
+                await self.__wd.runInExecutor(task.cleanup)
+        except Exception as e:
+            self.log.exception(e)
+
+
+# local test code
+
+class SleepAsyncWork(AsyncWorkBase):
+    def __init__(self, duration, name='_async_sleep_'):
+        AsyncWorkBase.__init__(self, name=name)
+        self.duration = duration
+
+    async def work(self, this_shop, log):
+        await asyncio.sleep(self.duration)
+        return self.name
+
+
+class ErrAsyncWork(AsyncWorkBase):
+    async def work(self, this_shop, log):
+        raise RuntimeError('ErrAsyncWork')
+
+
+class SyncWork(WorkBase):
+    def work(self, this_thread, log):
+        return this_thread.getName()
+
+
+class AsyncTaskTest(AsyncTaskBase):
+    CLEANUP = 0
+
+    async def cleanup(self):
+        AsyncTaskTest.CLEANUP += 1
+
+
+async def aws_test(log, total=5000):
+    ws = AsyncWorkShop(limit=2000, log=log)
+    tasks = []
+    for i in range(total // 5):
+        task = AsyncTaskTest(name='T_%05d' % i, log=log)
+        task.addSubWorks([SleepAsyncWork(0.5) for j in range(4)] + [SyncWork()])
+        tasks.append(task)
+    err_task = AsyncTaskTest(name='T_err', log=log)
+    err_task.addSubWorks([ErrAsyncWork(), SleepAsyncWork(0.2)])
+    start_at = _time()
+    futures = ws.addTasks(tasks + [err_task])
+    await asyncio.wait(futures[:-1])
+    log.error('[aws] %d works of 0.5s, limit=2000, %.3fs', total, _time() - start_at)
+    try:
+        await futures[-1]
+        assert False
+    except RuntimeError:
+        pass
+    ws.setToStop()
+    await ws.join()
+    assert all(tk.status == ST_FINISHED for tk in tasks)
+    assert err_task.status == ST_ERROR
+    assert AsyncTaskTest.CLEANUP == len(tasks) + 1
+
+
+if __name__ == "__main__":
+    import logging
+    from vavava import util
+    log = util.get_logger(level=logging.ERROR)
+    asyncio.new_event_loop().run_until_complete(aws_test(log))
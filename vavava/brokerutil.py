@@ -0,0 +1,703 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+spreads works over worker processes, on this host or others, through a
+small TCP broker: a WorkDispatcher (or WorkShop) with backend=BACKEND_BROKER
+hands each work to the broker over a BrokerPool, as it does to a ProcessPool,
+so the work statuses and the task tracking stay in that process.
+
+    export VAVAVA_BROKER_KEY=<shared secret>
+    python -m vavava.brokerutil --broker --ip=127.0.0.1 --port=9100
+    python -m vavava.brokerutil --worker --ip=127.0.0.1 --port=9100 --threads=8
+
+the works (and their results) are pickled, their classes must be importable
+by the workers. Unpickling runs code, so every message is signed with the
+key shared by the broker, its clients and workers (AUTHKEY_ENV, a random one
+inherited by the processes of spawnWorker() when unset) and dropped unless
+the signature matches. The messages are not encrypted: run the broker on
+loopback or a trusted network only, never on a public address.
+"""
+
+import os
+import sys
+import hmac
+import hashlib
+import binascii
+import socket
+import select
+import struct
+import threading
+import getopt
+from collections import deque
+from itertools import count as _count
+from time import time as _time, sleep as _sleep
+from .threadutil import ServeThreadBase, WorkBase, WorkDispatcher, CancelledError, \
+    ST_FINISHED, ST_ERROR
+if sys.version >= '3':
+    import pickle as _pickle
+else:
+    import cPickle as _pickle
+
+_HEADER = struct.Struct('!I')
+_SEQ = struct.Struct('!Q')
+_PROTOCOL = 2
+_NONCE_SIZE = 16
+_MAC_SIZE = hashlib.sha256().digest_size
+AUTHKEY_ENV = 'VAVAVA_BROKER_KEY'
+
+
+class BrokerError(RuntimeError):
+    """ the broker or the worker running a work went away """
+    pass
+
+
+def getAuthkey():
+    """
+    the key of AUTHKEY_ENV, a random one set there when missing, for the
+    processes started from now on to share it
+    """
+    key = os.environ.get(AUTHKEY_ENV)
+    if not key:
+        key = binascii.hexlify(os.urandom(32)).decode('ascii')
+        os.environ[AUTHKEY_ENV] = key
+    return key if isinstance(key, bytes) else key.encode('utf8')
+
+
+class _Channel:
+    """
+    pickled messages, each after its length, over a TCP socket. Both ends
+    first send a random nonce, then each message is signed with the authkey
+    over the nonce of the receiver, its sequence number and the pickle, so a
+    message is loaded only if it comes from a key holder, in this connection,
+    in order
+    """
+    def __init__(self, sock, authkey):
+        self.sock = sock
+        self.sent_at = _time()
+        self.__authkey = authkey
+        self.__mutex = threading.Lock()
+        self.__buf = b''
+        self.__nonce = os.urandom(_NONCE_SIZE)
+        self.__peer_nonce = None
+        self.__sent = _count()
+        self.__received = _count()
+        self.sock.sendall(self.__nonce)
+
+    def __mac(self, nonce, seq, data):
+        return hmac.new(self.__authkey, nonce + _SEQ.pack(seq) + data, hashlib.sha256).digest()
+
+    def send(self, msg):
+        """ thread safe """
+        if self.__peer_nonce is None:
+            raise BrokerError('message sent before the handshake')
+        data = _pickle.dumps(msg, _PROTOCOL)
+        with self.__mutex:
+            mac = self.__mac(self.__peer_nonce, next(self.__sent), data)
+            self.sock.sendall(_HEADER.pack(len(mac) + len(data)) + mac + data)
+            self.sent_at = _time()
+
+    def feed(self, data):
+        """ return the messages completed by data, raise BrokerError on a bad signature """
+        buf = self.__buf + data
+        msgs = []
+        start = 0
+        if self.__peer_nonce is None:
+            if len(buf) < _NONCE_SIZE:
+                self.__buf = buf
+                return msgs
+            self.__peer_nonce = buf[:_NONCE_SIZE]
+            start = _NONCE_SIZE
+        while len(buf) - start >= _HEADER.size:
+            size = _HEADER.unpack_from(buf, start)[0]
+            end = start + _HEADER.size + size
+            if end > len(buf):
+                break
+            mac = buf[start + _HEADER.size:start + _HEADER.size + _MAC_SIZE]
+            body = buf[start + _HEADER.size + _MAC_SIZE:end]
+            if size < _MAC_SIZE or not hmac.compare_digest(
+                    mac, self.__mac(self.__nonce, next(self.__received), body)):
+                raise BrokerError('bad message signature')
+            msgs.append(_pickle.loads(body))
+            start = end
+        self.__buf = buf[start:]
+        return msgs
+
+    def handshake(self, timeout=10):
+        """ wait for the nonce of the peer, before the first send() """
+        end_at = _time() + timeout
+        while self.__peer_nonce is None:
+            if _time() >= end_at or self.poll(end_at - _time()) is None:
+                raise BrokerError('no handshake from the peer')
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def poll(self, timeout):
+        """
+        the messages received in `timeout` seconds, None once the peer closed.
+        The socket stays blocking for send()
+        """
+        if not select.select([self.sock], [], [], timeout)[0]:
+            return []
+        data = self.sock.recv(65536)
+        if not data:
+            return None
+        return self.feed(data)
+
+
+def _connect(address, timeout=10):
+    sock = socket.create_connection(address, timeout)
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class _Peer:
+    """ a connection of the broker, from a BrokerPool or a BrokerWorker """
+    def __init__(self, channel, addr):
+        self.channel = channel
+        self.addr = addr
+        self.role = None
+        self.credit = 0  # worker: works it may take more
+        self.works = {}  # client: its id: _BrokerWork, worker: broker id: _BrokerWork leased
+        self.seen_at = _time()
+
+
+class _BrokerWork:
+    """ a work in the broker, queued or leased to a worker """
+    __slots__ = ('bid', 'client', 'wid', 'payload', 'worker', 'requeues', 'done')
+
+    def __init__(self, bid, client, wid, payload):
+        self.bid = bid
+        self.client = client
+        self.wid = wid
+        self.payload = payload
+        self.worker = None
+        self.requeues = 0
+        self.done = False
+
+
+class WorkBroker(ServeThreadBase):
+    """
+    queues the works put by BrokerPools and leases them to the BrokerWorkers,
+    at most as many to a worker as it has threads. A worker renews its leases
+    with every message, heartbeats when idle; one silent for `lease` seconds
+    or disconnected is dropped and its works are queued again, first. A work
+    requeued more than `max_requeues` times ends with a BrokerError. The
+    works of a client gone are canceled.
+    One thread polls all the sockets, port=0 takes a free port, see `address`
+    """
+    TICK = 0.05
+
+    def __init__(self, ip='127.0.0.1', port=0, lease=10.0, max_requeues=3, log=None,
+                 authkey=None):
+        ServeThreadBase.__init__(self, log=log)
+        self.lease = lease
+        self.__authkey = authkey or getAuthkey()
+        self.max_requeues = max_requeues
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__sock.bind((ip, port))
+        self.__sock.listen(64)
+        self.address = self.__sock.getsockname()
+        self.__peers = {}  # socket: _Peer
+        self.__workers = []
+        self.__queue = deque()  # _BrokerWork, done ones are skipped
+        self.__works = {}  # broker id: _BrokerWork not done
+        self.__seq = _count()
+        self.__dispatched = 0
+        self.__done = 0
+        self.__requeued = 0
+        self.__lost = 0
+
+    def info(self):
+        leased = sum(len(worker.works) for worker in list(self.__workers))
+        return {'workers': len(self.__workers),
+                'clients': len(self.__peers) - len(self.__workers),
+                'queued': len(self.__works) - leased,
+                'leased': leased,
+                'dispatched': self.__dispatched,
+                'done': self.__done,
+                'requeued': self.__requeued,
+                'lost': self.__lost}
+
+    def run(self):
+        self.log.debug('[broker] listen at %s:%d', *self.address)
+        self._set_server_available()
+        try:
+            while not self.isSetStop():
+                socks = [self.__sock] + list(self.__peers)
+                try:
+                    readable = select.select(socks, [], [], WorkBroker.TICK)[0]
+                except (select.error, socket.error) as e:
+                    self.log.debug('[broker] select: %r', e)
+                    continue
+                for sock in readable:
+                    if sock is self.__sock:
+                        self.__accept()
+                    elif sock in self.__peers:
+                        self.__read(self.__peers[sock])
+                self.__expire()
+                self.__dispatch()
+        finally:
+            for peer in list(self.__peers.values()):
+                peer.channel.close()
+            self.__peers.clear()
+            self.__sock.close()
+            self._set_server_available(False)
+
+    def __accept(self):
+        try:
+            sock, addr = self.__sock.accept()
+        except socket.error as e:
+            self.log.debug('[broker] accept: %r', e)
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.__peers[sock] = _Peer(_Channel(sock, self.__authkey), addr)
+        except socket.error as e:
+            self.log.debug('[broker] accept: %r', e)
+            sock.close()
+
+    def __read(self, peer):
+        try:
+            data = peer.channel.sock.recv(65536)
+        except socket.error:
+            data = b''
+        if not data:
+            self.__drop(peer, 'disconnected')
+            return
+        peer.seen_at = _time()
+        try:
+            msgs = peer.channel.feed(data)
+        except BrokerError as e:
+            self.log.warn('[broker] drop %s:%d, %s', peer.addr[0], peer.addr[1], e)
+            self.__drop(peer, str(e))
+            return
+        except Exception as e:
+            self.log.exception(e)
+            self.__drop(peer, 'bad message')
+            return
+        for msg in msgs:
+            self.__handle(peer, msg)
+
+    def __send(self, peer, msg):
+        try:
+            peer.channel.send(msg)
+        except socket.error as e:
+            self.__drop(peer, repr(e))
+
+    def __handle(self, peer, msg):
+        kind = msg[0]
+        if kind == 'put':
+            bw = _BrokerWork(next(self.__seq), peer, msg[1], msg[2])
+            peer.works[bw.wid] = bw
+            self.__works[bw.bid] = bw
+            self.__queue.append(bw)
+        elif kind == 'done':
+            bw = peer.works.pop(msg[1], None)
+            if bw is not None:
+                peer.credit += 1
+                self.__finish(bw, msg[2])
+        elif kind == 'cancel':
+            bw = peer.works.get(msg[1])
+            if bw is None:
+                pass
+            elif bw.worker is None:
+                self.__finish(bw, None)
+            else:
+                self.__send(bw.worker, ('cancel', bw.bid))
+        elif kind == 'hello':
+            peer.role = msg[1]
+            if peer.role == 'worker':
+                peer.credit = msg[2]
+                self.__workers.append(peer)
+                self.log.debug('[broker] worker %s:%d, threads=%d', peer.addr[0], peer.addr[1], msg[2])
+                self.__send(peer, ('welcome', self.lease))
+
+    def __finish(self, bw, reply):
+        bw.done = True
+        self.__done += 1
+        self.__works.pop(bw.bid, None)
+        client = bw.client
+        if client.works.pop(bw.wid, None) is not None:
+            self.__send(client, ('done', bw.wid, reply))
+
+    def __dispatch(self):
+        workers = [worker for worker in self.__workers if worker.credit > 0]
+        while self.__queue and workers:
+            bw = self.__queue.popleft()
+            if bw.done:
+                continue
+            worker = max(workers, key=lambda w: w.credit)
+            worker.credit -= 1
+            if worker.credit == 0:
+                workers.remove(worker)
+            bw.worker = worker
+            worker.works[bw.bid] = bw
+            self.__dispatched += 1
+            self.__send(worker, ('work', bw.bid, bw.payload))
+
+    def __expire(self):
+        end_at = _time() - self.lease
+        for worker in list(self.__workers):
+            if worker.seen_at < end_at:
+                self.__drop(worker, 'lease expired')
+
+    def __drop(self, peer, reason):
+        if self.__peers.pop(peer.channel.sock, None) is None:
+            return
+        peer.channel.close()
+        if peer.role == 'worker':
+            self.__workers.remove(peer)
+            self.log.warn('[broker] drop worker %s:%d, %s, %d works requeued',
+                          peer.addr[0], peer.addr[1], reason, len(peer.works))
+            works, peer.works = list(peer.works.values()), {}
+            requeue = []
+            for bw in sorted(works, key=lambda w: w.bid):
+                bw.worker = None
+                bw.requeues += 1
+                if bw.requeues > self.max_requeues:
+                    self.__lost += 1
+                    lost = BrokerError('work lost with %d workers' % bw.requeues)
+                    self.__finish(bw, _pickle.dumps((False, lost, None), _PROTOCOL))
+                else:
+                    requeue.append(bw)
+            self.__requeued += len(requeue)
+            self.__queue.extendleft(reversed(requeue))
+        else:
+            self.log.debug('[broker] drop client %s:%d, %s', peer.addr[0], peer.addr[1], reason)
+            works, peer.works = list(peer.works.values()), {}
+            for bw in works:
+                if bw.worker is None:
+                    bw.done = True
+                    self.__works.pop(bw.bid, None)
+                else:
+                    self.__send(bw.worker, ('cancel', bw.bid))
+
+
+_LOST = object()
+
+
+class BrokerPool:
+    """
+    the pool of WorkDispatcher(backend=BACKEND_BROKER): a WorkerThread puts
+    the work to the broker and waits for it, as with ProcessPool, so the work
+    keeps its status transitions, timeouts and retries, and its return value,
+    exception and attributes come back. A work set to stop is canceled in the
+    broker, or set to stop in the worker. One connection, opened on the
+    first work and again after it was lost
+    """
+    CANCEL_CHECK_INTERVAL = 0.1
+
+    def __init__(self, address, log=None, authkey=None):
+        self.address = tuple(address)
+        self.log = log
+        self.__authkey = authkey or getAuthkey()
+        self.__mutex = threading.Lock()
+        self.__channel = None
+        self.__seq = _count()
+        self.__waiting = {}  # id: [Event, reply, work, cancel sent]
+
+    def run(self, work):
+        payload = _pickle.dumps(work, _PROTOCOL)
+        entry = [threading.Event(), None, work, False]
+        with self.__mutex:
+            if self.__channel is None:
+                self.__connect()
+            channel = self.__channel
+            wid = next(self.__seq)
+            self.__waiting[wid] = entry
+        try:
+            channel.send(('put', wid, payload))
+            # no timeout: a timed wait polls in python 2, the reader checks the stops
+            entry[0].wait()
+        except socket.error as e:
+            self.__lost(channel, e)
+        finally:
+            self.__waiting.pop(wid, None)
+        reply = entry[1]
+        if reply is _LOST:
+            raise BrokerError('connection to the broker lost')
+        if reply is None:
+            raise CancelledError()
+        ok, value, state = _pickle.loads(reply)
+        if state is not None:
+            work._call_by_pool_restore(state)
+        if not ok:
+            raise value
+        return value
+
+    def __connect(self):
+        channel = _Channel(_connect(self.address), self.__authkey)
+        try:
+            channel.handshake()
+            channel.send(('hello', 'client'))
+        except Exception:
+            channel.close()
+            raise
+        reader = threading.Thread(target=self.__read, args=(channel,))
+        reader.setDaemon(True)
+        reader.start()
+        self.__channel = channel
+
+    def __read(self, channel):
+        """ sets the replies, sends a cancel for each work set to stop """
+        error = None
+        try:
+            while True:
+                msgs = channel.poll(BrokerPool.CANCEL_CHECK_INTERVAL)
+                if msgs is None:
+                    break
+                for msg in msgs:
+                    entry = self.__waiting.get(msg[1])
+                    if entry is not None:
+                        entry[1] = msg[2]
+                        entry[0].set()
+                for wid, entry in list(self.__waiting.items()):
+                    if not entry[3] and entry[2].isSetStop():
+                        entry[3] = True
+                        channel.send(('cancel', wid))
+        except (select.error, socket.error) as e:
+            error = e
+        self.__lost(channel, error)
+
+    def __lost(self, channel, error):
+        with self.__mutex:
+            if self.__channel is not channel:
+                return
+            self.__channel = None
+            waiting = list(self.__waiting.values())
+        if error is not None and self.log:
+            self.log.warn('[broker] connection lost: %r', error)
+        channel.close()
+        for entry in waiting:
+            if not entry[0].isSet():
+                entry[1] = _LOST
+                entry[0].set()
+
+    def shutdown(self, wait=True):
+        with self.__mutex:
+            channel = self.__channel
+        if channel is not None:
+            try:
+                channel.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.__lost(channel, None)
+
+
+class _BrokerRun(WorkBase):
+    """ runs a work received from the broker in a BrokerWorker """
+    def __init__(self, bid, payload):
+        WorkBase.__init__(self, name='_broker_run_')
+        self.bid = bid
+        self.payload = payload
+        self.inner = None
+
+    def work(self, this_thread, log):
+        self.inner = _pickle.loads(self.payload)
+        self.payload = None
+        if self.isSetStop():
+            self.inner.setToStop()
+        return self.inner.work(this_thread, log)
+
+    def setToStop(self):
+        WorkBase.setToStop(self)
+        if self.inner is not None:
+            self.inner.setToStop()
+
+    def reply(self):
+        """ the outcome for BrokerPool.run(), None when canceled """
+        if self.status == ST_FINISHED:
+            outcome = (True, self.future.result(), self.inner.__getstate__())
+        elif self.status == ST_ERROR:
+            state = self.inner.__getstate__() if self.inner is not None else None
+            outcome = (False, self.future.exception(), state)
+        else:
+            return None
+        try:
+            return _pickle.dumps(outcome, _PROTOCOL)
+        except Exception as e:
+            return _pickle.dumps((False, BrokerError('outcome not picklable: %r' % e), None),
+                                 _PROTOCOL)
+
+
+class BrokerWorker(ServeThreadBase):
+    """
+    takes works from the broker at `address` and runs them on its own
+    WorkDispatcher of `threads` threads, heartbeats every third of the lease
+    when it has nothing else to send. It stops when the broker goes away
+    """
+    def __init__(self, address, threads=4, log=None, authkey=None):
+        ServeThreadBase.__init__(self, log=log)
+        self.address = tuple(address)
+        self.threads = threads
+        self.__authkey = authkey or getAuthkey()
+        self.done = 0
+        self.__channel = None
+        self.__runs = {}  # broker id: _BrokerRun
+
+    def setToStop(self):
+        ServeThreadBase.setToStop(self)
+        channel = self.__channel
+        if channel is not None:
+            try:
+                channel.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def run(self):
+        wd = WorkDispatcher(tmin=self.threads, tmax=self.threads, log=self.log,
+                            shared_queue=True)
+        wd.serve()
+        channel = None
+        interval = 1.0  # a third of the lease, once welcome
+        try:
+            channel = self.__channel = _Channel(_connect(self.address), self.__authkey)
+            channel.handshake()
+            channel.send(('hello', 'worker', self.threads))
+            while not self.isSetStop():
+                msgs = channel.poll(interval)
+                if msgs is None:
+                    self.log.warn('[broker] the broker went away')
+                    break
+                for msg in msgs:
+                    if msg[0] == 'work':
+                        run = _BrokerRun(msg[1], msg[2])
+                        self.__runs[run.bid] = run
+                        wd.addWork(run).add_done_callback(
+                            lambda future, run=run: self.__reply(channel, run))
+                    elif msg[0] == 'cancel':
+                        run = self.__runs.get(msg[1])
+                        if run is not None:
+                            run.setToStop()
+                    elif msg[0] == 'welcome':
+                        interval = msg[1] / 3.0
+                        self._set_server_available()
+                if _time() - channel.sent_at >= interval:
+                    channel.send(('hb',))
+        except (select.error, socket.error, BrokerError) as e:
+            if not self.isSetStop():
+                self.log.warn('[broker] worker stopped: %r', e)
+        finally:
+            wd.setToStop()
+            wd.joinAll()
+            if channel is not None:
+                channel.close()
+            self._set_server_available(False)
+
+    def __reply(self, channel, run):
+        self.__runs.pop(run.bid, None)
+        self.done += 1
+        try:
+            channel.send(('done', run.bid, run.reply()))
+        except socket.error as e:
+            self.log.debug('[broker] reply: %r', e)
+
+
+def spawnWorker(address, threads=4, authkey=None):
+    """ start a BrokerWorker in a new local process, return its Popen """
+    import subprocess
+    env = dict(os.environ)
+    key = authkey or getAuthkey()
+    env[AUTHKEY_ENV] = key if sys.version < '3' else key.decode('utf8')
+    return subprocess.Popen([sys.executable, '-m', 'vavava.brokerutil', '--worker',
+                             '--ip=%s' % address[0], '--port=%d' % address[1],
+                             '--threads=%d' % threads], env=env)
+
+
+# local test code
+
+def broker_bench_scaling(log, works=400, unit=0.02, threads=4, sizes=(1, 2, 4, 8)):
+    """
+    works of `unit` seconds (waiting, as on I/O) through one broker to 1, 2,
+    4 .. worker processes of `threads` threads, the throughput should grow
+    with the workers. CPU-bound works scale the same up to the cpu count
+    """
+    from .threadutil import SleepWork, BACKEND_BROKER, wait
+    broker = WorkBroker(log=log)
+    broker.serve()
+    procs = []
+    base = None
+    try:
+        for size in sizes:
+            procs += [spawnWorker(broker.address, threads) for i in range(size - len(procs))]
+            while broker.info()['workers'] < size:
+                _sleep(0.05)
+            wd = WorkDispatcher(tmin=size * threads, tmax=size * threads, log=log,
+                                shared_queue=True, backend=BACKEND_BROKER,
+                                broker=broker.address)
+            wd.serve()
+            wait(wd.addWorks([SleepWork(0) for i in range(size * threads)]))  # warm up
+            start_at = _time()
+            wait(wd.addWorks([SleepWork(unit) for i in range(works)]))
+            duration = _time() - start_at
+            base = base or duration
+            log.error('[bench] workers=%d threads=%d %d works %.3fs %.0f/s speedup=%.2f',
+                      size, threads, works, duration, works / duration, base / duration)
+            wd.setToStop()
+            wd.joinAll()
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        broker.setToStop()
+        broker.join()
+
+
+def print_usage(optArray):
+    print("""
+    brokerutil --broker [--ip=127.0.0.1] [--port=9100] [--lease=10]
+    brokerutil --worker [--ip=127.0.0.1] [--port=9100] [--threads=4]
+    both need the shared key in $%s
+    """ % AUTHKEY_ENV, optArray)
+
+
+def main():
+    import logging
+    from vavava import util
+    # not this __main__ module: BrokerError is pickled to the clients
+    from vavava.brokerutil import WorkBroker, BrokerWorker, broker_bench_scaling
+    optArray = ["broker", "worker", "bench", "ip=", "port=", "threads=", "lease="]
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", optArray)
+    except getopt.GetoptError as e:
+        print(e)
+        print_usage(optArray)
+        return
+    PARAM = dict((opt.replace('-', ''), arg) for opt, arg in opts)
+    address = (PARAM.get('ip') or '127.0.0.1', int(PARAM.get('port') or 9100))
+    log = util.get_logger(level=logging.ERROR)
+    if ('broker' in PARAM or 'worker' in PARAM) and not os.environ.get(AUTHKEY_ENV):
+        print('set the key shared by the broker and its workers in $%s' % AUTHKEY_ENV)
+        return
+    if 'broker' in PARAM:
+        server = WorkBroker(address[0], address[1], lease=float(PARAM.get('lease') or 10), log=log)
+    elif 'worker' in PARAM:
+        server = BrokerWorker(address, threads=int(PARAM.get('threads') or 4), log=log)
+    elif 'bench' in PARAM:
+        broker_bench_scaling(log)
+        return
+    else:
+        print_usage(optArray)
+        return
+    server.serve()
+    try:
+        while server.isAlive():
+            server.join(1)
+    finally:
+        server.setToStop()
+        server.join()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt as e:
+        print('stop by user')
+    exit(0)
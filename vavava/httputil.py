@@ -5,6 +5,11 @@
 import urllib
 import urllib2
 import cookielib
+import httplib
+import socket
+import threading
+from collections import deque
+from time import time as _time, sleep as _sleep
 from gzip import GzipFile as _GzipFile
 from zlib import compress as _decompress, error as _zlib_error, MAX_WBITS as _zlib_MAX_WBITS
 try:
@@ -19,19 +24,20 @@ DEBUG_LVL = 0
 DEFAULT_HEADERS = {
     'Referer'   : "http://www.time.com/",
     'User-Agent': 'Mozilla/5.0 (Windows; U; Windows NT 6.1; en-US; rv:1.9.1.6) Gecko/20091201 Firefox/3.5.6',
-    # 'Connection': 'keep-alive',
+    'Connection': 'keep-alive',
     'Accept'    : 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
 }
 
 
 
 def http_get(url, retry=None):
+    client = HttpUtil()
     if not retry:
-        return HttpUtil().get(url)
+        return client.get(url)
     while retry > 0:
         retry -= 1
         try:
-            return HttpUtil().get(url)
+            return client.get(url)
         except KeyboardInterrupt as e:
             raise e
         except Exception: # urllib2.HTTPError, urllib2.URLError:
@@ -39,16 +45,21 @@ def http_get(url, retry=None):
 
 
 class HttpUtil:
-    """ a simple client of http"""
-    def __init__(self):
+    """
+    a simple client of http. pooled: keep the connections alive in the
+    ConnectionPool POOL shared by all the clients, read or close the responses
+    to give their connection back
+    """
+    def __init__(self, pooled=True):
         self._headers = DEFAULT_HEADERS
+        self.pooled = pooled
         self.set_debug_level()
         self.handlers = [
             ContentEncodingProcessor,  # diff with urllib2.build_opener(), disabled by HttpDownloadClipHandler
             urllib2.ProxyHandler,
             urllib2.UnknownHandler,
-            urllib2.HTTPHandler,
-            urllib2.HTTPSHandler,
+            PooledHTTPHandler if pooled else urllib2.HTTPHandler,
+            PooledHTTPSHandler if pooled else urllib2.HTTPSHandler,
             urllib2.HTTPDefaultErrorHandler,
             urllib2.HTTPRedirectHandler,
             urllib2.FTPHandler,
@@ -69,17 +80,20 @@ class HttpUtil:
         return self.response.read()
 
     def head(self, url, timeout=TIMEOUT):
-        import httplib
         from urlparse import urlparse
         parts = urlparse(url)
-        con = httplib.HTTPConnection(parts.netloc, timeout=timeout)
         if parts.query == '':
             url = parts.path
         else:
             url = parts.path + '/?' + parts.query
-        con.request('HEAD', url, headers=self._headers)
-        res = con.getresponse()
-        con.close()
+        if self.pooled:
+            res = POOL.request(parts.scheme or 'http', parts.netloc, 'HEAD', url,
+                               headers=self._headers, timeout=timeout)
+        else:
+            con = httplib.HTTPConnection(parts.netloc, timeout=timeout)
+            con.request('HEAD', url, headers=self._headers)
+            res = con.getresponse()
+            con.close()
         if res.status == 302:
             res = self.head(res.getheader('Location'))
         return res
@@ -116,7 +130,7 @@ class HttpUtil:
             self.handlers.append(urllib2.HTTPCookieProcessor(self._cookie))
         #################################################################
         opener = urllib2.OpenerDirector()
-        if hasattr(urllib2.httplib, 'HTTPS'):
+        if hasattr(urllib2.httplib, 'HTTPS') and not self.pooled:
             self.handlers.append(urllib2.HTTPSHandler)
         skip = set()
         for klass in self.handlers:
@@ -205,6 +219,248 @@ class ContentEncodingProcessor(urllib2.BaseHandler):
         return resp
 
 
+class ConnectionPool:
+    """
+    keep-alive httplib connections per (scheme, host:port), thread safe. At
+    most `maxsize` connections of a host are pooled, in use or idle, a
+    request beyond them gets an overflow connection closed after use. The
+    last one given back is reused first, the ones idle more than
+    `idle_timeout` seconds are closed, by a daemon thread while any is idle.
+    A response holds its connection until it is read to the end, closed or
+    garbage collected: read or close the responses
+    """
+    EVICT_INTERVAL = 1.0
+    IDEMPOTENT = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+
+    def __init__(self, maxsize=10, idle_timeout=30):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.created = 0
+        self.reused = 0
+        self.overflow = 0
+        self.__mutex = threading.Lock()
+        self.__idle = {}  # key: deque of (idle since, connection), oldest first
+        self.__open = {}  # key: pooled connections open
+        self.__sweeper = None  # the thread evicting the idle connections
+        self.__evicted_at = _time()
+
+    def get(self, scheme, host, timeout=TIMEOUT, **conn_args):
+        """ return (connection, reused), give it back with put() or discard() """
+        key = (scheme, host)
+        with self.__mutex:
+            now = _time()
+            if now - self.__evicted_at > self.EVICT_INTERVAL:
+                self.__evict(now)
+            idle = self.__idle.get(key)
+            if idle:
+                conn = idle.pop()[1]
+                self.reused += 1
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            pooled = self.__open.get(key, 0) < self.maxsize
+            if pooled:
+                self.__open[key] = self.__open.get(key, 0) + 1
+                self.created += 1
+            else:
+                self.overflow += 1
+        try:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(host, timeout=timeout, **conn_args)
+            else:
+                conn = httplib.HTTPConnection(host, timeout=timeout)
+        except Exception:
+            if pooled:
+                self.__closed(key)
+            raise
+        conn.pool_key = key if pooled else None
+        return conn, False
+
+    def put(self, conn):
+        """ give back a connection whose last response was read """
+        if conn.pool_key is None:
+            conn.close()  # overflow
+            return
+        with self.__mutex:
+            now = _time()
+            if now - self.__evicted_at > self.EVICT_INTERVAL:
+                self.__evict(now)
+            self.__idle.setdefault(conn.pool_key, deque()).append((now, conn))
+            if self.__sweeper is None:
+                self.__sweeper = threading.Thread(target=self.__sweep)
+                self.__sweeper.setDaemon(True)
+                self.__sweeper.start()
+
+    def discard(self, conn):
+        """ close a connection which may not be reused """
+        conn.close()
+        if conn.pool_key is not None:
+            self.__closed(conn.pool_key)
+
+    def request(self, scheme, host, method, url, body=None, headers=None, timeout=TIMEOUT,
+                **conn_args):
+        """
+        send a request on a pooled connection. When a reused one turns out
+        closed by the server meanwhile, the request is sent again on a new
+        one if it was not sent, or it is idempotent. Return the httplib
+        response, its connection is given back once it is read, closed or
+        garbage collected
+        """
+        while True:
+            conn, reused = self.get(scheme, host, timeout, **conn_args)
+            sent = False
+            try:
+                conn.request(method, url, body, headers or {})
+                sent = True
+                res = conn.getresponse(buffering=True)
+            except (httplib.HTTPException, socket.error):
+                self.discard(conn)
+                if reused and (not sent or method in self.IDEMPOTENT):
+                    continue
+                raise
+            if method == 'HEAD':
+                res.read()
+                self._call_by_resp_release(conn, res)
+                return res
+            return _PooledResponse(self, conn, res)
+
+    def _call_by_resp_release(self, conn, res):
+        if res.isclosed() and not res.will_close:
+            self.put(conn)
+        else:
+            res.close()
+            self.discard(conn)
+
+    def clear(self):
+        """ close the idle connections """
+        with self.__mutex:
+            idle, self.__idle = self.__idle, {}
+            for key, conns in idle.items():
+                self.__open[key] -= len(conns)
+        for conns in idle.values():
+            for idle_since, conn in conns:
+                conn.close()
+
+    def info(self):
+        with self.__mutex:
+            return {'open': sum(self.__open.values()),
+                    'idle': sum(len(conns) for conns in self.__idle.values()),
+                    'created': self.created, 'reused': self.reused,
+                    'overflow': self.overflow}
+
+    def __closed(self, key):
+        with self.__mutex:
+            self.__open[key] -= 1
+
+    def __sweep(self):
+        """ evict the idle connections until there is none """
+        while True:
+            _sleep(max(self.idle_timeout / 2.0, self.EVICT_INTERVAL))
+            with self.__mutex:
+                self.__evict(_time())
+                if not self.__idle:
+                    self.__sweeper = None
+                    return
+
+    def __evict(self, now):
+        # call with self.__mutex held
+        self.__evicted_at = now
+        for key, conns in self.__idle.items():
+            while conns and conns[0][0] + self.idle_timeout < now:
+                conns.popleft()[1].close()
+                self.__open[key] -= 1
+            if not conns:
+                del self.__idle[key]
+
+
+class _PooledResponse:
+    """
+    an httplib response whose connection goes back to the pool once the
+    body is read, or is closed when the response is closed or garbage
+    collected before
+    """
+    def __init__(self, pool, conn, res):
+        self.__pool = pool
+        self.__conn = conn
+        self.__res = res
+        self.status = res.status
+        self.reason = res.reason
+        self.msg = res.msg
+        self.getheader = res.getheader
+        self.getheaders = res.getheaders
+
+    def read(self, amt=None):
+        data = self.__res.read(amt)
+        if self.__res.isclosed():
+            self.close()
+        return data
+
+    recv = read  # for socket._fileobject
+
+    def isclosed(self):
+        return self.__conn is None
+
+    def close(self):
+        conn, self.__conn = self.__conn, None
+        if conn is not None:
+            self.__pool._call_by_resp_release(conn, self.__res)
+
+    __del__ = close
+
+
+# the pool shared by HttpUtil and HttpFetcher
+POOL = ConnectionPool()
+
+
+def _pooled_open(handler, req, scheme, **conn_args):
+    """ AbstractHTTPHandler.do_open() on a pooled keep-alive connection """
+    if req._tunnel_host:
+        # a CONNECT tunnel through a proxy is not pooled
+        http_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return handler.do_open(http_class, req, **conn_args)
+    host = req.get_host()
+    if not host:
+        raise urllib2.URLError('no host given')
+    headers = dict(req.unredirected_hdrs)
+    headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+    headers['Connection'] = 'keep-alive'
+    headers = dict((name.title(), val) for name, val in headers.items())
+    timeout = req.timeout
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    try:
+        r = handler.pool.request(scheme, host, req.get_method(), req.get_selector(),
+                                 req.data, headers, timeout, **conn_args)
+    except socket.error as err:
+        raise urllib2.URLError(err)
+    fp = socket._fileobject(r, close=True)
+    resp = urllib2.addinfourl(fp, r.msg, req.get_full_url())
+    resp.code = r.status
+    resp.msg = r.reason
+    return resp
+
+
+class PooledHTTPHandler(urllib2.HTTPHandler):
+    """ urllib2.HTTPHandler on the connections of POOL """
+    def __init__(self, debuglevel=0, pool=None):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool or POOL
+
+    def http_open(self, req):
+        return _pooled_open(self, req, 'http')
+
+
+class PooledHTTPSHandler(urllib2.HTTPSHandler):
+    """ urllib2.HTTPSHandler on the connections of POOL """
+    def __init__(self, debuglevel=0, context=None, pool=None):
+        urllib2.HTTPSHandler.__init__(self, debuglevel, context)
+        self.pool = pool or POOL
+
+    def https_open(self, req):
+        return _pooled_open(self, req, 'https', context=self._context)
+
+
 from util import SynFileContainer
 class HttpDownloadClipHandler(urllib2.BaseHandler):
     handler_order = 2046
@@ -356,6 +612,70 @@ def ttttt(n, test_urls, log):
         os.remove(md5)
         assert md5 == mm
 
+def serve_local(body='ok' * 512):
+    """
+    start a threaded HTTP/1.1 server on localhost answering `body` to any
+    GET, return it, its url is 'http://%s:%d/' % server.server_address
+    """
+    import BaseHTTPServer
+    import SocketServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        wbufsize = -1  # one send per response, flushed by handle_one_request()
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_HEAD = do_GET
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    th = threading.Thread(target=server.serve_forever)
+    th.setDaemon(True)
+    th.start()
+    return server
+
+
+def http_bench_pool(log, requests=2000, threads=4):
+    """ requests per second from `threads` clients on a local server, with and without POOL """
+    server = serve_local()
+    url = 'http://%s:%d/' % server.server_address
+
+    def run(pooled):
+        def client():
+            http = HttpUtil(pooled=pooled)
+            for i in range(requests // threads):
+                http.get(url)
+        ths = [threading.Thread(target=client) for i in range(threads)]
+        start_at = _time()
+        for th in ths:
+            th.start()
+        for th in ths:
+            th.join()
+        return requests / (_time() - start_at)
+
+    try:
+        plain = run(False)
+        pooled = run(True)
+        log.error('[http] %d GETs by %d threads: %.0f req/s without pool, %.0f req/s pooled (%s)',
+                  requests, threads, plain, pooled, POOL.info())
+    finally:
+        POOL.clear()
+        server.shutdown()
+        server.server_close()
+    return plain, pooled
+
+
 def main_test():
     import util
     test_urls = {
@@ -369,6 +689,7 @@ def main_test():
 
 if __name__ == "__main__":
     # main_test()
+    # import util; http_bench_pool(util.get_logger())
     http = HttpUtil()
     http.set_debug_level(1)
     http.get("http://www.baidu.com")
\ No newline at end of file
@@ -28,6 +28,16 @@ class Sqlite3Helper:
         finally:
             self.conn.rollback()
 
+    def execute_many(self, statements):
+        """ (sql, seq_of_parameters) pairs, committed as one transaction """
+        try:
+            for sql, seq_of_parameters in statements:
+                self.conn.executemany(sql, seq_of_parameters)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
     def fetch_one(self, sql, parameters=()):
         cursor = self.conn.cursor()
         try:
@@ -2,14 +2,24 @@
 # coding=utf-8
 
 import threading
+import logging
 import sys
+from collections import deque
 if sys.version >= '3':
-    from queue import Queue
+    from queue import Queue, PriorityQueue, Full
+    import pickle as _pickle
 else:
-    from Queue import Queue
-from random import randint
+    from Queue import Queue, PriorityQueue, Full
+    import cPickle as _pickle
+from random import randint, random as _random
+from itertools import count as _count
+from math import ceil as _ceil
+from heapq import heappush as _heappush, heappop as _heappop, heapify as _heapify
+from bisect import bisect_left as _bisect_left
 from time import sleep as _sleep, time as _time
-# from .util import Monitor as _Moniter
+from os.path import basename as _basename
+from concurrent import futures as _futures
+from multiprocessing import current_process as _mp_current_process
 
 # 0/1/2/3/4 = init/working/finish/cancel/error
 ST_INIT = 0
@@ -18,6 +28,98 @@ ST_FINISHED = 2
 ST_CANCEL = 3
 ST_ERROR = 4
 
+# priority of works and tasks, lower is served first, any int is allowed
+PRI_HIGH = 0
+PRI_NORMAL = 10
+PRI_LOW = 20
+# a queued work waiting longer than this (seconds) goes before newer works
+AGING = 5.0
+_INF = float('inf')
+
+# a failed run of a work which is retried, in WorkStats only
+_ST_RETRY = -1
+
+# upper bounds (seconds) of the Histogram buckets used by the metrics
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, _INF)
+
+# what a periodic Schedule does with the ticks it missed (timer thread late,
+# dispatcher full): run a work for each of them, or only one for all
+MISSED_CATCH_UP = 'catch_up'
+MISSED_SKIP = 'skip'
+
+# where WorkBase.work() runs, see WorkDispatcher
+BACKEND_THREAD = 'thread'
+BACKEND_PROCESS = 'process'
+BACKEND_BROKER = 'broker'  # worker processes of a brokerutil.WorkBroker
+
+# helpers for the futures returned by WorkDispatcher.addWork/WorkShop.addTask
+as_completed = _futures.as_completed
+wait = _futures.wait
+FIRST_COMPLETED = _futures.FIRST_COMPLETED
+FIRST_EXCEPTION = _futures.FIRST_EXCEPTION
+ALL_COMPLETED = _futures.ALL_COMPLETED
+CancelledError = _futures.CancelledError
+TimeoutError = _futures.TimeoutError
+
+
+class _StatusFuture(_futures.Future):
+    """ a Future driven by the ST_* status of its work or task """
+    def __init__(self):
+        _futures.Future.__init__(self)
+        self.__resolved = False
+
+    def _start(self):
+        """ set running, return False (and notify waiters) if it was canceled """
+        if self.running():
+            return True  # a retried work starts again
+        if self.set_running_or_notify_cancel():
+            return True
+        self.__resolved = True
+        return False
+
+    def _resolve(self, status, result=None, exception=None):
+        if self.__resolved:
+            return
+        self.__resolved = True
+        if not self.running():
+            # never started: pending, or canceled by the caller
+            self.cancel()
+            self.set_running_or_notify_cancel()
+        elif status == ST_FINISHED:
+            self.set_result(result)
+        elif status == ST_ERROR:
+            self.set_exception(exception)
+        else:
+            self.set_exception(CancelledError())
+
+
+class WorkFuture(_StatusFuture):
+    """ concurrent.futures.Future of a WorkBase, carries work() return value """
+    def __init__(self, work):
+        _StatusFuture.__init__(self)
+        self.work = work
+
+    def cancel(self):
+        if _futures.Future.cancel(self):
+            self.work.cancel()
+            return True
+        return False
+
+
+class TaskFuture(_StatusFuture):
+    """ concurrent.futures.Future of a TaskBase, result is a list of subwork results """
+    def __init__(self, task):
+        _StatusFuture.__init__(self)
+        self.task = task
+
+    def cancel(self):
+        if _futures.Future.cancel(self):
+            self.task.setToStop()
+            return True
+        return False
+
+
+
 class ThreadBase:
     def __init__(self, log=None):
         self._thread = threading.Thread(target=self.__run)
@@ -36,8 +138,8 @@ class ThreadBase:
             self.log = _get_logger()
 
     def start(self):
-        self._thread.start()
         self.__stop_ev.clear()
+        self._thread.start()
 
     def run(self):
         raise NotImplementedError()
@@ -46,7 +148,11 @@ class ThreadBase:
         return self.__running
 
     def isAlive(self):
-        return self.__running and self._thread.isAlive()
+        return self.__running and self._thread.is_alive()
+
+    def isStarted(self):
+        """ True once start() returned, even before run() is entered """
+        return self._thread.ident is not None
 
     def pause(self):
         self.__not_pause_ev.clear()
@@ -77,33 +183,83 @@ class ThreadBase:
             self.run()
         finally:
             self.__running = False
+            self._call_by_thread_exit()
+
+    def _call_by_thread_exit(self):
+        """ called in the thread, after run() returned or raised """
+        pass
 
 
 class ServeThreadBase(ThreadBase):
     def __init__(self, log=None):
         ThreadBase.__init__(self, log=log)
         self.__started = False  # set in self.run(), when service is available
-
-    def serve(self, timeout=None):
-        if not self.isAlive():
+        self.__exited = False
+        self.__ready = threading.Condition()
+
+    def serve(self, timeout=None, wait=True):
+        """ start the thread, block until it is available, stopped or exited """
+        if self.isSetStop():
+            return False
+        if not self._thread.is_alive() and not self.__exited:
             self.start()
-        if not timeout:
-            while not self.isAvailable() and not self.isSetStop():
-                pass
-            return self.isAvailable()
-        else:
-            while timeout  > 0 and not self.isSetStop():
-                if self.isAvailable():
-                    return True
-                timeout -= 0.5
-                _sleep(0.5)
-            return self.isAvailable()
+        if wait:
+            return self.waitForAvailable(timeout)
+        return self.isAvailable()
+
+    def waitForAvailable(self, timeout=None):
+        """ return isAvailable(), without polling when timeout is None """
+        end_at = _time() + timeout if timeout else None
+        with self.__ready:
+            while not self.__started and not self.isSetStop() and not self.__exited:
+                if end_at is None:
+                    self.__ready.wait()
+                elif end_at > _time():
+                    self.__ready.wait(end_at - _time())
+                else:
+                    break
+            return self.__started
 
     def isAvailable(self):
         return self.__started
 
+    def setToStop(self):
+        ThreadBase.setToStop(self)
+        with self.__ready:
+            self.__ready.notify_all()
+
     def _set_server_available(self, flag=True):
-        self.__started = flag
+        with self.__ready:
+            self.__started = flag
+            self.__ready.notify_all()
+
+    def _call_by_thread_exit(self):
+        with self.__ready:
+            self.__exited = True
+            self.__ready.notify_all()
+
+
+def serveAll(servers, timeout=None):
+    """
+    start many ServeThreadBase (WorkShop ..) and WorkDispatcher at once, then
+    wait for all of them: the startups overlap instead of running one by one.
+    return True when every server is available
+    """
+    end_at = _time() + timeout if timeout else None
+    waiting = []
+    for server in servers:
+        if isinstance(server, ServeThreadBase):
+            server.serve(wait=False)
+            waiting.append(server)
+        else:
+            server.serve()
+    available = True
+    for server in waiting:
+        if end_at is None:
+            available = server.waitForAvailable() and available
+        else:
+            available = server.waitForAvailable(max(end_at - _time(), 1e-6)) and available
+    return available
 
 
 class ThreadManager:
@@ -123,6 +279,10 @@ class ThreadManager:
         with self.__mutex:
             self.__threads.append(thread)
 
+    def removeThread(self, thread):
+        with self.__mutex:
+            self.__threads.remove(thread)
+
     def count(self):
         with self.__mutex:
             return len(self.__threads)
@@ -130,7 +290,7 @@ class ThreadManager:
     def startAll(self):
         with self.__mutex:
             for th in self.__threads:
-                if not th.isAlive():
+                if not th.isStarted():
                     th.start()
 
     def pauseAll(self):
@@ -144,7 +304,7 @@ class ThreadManager:
             for th in self.__threads:
                 if th.isPaused():
                     th.resume()
-                if not th.isAlive():
+                if not th.isStarted():
                     th.start()
 
     def stopAll(self):
@@ -175,9 +335,16 @@ class ThreadManager:
             if th.idel():
                 return th
 
+    def idleCount(self):
+        return len([th for th in self.__threads if th.idel()])
+
     def getThread(self, seq):
         return self.__threads[seq]
 
+    def threads(self):
+        with self.__mutex:
+            return list(self.__threads)
+
     def info(self):
         info = dict()
         for th in self.__threads:
@@ -189,13 +356,39 @@ class ThreadManager:
 
 
 class WorkBase:
-    def __init__(self, name='_work_', parent=None):
+    # None: run on the dispatcher's backend, or BACKEND_THREAD/PROCESS/BROKER
+    backend = None
+    # None, or a key (e.g. a host) of the WorkDispatcher.setLimit() limits
+    limit_key = None
+    # None, or a key (e.g. a file name): works of a key run one at a time, in order
+    lane_key = None
+    # None, or a key (e.g. an url): a work added while one of the same key is
+    # queued or running gets that one's outcome instead of running
+    dedup_key = None
+
+    def __init__(self, name='_work_', parent=None, priority=None, deadline=None, retry=None,
+                 timeout=None):
+        """
+        priority: PRI_*, None takes the task's priority, or PRI_NORMAL
+        deadline: time.time() after which the work is canceled instead of started
+        retry: RetryPolicy when work() raises, None takes the task's
+        timeout: seconds work() may run, then the work is set to stop and ends
+                 with ST_ERROR and a TimeoutError, see WorkDispatcher
+        """
         self.name = name
         self.parent = parent
+        self.priority = priority
+        self.deadline = deadline
+        self.retry = retry
+        self.timeout = timeout
+        self.__retries = 0
         self.__stop_ev = threading.Event()
         self.__stop_ev.clear()
         # 0/1/2/3/4 = init/working/finish/cancel/error
         self.__status = ST_INIT
+        self.__done_ev = threading.Event()
+        self.__future = None
+        self.__on_done = None
 
     def work(self, this_thread, log):
         raise NotImplementedError('WorkBase')
@@ -207,6 +400,15 @@ class WorkBase:
     def status(self):
         return self.__status
 
+    @property
+    def future(self):
+        return self.__future
+
+    @property
+    def retries(self):
+        """ times work() raised and was run again """
+        return self.__retries
+
     def isProcessing(self): # working or just initialised
         return self.__status < ST_FINISHED and not self.isSetStop()
 
@@ -224,102 +426,1374 @@ class WorkBase:
         return self.__stop_ev.isSet()
 
     def waitForStop(self, timeout=None):
-        while not timeout and self.__status < ST_FINISHED:
-            _sleep(0.5)
-            if timeout < 0:
-                raise RuntimeError('Work timeout')
-            timeout -= 0.5
+        if not self.__done_ev.wait(timeout):
+            raise RuntimeError('Work timeout')
 
-    def _call_by_work_thread_run(self, this_thread, log):
+    def _call_by_work_thread_run(self, this_thread, log, pool=None):
         self.__stop_ev.clear()
-        self.work(this_thread, log)
+        if pool:
+            result = pool.run(self)
+        else:
+            result = self.work(this_thread, log)
         self.__stop_ev.set()
+        return result
+
+    # the parent side state is not sent to a worker process
+    _LOCAL_ATTRS = ('parent', '_WorkBase__stop_ev', '_WorkBase__status', '_WorkBase__retries',
+                    '_WorkBase__done_ev', '_WorkBase__future', '_WorkBase__on_done')
+
+    def __getstate__(self):
+        return dict((k, v) for k, v in self.__dict__.items()
+                    if k not in WorkBase._LOCAL_ATTRS)
 
-    def _call_by_work_thread_set_status(self, status):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.parent = None
+        self.__stop_ev = threading.Event()
+        self.__status = ST_INIT
+        self.__retries = 0
+        self.__done_ev = threading.Event()
+        self.__future = None
+        self.__on_done = None
+
+    def _call_by_pool_restore(self, state):
+        """ take back the attributes set by work() in a worker process """
+        self.__dict__.update(state)
+
+    def _call_by_work_thread_set_status(self, status, result=None, exception=None):
+        """
+        return the status really set, ST_CANCEL if the future was canceled,
+        the final status if the work ended already (e.g. timed out)
+        """
+        if self.__status > ST_WORKING:
+            return self.__status
+        if status == ST_WORKING and self.__future and not self.__future._start():
+            status = ST_CANCEL
         self.__status = status
+        if status > ST_WORKING:
+            if self.__future:
+                self.__future._resolve(status, result, exception)
+            self.__done_ev.set()
+            if self.__on_done:
+                on_done, self.__on_done = self.__on_done, None
+                on_done(self)
+        return status
+
+    def _call_by_wd_future(self):
+        if self.__future is None:
+            self.__future = WorkFuture(self)
+        return self.__future
+
+    def _call_by_ws_on_done(self, callback):
+        """ callback(work) is called once, when work is finished/canceled/error """
+        self.__on_done = callback
+
+    def _call_by_wd_retried(self):
+        self.__retries += 1
+
+
+class _LiteDone:
+    """ one Condition shared by all LiteWorkBase.waitForStop() callers """
+    cond = threading.Condition()
+    waiters = 0
+
+
+class LiteWorkBase(object):
+    """
+    compact WorkBase for fan-outs of millions of small works: __slots__, no
+    per-instance Event, status and stop flag are plain fields, the future and
+    the done hook are kept only once a dispatcher asks for them, and
+    waitForStop() shares one Condition. Same API as WorkBase, subclasses
+    should declare __slots__ too.
+    """
+    __slots__ = ('name', 'parent', 'priority', 'deadline', 'retry', 'timeout',
+                 '_status', '_stop', '_extra')
+    backend = None
+    limit_key = None
+    lane_key = None
+    dedup_key = None
+
+    def __init__(self, name='_work_', parent=None, priority=None, deadline=None, retry=None,
+                 timeout=None):
+        self.name = name
+        self.parent = parent
+        self.priority = priority
+        self.deadline = deadline
+        self.retry = retry
+        self.timeout = timeout
+        self._status = ST_INIT
+        self._stop = False
+        self._extra = None  # [future, on_done, retries], see WorkBase
+
+    def work(self, this_thread, log):
+        raise NotImplementedError('LiteWorkBase')
+
+    def setParent(self, parent):
+        self.parent = parent
+
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def future(self):
+        return self._extra and self._extra[0]
+
+    @property
+    def retries(self):
+        return self._extra[2] if self._extra else 0
+
+    def isProcessing(self): # working or just initialised
+        return self._status < ST_FINISHED and not self._stop
+
+    def setToStop(self):
+        self._stop = True
+
+    def isSetStop(self):
+        return self._stop
+
+    def cancel(self):
+        self._stop = True
+
+    @property
+    def canceled(self):
+        return self._stop
+
+    def waitForStop(self, timeout=None):
+        end_at = None if timeout is None else _time() + timeout
+        with _LiteDone.cond:
+            _LiteDone.waiters += 1
+            try:
+                while self._status < ST_FINISHED:
+                    if end_at is None:
+                        _LiteDone.cond.wait()
+                    elif end_at > _time():
+                        _LiteDone.cond.wait(end_at - _time())
+                    else:
+                        raise RuntimeError('Work timeout')
+            finally:
+                _LiteDone.waiters -= 1
+
+    def _call_by_work_thread_run(self, this_thread, log, pool=None):
+        self._stop = False
+        if pool:
+            result = pool.run(self)
+        else:
+            result = self.work(this_thread, log)
+        self._stop = True
+        return result
+
+    def _call_by_work_thread_set_status(self, status, result=None, exception=None):
+        """ see WorkBase """
+        if self._status > ST_WORKING:
+            return self._status
+        extra = self._extra
+        future = extra and extra[0]
+        if status == ST_WORKING and future and not future._start():
+            status = ST_CANCEL
+        self._status = status
+        if status > ST_WORKING:
+            if future:
+                future._resolve(status, result, exception)
+            if _LiteDone.waiters:
+                with _LiteDone.cond:
+                    _LiteDone.cond.notify_all()
+            if extra and extra[1]:
+                on_done, extra[1] = extra[1], None
+                on_done(self)
+        return status
+
+    def _call_by_ws_on_done(self, callback):
+        if self._extra is None:
+            self._extra = [None, None, 0]
+        self._extra[1] = callback
+
+    def _call_by_wd_future(self):
+        if self._extra is None:
+            self._extra = [None, None, 0]
+        if self._extra[0] is None:
+            self._extra[0] = WorkFuture(self)
+        return self._extra[0]
+
+    def _call_by_wd_retried(self):
+        if self._extra is None:
+            self._extra = [None, None, 0]
+        self._extra[2] += 1
+
+    # the parent side state is not sent to a worker process
+    _LOCAL_ATTRS = ('parent', '_status', '_stop', '_extra')
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in type(self).__mro__:
+            slots = getattr(cls, '__slots__', ())
+            for k in (slots,) if isinstance(slots, str) else slots:
+                if k not in LiteWorkBase._LOCAL_ATTRS and hasattr(self, k):
+                    state[k] = getattr(self, k)
+        return state
+
+    def __setstate__(self, state):
+        LiteWorkBase.__init__(self)
+        self._call_by_pool_restore(state)
+
+    def _call_by_pool_restore(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+
+# the classes accepted as works by dispatchers and shops
+WORK_TYPES = (WorkBase, LiteWorkBase)
+
+
+class Capacity:
+    """
+    counts the items queued against an optional limit, and keeps the
+    high-water mark. acquire() raises Full when there is no room.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.high = 0
+        self.__cond = threading.Condition()
+
+    def acquire(self, block=True, timeout=None):
+        with self.__cond:
+            self.__wait_room(block, timeout)
+            self.used += 1
+            self.high = max(self.high, self.used)
+
+    def acquireMany(self, n, block=True, timeout=None):
+        """ wait for room like acquire(), take up to n items, return how many """
+        with self.__cond:
+            self.__wait_room(block, timeout)
+            if self.limit is not None:
+                n = min(n, self.limit - self.used)
+            self.used += n
+            self.high = max(self.high, self.used)
+            return n
+
+    def __wait_room(self, block, timeout):
+        if self.limit is not None and self.used >= self.limit:
+            if not block:
+                raise Full()
+            end_at = None if timeout is None else _time() + timeout
+            while self.used >= self.limit:
+                if end_at is None:
+                    self.__cond.wait()
+                    continue
+                remaining = end_at - _time()
+                if remaining <= 0:
+                    raise Full()
+                self.__cond.wait(remaining)
+
+    def take(self, n=1):
+        """ count n more items, even over the limit """
+        with self.__cond:
+            self.used += n
+            self.high = max(self.high, self.used)
+
+    def release(self, n=1):
+        if n > 0:
+            with self.__cond:
+                self.used -= n
+                self.__cond.notify(n)
+
+
+class Histogram:
+    """
+    counts of observed values per bucket (upper bounds, the last one _INF).
+    Not thread safe: each writer owns its histograms, readers merge them
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[_bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        return self
+
+    def quantile(self, q):
+        """ upper bound of the bucket holding the q-th value, None if empty """
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot(self):
+        cumulative, seen = [], 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            cumulative.append((bound, seen))
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99)}
+
+
+class WorkStats:
+    """
+    queue wait and per class run time and outcome counters of the works (or
+    tasks) one thread ended. Only that thread writes it, so there is no lock
+    """
+    _COLUMNS = {ST_FINISHED: 1, ST_ERROR: 2, ST_CANCEL: 3, _ST_RETRY: 4}
+
+    def __init__(self):
+        self.wait = Histogram()
+        self.classes = {}  # class name: [run Histogram, finished, error, cancel, retry]
+
+    def waited(self, seconds):
+        self.wait.observe(seconds)
+
+    def record(self, work, status, seconds=None):
+        name = work.__class__.__name__
+        entry = self.classes.get(name)
+        if entry is None:
+            entry = self.classes[name] = [Histogram(), 0, 0, 0, 0]
+        if seconds is not None:
+            entry[0].observe(seconds)
+        entry[WorkStats._COLUMNS.get(status, 3)] += 1
+
+    def merge(self, other):
+        self.wait.merge(other.wait)
+        for name, entry in list(other.classes.items()):
+            mine = self.classes.get(name)
+            if mine is None:
+                mine = self.classes[name] = [Histogram(), 0, 0, 0, 0]
+            mine[0].merge(entry[0])
+            for i in (1, 2, 3, 4):
+                mine[i] += entry[i]
+        return self
+
+    def snapshot(self, uptime):
+        classes, totals = {}, [0, 0, 0, 0]
+        for name, entry in self.classes.items():
+            classes[name] = {'run': entry[0].snapshot(), 'finished': entry[1],
+                             'error': entry[2], 'cancel': entry[3], 'retry': entry[4]}
+            for i in (0, 1, 2, 3):
+                totals[i] += entry[i + 1]
+        done = sum(totals[:3])
+        return {'wait': self.wait.snapshot(), 'classes': classes,
+                'finished': totals[0], 'error': totals[1], 'cancel': totals[2],
+                'retries': totals[3],
+                'throughput': totals[0] / uptime if uptime > 0 else 0.0,
+                'error_rate': float(totals[1]) / done if done else 0.0,
+                'cancel_rate': float(totals[2]) / done if done else 0.0}
+
+
+def _prom_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _prom_histogram(lines, name, hist, labels=''):
+    sep = ',' if labels else ''
+    for bound, n in hist['buckets']:
+        le = '+Inf' if bound == _INF else '%g' % bound
+        lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, le, n))
+    labels = '{%s}' % labels if labels else ''
+    lines.append('%s_sum%s %.6f' % (name, labels, hist['sum']))
+    lines.append('%s_count%s %d' % (name, labels, hist['count']))
+
+
+def _prom_stats(lines, prefix, stats, kind):
+    """ the WorkStats.snapshot() of works (kind='work') or tasks (kind='task') """
+    lines.append('# TYPE %s_%ss_total counter' % (prefix, kind))
+    for name, cls in sorted(stats['classes'].items()):
+        for status in ('finished', 'error', 'cancel'):
+            lines.append('%s_%ss_total{%s="%s",status="%s"} %d'
+                         % (prefix, kind, kind, _prom_label(name), status, cls[status]))
+    lines.append('# TYPE %s_%s_retries_total counter' % (prefix, kind))
+    for name, cls in sorted(stats['classes'].items()):
+        lines.append('%s_%s_retries_total{%s="%s"} %d'
+                     % (prefix, kind, kind, _prom_label(name), cls['retry']))
+    lines.append('# TYPE %s_%s_seconds histogram' % (prefix, kind))
+    for name, cls in sorted(stats['classes'].items()):
+        _prom_histogram(lines, '%s_%s_seconds' % (prefix, kind), cls['run'],
+                        '%s="%s"' % (kind, _prom_label(name)))
+
+
+def _prom_metrics(lines, prefix, metrics):
+    """ a WorkDispatcher.metrics() snapshot """
+    pool, works = metrics['pool'], metrics['works']
+    for name, kind, value in (('threads', 'gauge', pool['current']),
+                              ('threads_peak', 'gauge', pool['peak']),
+                              ('threads_retired_total', 'counter', pool['retired']),
+                              ('queued', 'gauge', pool['queued']),
+                              ('queued_peak', 'gauge', pool['queue_high']),
+                              ('retrying', 'gauge', metrics['retrying']),
+                              ('timeouts_total', 'counter', metrics['timeouts']),
+                              ('threads_replaced_total', 'counter', metrics['threads_replaced']),
+                              ('canceled_queued_total', 'counter', metrics['canceled_queued']),
+                              ('schedules', 'gauge', metrics['schedules']),
+                              ('dedup_flights', 'gauge', metrics['dedup']['flights']),
+                              ('dedup_attached', 'gauge', metrics['dedup']['attached']),
+                              ('deduped_total', 'counter', metrics['dedup']['deduped']),
+                              ('lanes', 'gauge', metrics['lanes']['active']),
+                              ('lane_waiting', 'gauge', metrics['lanes']['waiting']),
+                              ('missed_deadlines_total', 'counter', metrics['missed_deadlines']),
+                              ('uptime_seconds', 'gauge', metrics['uptime'])):
+        lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+        lines.append('%s_%s %s' % (prefix, name, value))
+    lines.append('# TYPE %s_thread_utilization gauge' % prefix)
+    for name, value in sorted(metrics['threads'].items()):
+        lines.append('%s_thread_utilization{thread="%s"} %.4f' % (prefix, _prom_label(name), value))
+    lines.append('# TYPE %s_queue_wait_seconds histogram' % prefix)
+    _prom_histogram(lines, '%s_queue_wait_seconds' % prefix, works['wait'])
+    _prom_stats(lines, prefix, works, 'work')
+    for name in ('running', 'parked'):
+        lines.append('# TYPE %s_key_%s gauge' % (prefix, name))
+        for key, limit in sorted(metrics['limits'].items()):
+            lines.append('%s_key_%s{key="%s"} %d' % (prefix, name, _prom_label(key), limit[name]))
+
+
+class WorkQueue:
+    """
+    blocking queue of works, private to a WorkerThread or shared by many.
+    Works are served by priority, then by earliest deadline, then FIFO. A work
+    which has waited more than `aging` seconds is served first, so that low
+    priority works are not starved.
+    capacity: the Capacity the producer acquired for each work, released
+    when the work leaves the queue
+    """
+    def __init__(self, aging=AGING, capacity=None):
+        self.cond = threading.Condition()
+        self.aging = aging
+        self.capacity = capacity
+        self.missed = 0  # works canceled because their deadline passed
+        self.last_queued_at = None  # put() time of the work get() returned last
+        self.__heap = []
+        self.__fifo = deque()
+        self.__seq = _count()
+        self.__size = 0
+
+    def put(self, work):
+        priority = PRI_NORMAL if work.priority is None else work.priority
+        deadline = _INF if work.deadline is None else work.deadline
+        with self.cond:
+            # [priority, deadline, seq, queued_at, work], work is None once taken
+            entry = [priority, deadline, next(self.__seq), _time(), work]
+            _heappush(self.__heap, entry)
+            self.__fifo.append(entry)
+            self.__size += 1
+            self.cond.notify()
+
+    def putMany(self, works):
+        """ put() for a batch, under one lock, waking up at most len(works) threads """
+        queued_at = _time()
+        with self.cond:
+            seq, heap = self.__seq, self.__heap
+            entries = [[PRI_NORMAL if work.priority is None else work.priority,
+                        _INF if work.deadline is None else work.deadline,
+                        next(seq), queued_at, work] for work in works]
+            if len(entries) > len(heap):
+                heap.extend(entries)
+                _heapify(heap)
+            else:
+                for entry in entries:
+                    _heappush(heap, entry)
+            self.__fifo.extend(entries)
+            self.__size += len(works)
+            self.cond.notify(len(works))
+
+    def get(self):
+        """ call with self.cond held """
+        fifo, heap = self.__fifo, self.__heap
+        while fifo[0][-1] is None:
+            fifo.popleft()
+        if fifo[0][3] + self.aging < _time():
+            entry = fifo.popleft()
+        else:
+            while heap[0][-1] is None:
+                _heappop(heap)
+            entry = _heappop(heap)
+        work, entry[-1] = entry[-1], None
+        self.last_queued_at = entry[3]
+        self.__size -= 1
+        if self.capacity:
+            self.capacity.release()
+        if len(heap) > 2 * self.__size + 64:
+            self.__heap = [e for e in heap if e[-1] is not None]
+            _heapify(self.__heap)
+        return work
+
+    def expired(self, work):
+        """ True if work missed its deadline, it is counted in self.missed """
+        if work.deadline is None or work.deadline >= _time():
+            return False
+        with self.cond:
+            self.missed += 1
+        return True
+
+    def empty(self):
+        return self.__size == 0
+
+    def size(self):
+        return self.__size
+
+    def drain(self):
+        """ take all the works out in serving order, their capacity stays acquired """
+        with self.cond:
+            works = [e[-1] for e in sorted(self.__heap) if e[-1] is not None]
+            self.__heap, self.__fifo, self.__size = [], deque(), 0
+        return works
+
+    def remove(self, works):
+        """ take the works of the set `works` out, return them, their capacity is released """
+        removed = []
+        with self.cond:
+            for entry in self.__heap:
+                if entry[-1] is not None and entry[-1] in works:
+                    removed.append(entry[-1])
+                    entry[-1] = None
+            if removed:
+                self.__size -= len(removed)
+                self.__heap = [e for e in self.__heap if e[-1] is not None]
+                _heapify(self.__heap)
+                self.__fifo = deque(e for e in self.__fifo if e[-1] is not None)
+        if removed and self.capacity:
+            self.capacity.release(len(removed))
+        return removed
+
+    def clear(self, status=ST_CANCEL):
+        with self.cond:
+            works = [e[-1] for e in self.__heap if e[-1] is not None]
+            self.__heap, self.__fifo, self.__size = [], deque(), 0
+        if self.capacity:
+            self.capacity.release(len(works))
+        for work in works:
+            work._call_by_work_thread_set_status(status)
+
+
+class _ProcessThread:
+    """ stands for this_thread of a work running in a worker process """
+    def getName(self):
+        return _mp_current_process().name
+
+    def isSetStop(self):
+        return False
+
+
+def _process_run(work):
+    """ called in a worker process of ProcessPool """
+    result = work.work(_ProcessThread(), logging.getLogger())
+    return result, work.__getstate__()
+
+
+class ProcessPool:
+    """
+    runs picklable works in worker processes. A WorkerThread hands the work
+    over and waits for it, so the work keeps its status transitions, and its
+    return value, exception and attributes come back to the parent process.
+    """
+    CANCEL_CHECK_INTERVAL = 0.1
+
+    def __init__(self, processes=None):
+        self.processes = processes
+        self.__executor = None
+        self.__mutex = threading.Lock()
+
+    def run(self, work):
+        with self.__mutex:
+            if self.__executor is None:
+                self.__executor = _futures.ProcessPoolExecutor(self.processes)
+            future = self.__executor.submit(_process_run, work)
+        while not future.done():
+            if work.isSetStop():
+                # only works still waiting in the pool can be canceled
+                future.cancel()
+            _futures.wait([future], timeout=ProcessPool.CANCEL_CHECK_INTERVAL)
+        result, state = future.result()
+        work._call_by_pool_restore(state)
+        return result
+
+    def shutdown(self, wait=True):
+        with self.__mutex:
+            executor, self.__executor = self.__executor, None
+        if executor:
+            executor.shutdown(wait)
+
+
+class QueuePolicy:
+    """
+    sizes an elastic WorkDispatcher from the observed queue depth and work
+    latency: enough threads to start each queued work within `target_wait`
+    seconds, on top of the busy ones
+    """
+    def __init__(self, target_wait=0.1):
+        self.target_wait = target_wait
+
+    def size(self, busy, queued, latency):
+        if latency is None:
+            return busy + queued
+        return busy + int(_ceil(queued * latency / self.target_wait))
+
+
+class DelayQueue(ServeThreadBase):
+    """
+    calls func(*args) in its own thread once `delay` seconds passed. The
+    entries are kept in a heap, canceled ones are dropped when they come
+    first or when they are most of the heap
+    """
+    def __init__(self, log=None):
+        ServeThreadBase.__init__(self, log=log)
+        self.setDaemon(True)
+        self.__cond = threading.Condition()
+        self.__heap = []
+        self.__seq = _count()
+        self.__canceled = 0
+
+    def put(self, delay, func, *args):
+        """ return an entry for cancel() """
+        return self.putAt(_time() + delay, func, *args)
+
+    def putAt(self, when, func, *args):
+        """ as put(), at time.time() `when` """
+        entry = [when, next(self.__seq), func, args]
+        with self.__cond:
+            _heappush(self.__heap, entry)
+            if self.__heap[0] is entry:
+                self.__cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        """ no-op for an entry fired or canceled already """
+        with self.__cond:
+            if entry[2] is None:
+                return
+            entry[2] = None
+            self.__canceled += 1
+            if self.__canceled > 64 and self.__canceled * 2 > len(self.__heap):
+                self.__heap = [e for e in self.__heap if e[2] is not None]
+                _heapify(self.__heap)
+                self.__canceled = 0
+
+    def size(self):
+        return len(self.__heap) - self.__canceled
+
+    def setToStop(self):
+        with self.__cond:
+            ServeThreadBase.setToStop(self)
+            self.__cond.notify()
+
+    def run(self):
+        self._set_server_available()
+        while True:
+            with self.__cond:
+                while not self.isSetStop():
+                    if not self.__heap:
+                        self.__cond.wait()
+                    elif self.__heap[0][2] is None:
+                        _heappop(self.__heap)
+                        self.__canceled -= 1
+                    elif self.__heap[0][0] > _time():
+                        self.__cond.wait(self.__heap[0][0] - _time())
+                    else:
+                        break
+                else:
+                    break
+                entry = _heappop(self.__heap)
+                func, args = entry[2], entry[3]
+                entry[2] = None  # fired: cancel() is a no-op now
+            try:
+                func(*args)
+            except Exception as e:
+                self.log.exception(e)
+        self._set_server_available(False)
+
+
+class WorkProfiler(ServeThreadBase):
+    """
+    samples the stacks of the threads of a WorkDispatcher every `interval`
+    seconds while they are in work(), and counts them by task (the work's
+    parent), work class and stack. trace: also keep the last `max_samples`
+    timed samples for chromeTrace(). Started and stopped on a live
+    dispatcher by WorkDispatcher.startProfiler/stopProfiler.
+    A sample costs ~13us per busy thread on python3 (see sample_time), and
+    at the default 100 samples/s the throughput of busy threads does not
+    change measurably (wd_bench_profiler). The sampler needs the GIL, with
+    CPU-bound works it gets fewer samples than asked for
+    """
+    def __init__(self, threads, interval=0.01, trace=False, max_samples=100000, log=None):
+        """ threads: callable returning the WorkerThreads to sample """
+        ServeThreadBase.__init__(self, log=log)
+        self.setDaemon(True)
+        self.interval = interval
+        self.samples = 0
+        self.sample_time = 0.0  # seconds spent sampling
+        self.started_at = None
+        self.__threads = threads
+        self.__wake = threading.Event()
+        self.__mutex = threading.Lock()
+        self.__stacks = {}  # (task name, work class name, frames): samples
+        # (sample number, time, thread name, task name, work class name, frames)
+        self.__trace = deque(maxlen=max_samples) if trace else None
+
+    def setToStop(self):
+        ServeThreadBase.setToStop(self)
+        self.__wake.set()
+
+    def run(self):
+        self.started_at = next_at = _time()
+        self._set_server_available()
+        while not self.isSetStop():
+            self.__sample()
+            next_at = max(next_at + self.interval, _time())
+            self.__wake.wait(next_at - _time())
+        self._set_server_available(False)
+
+    def __sample(self):
+        start_at = _time()
+        frames = sys._current_frames()
+        for th in self.__threads():
+            work = th.currWork
+            frame = frames.get(th._thread.ident)
+            if work is None or frame is None:
+                continue
+            stack = WorkProfiler.__walk(frame)
+            if stack is None:
+                continue  # not in work()
+            task = work.parent.name if isinstance(work.parent, TaskBase) else '-'
+            key = (task, work.__class__.__name__, stack)
+            with self.__mutex:
+                self.__stacks[key] = self.__stacks.get(key, 0) + 1
+                if self.__trace is not None:
+                    self.__trace.append((self.samples, start_at, th.getName()) + key)
+        self.samples += 1
+        self.sample_time += _time() - start_at
+
+    @staticmethod
+    def __walk(frame):
+        """ the frames under _call_by_work_thread_run, outermost first """
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            if code in _WORK_RUN_CODES:
+                names.reverse()
+                return tuple(names)
+            names.append('%s (%s)' % (code.co_name, _basename(code.co_filename)))
+            frame = frame.f_back
+        return None
+
+    def byWork(self):
+        """ samples per work class """
+        return self.__count(1)
+
+    def byTask(self):
+        """ samples per task name, '-' for the works added without a task """
+        return self.__count(0)
+
+    def __count(self, column):
+        counts = {}
+        with self.__mutex:
+            for key, n in self.__stacks.items():
+                counts[key[column]] = counts.get(key[column], 0) + n
+        return counts
+
+    def collapsed(self, by_task=True):
+        """
+        the collapsed-stack text of flamegraph.pl and speedscope: one line of
+        `[task;]work class;frame;... samples` per stack
+        """
+        with self.__mutex:
+            items = list(self.__stacks.items())
+        counts = {}
+        for (task, cls, stack), n in items:
+            frames = ((task,) if by_task else ()) + (cls,) + stack
+            line = ';'.join(frame.replace(';', ':') for frame in frames)
+            counts[line] = counts.get(line, 0) + n
+        return ''.join('%s %d\n' % item for item in sorted(counts.items()))
+
+    def chromeTrace(self):
+        """
+        the timed samples (trace=True) as a Chrome trace-event dict, for
+        chrome://tracing or Perfetto once json.dump-ed: a slice per frame
+        for as long as consecutive samples of a thread share it
+        """
+        with self.__mutex:
+            samples = list(self.__trace or ())
+        events, tids, open_by_thread = [], {}, {}
+        base = self.started_at or 0
+
+        def close(opened, depth, end_at, tid):
+            while len(opened) > depth:
+                name, start_at = opened.pop()
+                events.append({'name': name, 'ph': 'X', 'pid': 1, 'tid': tid,
+                               'ts': int((start_at - base) * 1e6),
+                               'dur': max(1, int((end_at - start_at) * 1e6))})
+
+        last_at, last_sample = {}, {}
+        for sample, at, thread, task, cls, stack in samples:
+            if thread not in tids:
+                tids[thread] = len(tids) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                               'tid': tids[thread], 'args': {'name': thread}})
+            tid, opened = tids[thread], open_by_thread.setdefault(thread, [])
+            if thread in last_at and sample != last_sample[thread] + 1:
+                close(opened, 0, last_at[thread] + self.interval, tid)  # idle meanwhile
+            frames = (task, cls) + stack
+            same = 0
+            while same < len(opened) and same < len(frames) and opened[same][0] == frames[same]:
+                same += 1
+            close(opened, same, at, tid)
+            opened.extend((name, at) for name in frames[same:])
+            last_at[thread], last_sample[thread] = at, sample
+        for thread, opened in open_by_thread.items():
+            close(opened, 0, last_at[thread] + self.interval, tids[thread])
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+class _KeyState:
+    def __init__(self):
+        self.limit = None     # max works running at the same time
+        self.rate = None      # works started per second
+        self.burst = 1
+        self.tokens = 0.0
+        self.stamp = _time()  # last refill of tokens
+        self.running = 0
+        self.parked = deque()
+        self.admitted = set() # taken off parked, counted as running already
+        self.timer = None     # DelayQueue entry waking up the parked works
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def mayStart(self):
+        return (self.limit is None or self.running < self.limit) \
+               and (self.rate is None or self.tokens >= 1)
+
+    def start(self):
+        self.running += 1
+        if self.rate is not None:
+            self.tokens -= 1
+
+
+class KeyLimiter:
+    """
+    per key caps of running works and token-bucket start rates, for works
+    whose limit_key is set. A work which may not start yet is parked here
+    instead of in a thread, then handed to `release(works)` as soon as it may
+    """
+    def __init__(self, release, delays):
+        self.__mutex = threading.Lock()
+        self.__keys = {}
+        self.__release = release
+        self.__delays = delays  # DelayQueue, waits for tokens
+
+    def setLimit(self, key, concurrency=None, rate=None, burst=None):
+        """ None removes a limit, burst: tokens saved up, default max(1, rate) """
+        with self.__mutex:
+            st = self.__keys.setdefault(key, _KeyState())
+            st.refill(_time())
+            st.limit, st.rate = concurrency, rate
+            if rate is not None:
+                st.burst = burst or max(1, rate)
+                if st.timer is None and not st.parked:
+                    st.tokens = st.burst
+            ready = self.__ready(st)
+        if ready:
+            self.__release(ready)
+
+    def admit(self, work):
+        """ True if work may start, else it is parked """
+        st = self.__keys.get(work.limit_key)
+        if st is None:
+            return True
+        with self.__mutex:
+            if work in st.admitted:
+                st.admitted.remove(work)
+                return True
+            st.refill(_time())
+            if not st.parked and st.mayStart():
+                st.start()
+                return True
+            st.parked.append(work)
+            self.__wait_tokens(work.limit_key, st)
+            return False
+
+    def done(self, work):
+        """ an admitted work ended """
+        st = self.__keys.get(work.limit_key)
+        if st is None:
+            return
+        with self.__mutex:
+            st.running -= 1
+            ready = self.__ready(st)
+        if ready:
+            self.__release(ready)
+
+    def parked(self):
+        return sum(len(st.parked) for st in list(self.__keys.values()))
+
+    def info(self):
+        with self.__mutex:
+            return dict((key, {'running': st.running, 'parked': len(st.parked),
+                               'concurrency': st.limit, 'rate': st.rate,
+                               'tokens': st.tokens})
+                        for key, st in self.__keys.items())
+
+    def cancel(self, works, dequeued=()):
+        """
+        take the parked works of the set `works` out and return them. The
+        admitted ones in `dequeued`, taken out of the queues, give back their start
+        """
+        parked, ready = [], []
+        with self.__mutex:
+            for key in set(work.limit_key for work in works if work.limit_key is not None):
+                st = self.__keys.get(key)
+                if st is None:
+                    continue
+                parked.extend(work for work in st.parked if work in works)
+                st.parked = deque(work for work in st.parked if work not in works)
+                for work in dequeued:
+                    if work in st.admitted:
+                        st.admitted.remove(work)
+                        st.running -= 1
+                ready.extend(self.__ready(st))
+        if ready:
+            self.__release(ready)
+        return parked
+
+    def clear(self, status=ST_CANCEL):
+        """ end the parked works with status """
+        works = []
+        with self.__mutex:
+            for st in self.__keys.values():
+                works.extend(st.parked)
+                st.parked = deque()
+                if st.timer is not None:
+                    self.__delays.cancel(st.timer)
+                    st.timer = None
+        for work in works:
+            work._call_by_work_thread_set_status(status)
+
+    def __ready(self, st):
+        """ call with self.__mutex held, take the parked works which may start """
+        ready = []
+        st.refill(_time())
+        while st.parked and st.mayStart():
+            st.start()
+            work = st.parked.popleft()
+            st.admitted.add(work)
+            ready.append(work)
+        return ready
+
+    def __wait_tokens(self, key, st):
+        # call with self.__mutex held
+        if st.timer is None and st.rate is not None and st.tokens < 1 \
+                and (st.limit is None or st.running < st.limit):
+            st.timer = self.__delays.put((1 - st.tokens) / st.rate, self.__wake, key)
+
+    def __wake(self, key):
+        st = self.__keys[key]
+        with self.__mutex:
+            st.timer = None
+            ready = self.__ready(st)
+            if st.parked:
+                self.__wait_tokens(key, st)
+        if ready:
+            self.__release(ready)
+
+
+class RetryPolicy:
+    """
+    runs a work again when work() raised one of `retry_on`, `attempts` runs
+    at most. Retry n waits backoff * factor ** (n - 1) seconds (at most
+    max_backoff), less a random share of up to `jitter` of it, in the
+    dispatcher's DelayQueue, not in a thread
+    """
+    def __init__(self, attempts=3, backoff=0.1, factor=2.0, max_backoff=30.0, jitter=0.5,
+                 retry_on=(Exception,)):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = retry_on
+
+    def shouldRetry(self, retries, exception):
+        """ retries: how many times the work was run again already """
+        return retries + 1 < self.attempts and isinstance(exception, self.retry_on)
+
+    def delay(self, retry):
+        delay = min(self.max_backoff, self.backoff * self.factor ** (retry - 1))
+        return delay * (1 - self.jitter * _random())
+
+
+class Schedule:
+    """
+    a work scheduled by WorkDispatcher.scheduleAt/scheduleAfter, or the works
+    of factory() scheduled every `interval` seconds by scheduleEvery.
+    future: the future of the one-shot work, None for a periodic schedule
+    runs/skipped: works released, ticks dropped under MISSED_SKIP
+    """
+    def __init__(self, factory, due_at, interval=None, missed=MISSED_SKIP, future=None):
+        self.factory = factory
+        self.due_at = due_at
+        self.interval = interval
+        self.missed = missed
+        self.future = future
+        self.runs = 0
+        self.skipped = 0
+        self.canceled = False
+        self.entry = None  # DelayQueue entry of the next tick
+        self.owner = None
+
+    def cancel(self):
+        """ no more works are released, a one-shot work is canceled """
+        if self.owner is not None:
+            self.owner.cancelSchedule(self)
+
+    def _call_by_wd_tick(self, now):
+        """ return how many works to release now, move due_at to the next tick """
+        if self.interval is None:
+            self.runs = 1
+            return 1
+        ticks = int((now - self.due_at) / self.interval) + 1
+        self.due_at += ticks * self.interval
+        if self.missed == MISSED_SKIP:
+            self.skipped += ticks - 1
+            ticks = 1
+        self.runs += ticks
+        return ticks
+
+
+# the frame a work's stack starts under, see WorkProfiler
+_WORK_RUN_CODES = frozenset(cls.__dict__['_call_by_work_thread_run'].__code__
+                            for cls in WORK_TYPES)
+
+_worker = threading.local()  # .thread: the WorkerThread running in this thread
 
 
 class WorkerThread(ServeThreadBase):
-    def __init__(self, standalone=None, log=None):
+    def __init__(self, standalone=None, work_queue=None, backend=BACKEND_THREAD,
+                 process_pool=None, aging=AGING, capacity=None, owner=None, log=None,
+                 broker_pool=None):
+        """ owner: the WorkDispatcher which decides when this thread retires """
         ServeThreadBase.__init__(self, log=log)
-        self.__wk_qu = Queue()
-        self.__ev = threading.Event()
+        self.__owner = owner
+        self.__backend = backend
+        self.__pool = process_pool
+        self.__broker = broker_pool
+        self.__shared = work_queue is not None
+        self.__wk_qu = work_queue if self.__shared else WorkQueue(aging, capacity)
+        self.__cond = self.__wk_qu.cond
         self.__curr_wk = None
         self.__busy = False
         self.__standalone = standalone
+        self.__queued_at = None
+        self.__stats = WorkStats()
+        self.__started_at = None   # run() start
+        self.__working_at = None   # start of the current work()
+        self.__busy_time = 0.0     # seconds spent in work()
 
     def add_work(self, work):
-        assert isinstance(work, WorkBase)
+        assert isinstance(work, WORK_TYPES)
         self.__wk_qu.put(work)
-        self.__ev.set()
+
+    def add_works(self, works):
+        self.__wk_qu.putMany(works)
 
     def idel(self):
-        return self.isAvailable() and self.__wk_qu.empty() and not self.__busy
+        if self.__shared:
+            return self.isAvailable() and not self.__busy
+        return self.isAvailable() and not self.__busy and self.__wk_qu.empty()
 
     def size(self):
-        return self.__wk_qu.qsize()
+        return self.__wk_qu.size()
+
+    def missedDeadlines(self):
+        return 0 if self.__shared else self.__wk_qu.missed
+
+    @property
+    def stats(self):
+        return self.__stats
+
+    def utilization(self):
+        """ share of the time since run() started spent in work() """
+        started_at, working_at, now = self.__started_at, self.__working_at, _time()
+        if started_at is None or now <= started_at:
+            return 0.0
+        busy = self.__busy_time + (now - working_at if working_at else 0)
+        return min(1.0, busy / (now - started_at))
 
     @property
     def isStandalone(self):
         return self.__standalone
 
+    @property
+    def currWork(self):
+        """ the work taken from the queue last, None when idle """
+        return self.__curr_wk
+
+    def _call_by_wd_remove(self, works):
+        """ take the works of the set `works` out of the private queue """
+        return [] if self.__shared else self.__wk_qu.remove(works)
+
+    def _call_by_wd_abandon(self):
+        """ hung in a work: take no more works, return the queued ones """
+        self.setToStop()
+        return [] if self.__shared else self.__wk_qu.drain()
+
+    def resume(self):
+        with self.__cond:
+            ServeThreadBase.resume(self)
+            self.__cond.notify_all()
+
     def setToStop(self):
-        ThreadBase.setToStop(self)
+        with self.__cond:
+            ServeThreadBase.setToStop(self)
+            self.__cond.notify_all()
         if self.__curr_wk:
             self.__curr_wk.setToStop()
 
+    def __may_retire(self):
+        return not self.__standalone and self.__owner is not None \
+               and self.__owner._call_by_work_thread_may_retire()
+
+    def __next_work(self):
+        """
+        block until a work is available, return None when set to stop, or
+        when the owner lets this thread retire after it idled long enough
+        """
+        while True:
+            with self.__cond:
+                idle_since = _time()
+                while not self.isSetStop() and (self.isPaused() or self.__wk_qu.empty()):
+                    if self.isPaused() or not self.__may_retire():
+                        self.__cond.wait()
+                        continue
+                    timeout = idle_since + self.__owner.idle_timeout - _time()
+                    if timeout <= 0:
+                        break
+                    self.__cond.wait(timeout)
+                else:
+                    if self.isSetStop():
+                        return None
+                    self.__busy = True
+                    self.__curr_wk = self.__wk_qu.get()
+                    self.__queued_at = self.__wk_qu.last_queued_at
+                    return self.__curr_wk
+            if self.__owner._call_by_work_thread_retire(self):
+                return None
+
     def run(self):
+        self.__started_at = _time()
+        _worker.thread = self
         self._set_server_available()
-        while not self.isSetStop():
-            if not self.waitForResume(1):
-                continue
-            if not self.__ev.wait(1):
-                continue
-            if self.__wk_qu.empty():
-                self.__ev.clear()
-                continue
-            self.__curr_wk = self.__wk_qu.get()
+        while True:
+            wk = self.__next_work()
+            if wk is None:
+                break
+            status, seconds, admitted = ST_CANCEL, None, False
             try:
-                if self.__curr_wk.canceled:
+                waited = _time() - self.__queued_at
+                if wk.limit_key is not None and self.__owner:
+                    if not self.__owner._call_by_work_thread_admit(wk):
+                        status = None  # parked by the owner, comes back later
+                        continue
+                    admitted = True
+                if wk.canceled:
                     self.log.debug('[wkth] canceled a work')
+                    wk._call_by_work_thread_set_status(ST_CANCEL)
                     continue
-                if self.__curr_wk:
-                    self.__curr_wk._call_by_work_thread_set_status(ST_WORKING)
-                    self.__busy = True
-                    self.__curr_wk._call_by_work_thread_run(this_thread=self, log=self.log)
-                    self.__busy = False
-                    self.__curr_wk._call_by_work_thread_set_status(ST_FINISHED)
-                    self.__curr_wk = None
+                if self.__wk_qu.expired(wk):
+                    self.log.debug('[wkth] a work missed its deadline: %s', wk.name)
+                    wk._call_by_work_thread_set_status(ST_CANCEL)
+                    continue
+                if wk._call_by_work_thread_set_status(ST_WORKING) != ST_WORKING:
+                    self.log.debug('[wkth] canceled a work')
+                    continue
+                pool = None
+                backend = wk.backend or self.__backend
+                if backend == BACKEND_PROCESS:
+                    pool = self.__pool
+                elif backend == BACKEND_BROKER:
+                    pool = self.__broker
+                watch = None
+                if wk.timeout is not None and self.__owner:
+                    watch = self.__owner._call_by_work_thread_watch(self, wk)
+                self.__working_at = start_at = _time()
+                try:
+                    result = wk._call_by_work_thread_run(this_thread=self, log=self.log, pool=pool)
+                finally:
+                    seconds = _time() - start_at
+                    self.__busy_time += seconds
+                    self.__working_at = None
+                    if self.__owner:
+                        self.__owner._call_by_work_thread_done(seconds, watch)
+                # ST_ERROR if it timed out meanwhile
+                status = wk._call_by_work_thread_set_status(ST_FINISHED, result=result)
+            except CancelledError:
+                self.log.debug('[wkth] canceled a work')
+                status = wk._call_by_work_thread_set_status(ST_CANCEL)
             except Exception as e:
-                self.log.exception(e)
-                self.__curr_wk._call_by_work_thread_set_status(ST_ERROR)
+                if self.__owner and self.__owner._call_by_work_thread_retry(wk, e):
+                    self.log.debug('[wkth] retry a work: %s, %r', wk.name, e)
+                    status = _ST_RETRY
+                else:
+                    self.log.exception(e)
+                    status = wk._call_by_work_thread_set_status(ST_ERROR, exception=e)
             finally:
-                if self.__standalone and self.__wk_qu.empty():
+                if admitted:
+                    self.__owner._call_by_work_thread_end(wk)
+                if status is not None:
+                    self.__stats.waited(waited)
+                    self.__stats.record(wk, status, seconds)
+                    if status != _ST_RETRY and self.__owner:
+                        if wk.dedup_key is not None:
+                            self.__owner._call_by_work_thread_flight_done(wk, status)
+                        if wk.lane_key is not None:
+                            self.__owner._call_by_work_thread_lane_done(wk)
+                with self.__cond:
+                    self.__busy = False
+                    self.__curr_wk = None
+                    done = self.__standalone and self.__wk_qu.empty()
+                if done:
                     break
 
         self._set_server_available(False)
-        while not self.__wk_qu.empty():
-            wk = self.__wk_qu.get()
-            wk._call_by_work_thread_set_status(ST_CANCEL)
+        if not self.__shared:
+            self.__wk_qu.clear(ST_CANCEL)
         # self.log.debug('%s, stop', self.getName())
 
 
 class WorkDispatcher:
-    def __init__(self, tmin, tmax, standalone_works=None, log=None):
+    """
+    shared_queue=False: a work goes to an idle thread, or to a random busy
+                        thread's own queue when all of them are busy
+    shared_queue=True:  all threads pop from one run queue, so the next work
+                        is picked up by whichever thread gets free first
+    backend=BACKEND_PROCESS: works run in a pool of worker processes (at most
+                        `processes`, default cpu count), a thread waits for
+                        each of them, so tmax bounds the works in flight.
+                        WorkBase.backend overrides it per work
+    backend=BACKEND_BROKER: the same with the worker processes of the
+                        brokerutil.WorkBroker at `broker` (ip, port)
+    queues serve works by priority then deadline, see WorkQueue for `aging`
+    elastic pool: threads above tmin retire after `idle_timeout` seconds idle
+                        (None: never), but not within idle_timeout after the
+                        pool grew. `policy` (e.g. QueuePolicy) may size the
+                        pool from queue depth and work latency instead
+    capacity: max works queued in the dispatcher (None: unbounded), addWork
+                        blocks, times out or raises Full, see tryAddWork
+    metrics() and metricsText() report queue wait, run time, outcomes and
+                        utilization, counted by each thread without locking
+    setLimit(): per WorkBase.limit_key caps of running works and start rates,
+                        works over a limit are parked without holding a thread
+    a work whose work() raised is queued again after a backoff if its
+                        RetryPolicy says so, until then it stays ST_WORKING
+    startProfiler/stopProfiler(): sample the stacks of the threads, see WorkProfiler
+    WorkBase.timeout: the DelayQueue thread is the watchdog, a work still in
+                        work() then is set to stop and ended with ST_ERROR and
+                        a TimeoutError at once. If work() has not returned
+                        `timeout_grace` seconds later, its thread is left to
+                        it and replaced, its queued works move to the new one.
+                        Lanes, limits and dedup are released when work()
+                        returns
+    scheduleAt/scheduleAfter/scheduleEvery(): works released later or
+                        periodically by the one DelayQueue timer thread
+    works with the same WorkBase.lane_key run one at a time in the order they
+                        were added, the next one waits out of the queues
+                        (holding its capacity) until the previous one is done.
+                        Standalone works have no lanes
+    a work added while one with the same WorkBase.dedup_key is queued or
+                        running is not queued, it gets that one's result,
+                        error or cancel when it is done. memo_ttl: seconds a
+                        result is also given to the works added after it
+    WorkShop cancels the subworks of a failed task in one step, see
+                        _call_by_ws_cancel, counted in metrics() 'canceled_queued'
+    """
+    POOL_HISTORY = 256  # (time, size) samples of the pool kept for metrics()
+
+    def __init__(self, tmin, tmax, standalone_works=None, log=None, shared_queue=False,
+                 backend=BACKEND_THREAD, processes=None, aging=AGING,
+                 idle_timeout=60, policy=None, capacity=None, memo_ttl=None,
+                 timeout_grace=1.0, broker=None):
         self.tmin = tmin
         self.tmax = tmax
         self.log =log
+        self.idle_timeout = idle_timeout
+        self.policy = policy
+        self.memo_ttl = memo_ttl
+        self.timeout_grace = timeout_grace
         self.mgr = ThreadManager()
         self.__mutex = threading.RLock()
-        self.setToStop = self.mgr.stopAll
+        self.__size = 0
+        self.__peak = 0
+        self.__retired = 0
+        self.__grown_at = 0
+        self.__latency = None  # moving average of work() seconds
+        self.__started_at = _time()
+        # of the threads which retired, and of the works canceled out of the queues
+        self.__retired_stats = WorkStats()
+        self.__pool_history = deque(maxlen=WorkDispatcher.POOL_HISTORY)
+        self.__aging = aging
+        self.__capacity = Capacity(capacity)
+        self.__run_qu = WorkQueue(aging, self.__capacity) if shared_queue else None
+        self.__backend = backend
+        self.__pool = ProcessPool(processes)
+        self.__broker = None
+        if broker is not None:
+            from .brokerutil import BrokerPool
+            self.__broker = BrokerPool(broker, log)
+        elif backend == BACKEND_BROKER:
+            raise ValueError('[wd] backend=BACKEND_BROKER needs the broker address')
+        self.__limiter = None
+        self.__delays = None
+        self.__retrying = {}  # work: its DelayQueue entry
+        self.__lanes = {}  # lane_key: deque of the works after the running one
+        self.__schedules = set()  # pending Schedules
+        self.__profiler = None
+        self.__timeouts = 0  # works timed out
+        self.__replaced = 0  # threads left to a hung work
+        self.__flights = {}  # dedup_key: [the queued or running work, works attached]
+        self.__memo = {}  # dedup_key: (expires_at, result)
+        self.__memo_order = deque()  # (expires_at, dedup_key), oldest first
+        self.__deduped = 0
+        self.__canceled = 0  # works taken out by _call_by_ws_cancel
+        self.__stopped = False
         self.isAlive = self.mgr.allAlive
-        self.info = self.mgr.info
         self.__is_serving = False
         if standalone_works:
             self.addWorks(standalone_works, standalone=True)
         else:
             for i in range(self.tmin):
-                self.mgr.addThreads([WorkerThread(log=log)])
+                self.mgr.addThreads([self.__make_th()])
+            self.__size = self.__peak = self.tmin
+        self.__pool_history.append((self.__started_at, self.mgr.count()))
+
+    def __make_th(self, standalone=False):
+        return WorkerThread(standalone=standalone,
+                            work_queue=None if standalone else self.__run_qu,
+                            backend=self.__backend, process_pool=self.__pool,
+                            aging=self.__aging, capacity=self.__capacity,
+                            owner=self, log=self.log, broker_pool=self.__broker)
+
+    def __new_th(self, standalone=False):
+        self.log.warn('[ws] new work-line')
+        new_th = self.__make_th(standalone=standalone)
+        self.mgr.addThread(new_th)
+        self.__size += 1
+        self.__peak = max(self.__peak, self.__size)
+        self.__grown_at = _time()
+        self.__pool_history.append((self.__grown_at, self.__size))
+        if self.__is_serving:
+            new_th.start()
+        return new_th
 
     def __get_th(self, standalone=False):
         with self.__mutex:
@@ -328,43 +1802,641 @@ class WorkDispatcher:
                 return th
             th_len = self.mgr.count()
             if th_len < self.tmax:
-                self.log.warn('[ws] new work-line')
-                new_th = WorkerThread(standalone=standalone, log=self.log)
-                self.mgr.addThread(new_th)
-                if self.__is_serving:
-                    new_th.start()
-                return new_th
+                return self.__new_th(standalone=standalone)
             else:
                 self.log.warn('[ws] all work-lines are busy')
                 return self.mgr.getThread(randint(0, th_len-1))
 
-    def addWork(self, work, standalone=False):
-        if not isinstance(work, WorkBase):
+    def addWork(self, work, standalone=False, block=True, timeout=None):
+        """
+        return a WorkFuture of work. When the dispatcher is full, wait for room
+        (at most `timeout` seconds) or, with block=False, raise Full at once
+        """
+        if not isinstance(work, WORK_TYPES):
+            raise ValueError('not a Work class')
+        self.__capacity.acquire(block, timeout)
+        if not standalone and (work.dedup_key is not None or work.lane_key is not None):
+            if not self.__lane_enter(self.__dedup([work])):
+                return work._call_by_wd_future()
+        return self.__queue(work, standalone)
+
+    def __queue(self, work, standalone=False):
+        future = work._call_by_wd_future()
+        with self.__mutex:
+            if self.__run_qu is None or standalone:
+                self.__get_th(standalone=standalone).add_work(work=work)
+                return future
+            if self.mgr.count() < self.tmax and self.__want_grow():
+                self.__new_th()
+            self.__run_qu.put(work)
+        return future
+
+    def _call_by_ws_release(self, works):
+        """
+        queue the subworks a finished one released without waiting for room:
+        it is called by a work thread, which must not block on its own queue
+        """
+        self.__capacity.take(len(works))
+        self.__dispatch(self.__lane_enter(self.__dedup(works)))
+
+    def __release(self, works):
+        """ as _call_by_ws_release, for works parked by a limit or retried """
+        self.__capacity.take(len(works))
+        self.__dispatch(works)
+
+    def __lane_enter(self, works):
+        """ return the works which may be queued now, the others wait in their lane """
+        ready = []
+        with self.__mutex:
+            for work in works:
+                key = work.lane_key
+                if key is None:
+                    ready.append(work)
+                elif key in self.__lanes:
+                    work._call_by_wd_future()
+                    self.__lanes[key].append(work)
+                else:
+                    self.__lanes[key] = deque()
+                    ready.append(work)
+        return ready
+
+    def __dedup(self, works):
+        """
+        return the works to queue, the others follow the work of their
+        dedup_key or get its memo, and give back their capacity
+        """
+        fresh, memoized = [], []
+        with self.__mutex:
+            self.__memo_expire(_time())
+            for work in works:
+                key = work.dedup_key
+                if key is None:
+                    fresh.append(work)
+                    continue
+                work._call_by_wd_future()
+                flight = self.__flights.get(key)
+                if flight is not None:
+                    flight[1].append(work)
+                elif key in self.__memo:
+                    memoized.append((work, self.__memo[key][1]))
+                else:
+                    self.__flights[key] = [work, []]
+                    fresh.append(work)
+            self.__deduped += len(works) - len(fresh)
+        self.__capacity.release(len(works) - len(fresh))
+        for work, result in memoized:
+            self.__follow(work, ST_FINISHED, result)
+        return fresh
+
+    def __follow(self, work, status, result=None, exception=None):
+        if work._call_by_work_thread_set_status(ST_WORKING) != ST_CANCEL:
+            work._call_by_work_thread_set_status(status, result=result, exception=exception)
+
+    def __memo_expire(self, now):
+        order = self.__memo_order
+        while order and order[0][0] <= now:
+            expires_at, key = order.popleft()
+            entry = self.__memo.get(key)
+            if entry is not None and entry[0] == expires_at:
+                del self.__memo[key]
+
+    def _call_by_work_thread_flight_done(self, work, status):
+        """ give the outcome of work to the works which were added after it """
+        result = exception = None
+        if status == ST_FINISHED:
+            result = work.future.result()
+        elif status == ST_ERROR:
+            exception = work.future.exception()
+        with self.__mutex:
+            flight = self.__flights.get(work.dedup_key)
+            if flight is None or flight[0] is not work:
+                return
+            del self.__flights[work.dedup_key]
+            if status == ST_FINISHED and self.memo_ttl:
+                expires_at = _time() + self.memo_ttl
+                self.__memo[work.dedup_key] = (expires_at, result)
+                self.__memo_order.append((expires_at, work.dedup_key))
+        for follower in flight[1]:
+            self.__follow(follower, status, result, exception)
+
+    def clearMemo(self, key=None):
+        """ forget the memo of key, or all of them """
+        with self.__mutex:
+            if key is None:
+                self.__memo.clear()
+                self.__memo_order.clear()
+            else:
+                self.__memo.pop(key, None)
+
+    def _call_by_work_thread_lane_done(self, work):
+        """ queue the next work of the lane, its capacity is already held """
+        with self.__mutex:
+            lane = self.__lanes.get(work.lane_key)
+            if lane is None:
+                return
+            if not lane:
+                del self.__lanes[work.lane_key]
+                return
+            work = lane.popleft()
+        self.__dispatch([work])
+
+    def __dispatch(self, works):
+        if not works:
+            return
+        if self.__run_qu is not None:
+            for work in works:
+                self.__queue(work)
+            return
+        this = getattr(_worker, 'thread', None)
+        with self.__mutex:
+            for work in works:
+                work._call_by_wd_future()
+                th = self.mgr.getIdleThread()
+                if th is None and self.mgr.count() < self.tmax:
+                    th = self.__new_th()
+                if th is None:
+                    # the shortest queue, the calling thread is about to be free
+                    threads = [self.mgr.getThread(i) for i in range(self.mgr.count())]
+                    th = min(threads, key=lambda t: (t.size(), t is not this))
+                th.add_work(work)
+
+    def tryAddWork(self, work, standalone=False):
+        """ return a WorkFuture, or None if the dispatcher is full """
+        try:
+            return self.addWork(work, standalone=standalone, block=False)
+        except Full:
+            return None
+
+    def __want_grow(self, incoming=1):
+        count, idle = self.mgr.count(), self.mgr.idleCount()
+        queued = self.__run_qu.size() + incoming
+        if self.policy is None:
+            return queued > idle
+        return self.policy.size(count - idle, queued, self.__latency) > count
+
+    def _call_by_work_thread_may_retire(self):
+        # called with the thread's queue locked, so no self.mgr lock here
+        return self.idle_timeout is not None and self.__size > self.tmin
+
+    def _call_by_work_thread_retire(self, th):
+        """ called by an idle thread, True if it is removed and should exit """
+        with self.__mutex:
+            count = self.mgr.count()
+            if count <= self.tmin or _time() - self.__grown_at < self.idle_timeout:
+                return False
+            queued = th.size() if self.__run_qu is None else self.__run_qu.size()
+            if queued:
+                return False
+            if self.policy is not None:
+                busy = count - self.mgr.idleCount()
+                if self.policy.size(busy, queued, self.__latency) >= count:
+                    return False
+            self.mgr.removeThread(th)
+            self.__size -= 1
+            self.__retired += 1
+            self.__retired_stats.merge(th.stats)
+            self.__pool_history.append((_time(), self.__size))
+            self.log.debug('[ws] retire a work-line')
+            return True
+
+    def setLimit(self, key, concurrency=None, rate=None, burst=None):
+        """
+        at most `concurrency` works with this limit_key running at the same
+        time, and at most `rate` of them started per second (token bucket of
+        `burst` tokens). None removes a limit
+        """
+        with self.__mutex:
+            if self.__limiter is None:
+                self.__limiter = KeyLimiter(self.__release, self.__delay_queue())
+        self.__limiter.setLimit(key, concurrency, rate, burst)
+
+    def __delay_queue(self):
+        with self.__mutex:
+            if self.__delays is None:
+                self.__delays = DelayQueue(log=self.log)
+                self.__delays.serve()
+            return self.__delays
+
+    def retryingSize(self):
+        """ works waiting to be run again, see RetryPolicy """
+        return len(self.__retrying)
+
+    def _call_by_work_thread_retry(self, work, exception):
+        """ True if the failed work is queued again after a backoff """
+        policy = work.retry
+        if policy is None or work.canceled or not policy.shouldRetry(work.retries, exception):
+            return False
+        work._call_by_wd_retried()
+        delay = policy.delay(work.retries)
+        with self.__mutex:
+            if self.__stopped:
+                return False
+            self.__retrying[work] = self.__delay_queue().put(delay, self.__retry_due, work)
+        return True
+
+    def __retry_due(self, work):
+        with self.__mutex:
+            if self.__retrying.pop(work, None) is None:
+                return
+        self.__release([work])
+
+    def startProfiler(self, interval=0.01, trace=False, max_samples=100000):
+        """ start and return a WorkProfiler of the threads """
+        with self.__mutex:
+            if self.__profiler is not None:
+                raise ValueError('[ws] the profiler is running already')
+            self.__profiler = WorkProfiler(self.mgr.threads, interval, trace, max_samples,
+                                           log=self.log)
+            profiler = self.__profiler
+        profiler.serve()
+        return profiler
+
+    def stopProfiler(self):
+        """ stop the WorkProfiler and return it with its samples, or None """
+        with self.__mutex:
+            profiler, self.__profiler = self.__profiler, None
+        if profiler is not None:
+            profiler.setToStop()
+            profiler.join()
+        return profiler
+
+    def scheduleAt(self, when, work):
+        """ release work at time.time() `when`, return its Schedule """
+        if not isinstance(work, WORK_TYPES):
             raise ValueError('not a Work class')
-        self.__get_th(standalone=standalone).add_work(work=work)
+        future = work._call_by_wd_future()
+        return self.__schedule(Schedule(lambda: work, when, future=future))
+
+    def scheduleAfter(self, delay, work):
+        """ release work in `delay` seconds, return its Schedule """
+        return self.scheduleAt(_time() + delay, work)
+
+    def scheduleEvery(self, interval, factory, start=None, missed=MISSED_SKIP):
+        """
+        release factory() (a new work) every `interval` seconds, the first one
+        at time.time() `start` (default: in `interval` seconds) until the
+        Schedule is canceled. missed: MISSED_SKIP or MISSED_CATCH_UP
+        """
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        if start is None:
+            start = _time() + interval
+        return self.__schedule(Schedule(factory, start, interval, missed))
+
+    def cancelSchedule(self, schedule):
+        with self.__mutex:
+            if schedule.canceled:
+                return
+            schedule.canceled = True
+            self.__schedules.discard(schedule)
+            if schedule.entry is not None:
+                self.__delays.cancel(schedule.entry)
+        if schedule.future is not None:
+            schedule.future.cancel()
+
+    def scheduledSize(self):
+        return len(self.__schedules)
+
+    def __schedule(self, schedule):
+        with self.__mutex:
+            if self.__stopped:
+                raise ValueError('[ws] can not schedule, dispatcher is stopped')
+            schedule.owner = self
+            self.__schedules.add(schedule)
+            schedule.entry = self.__delay_queue().putAt(
+                schedule.due_at, self.__schedule_due, schedule)
+        return schedule
+
+    def __schedule_due(self, schedule):
+        # in the DelayQueue thread, which must not block on a full dispatcher
+        with self.__mutex:
+            if schedule.canceled:
+                return
+            ticks = schedule._call_by_wd_tick(_time())
+            if schedule.interval is None:
+                self.__schedules.discard(schedule)
+                schedule.entry = None
+            else:
+                schedule.entry = self.__delays.putAt(
+                    schedule.due_at, self.__schedule_due, schedule)
+        works = []
+        for i in range(ticks):
+            try:
+                work = schedule.factory()
+            except Exception as e:
+                self.log.exception(e)
+                continue
+            if not isinstance(work, WORK_TYPES):
+                self.log.error('[ws] a schedule made no work: %r', work)
+                continue
+            works.append(work)
+        if works:
+            self._call_by_ws_release(works)
+
+    def _call_by_work_thread_watch(self, th, work):
+        """ return the DelayQueue entry timing out work, which th starts now """
+        return self.__delay_queue().put(work.timeout, self.__time_out, th, work,
+                                        'work timed out after %ss' % work.timeout)
+
+    def _call_by_ws_delay(self, delay, func, *args):
+        """ func(*args) in the DelayQueue thread, return an entry for _call_by_ws_undelay """
+        return self.__delay_queue().put(delay, func, *args)
+
+    def _call_by_ws_undelay(self, entry):
+        self.__delay_queue().cancel(entry)
+
+    def _call_by_ws_cancel(self, works):
+        """
+        cancel the subworks of a task in one step: the ones queued, parked,
+        waiting in a lane, attached to a dedup flight or waiting for a retry
+        are taken out and ended with ST_CANCEL, the running ones are set to
+        stop. Return how many were taken out
+        """
+        works = set(works)
+        queued, waiting, attached = [], [], []
+        with self.__mutex:
+            threads = self.mgr.threads()
+            for key, lane in list(self.__lanes.items()):
+                if any(work in works for work in lane):
+                    waiting.extend(work for work in lane if work in works)
+                    self.__lanes[key] = deque(work for work in lane if work not in works)
+            for flight in self.__flights.values():
+                if any(work in works for work in flight[1]):
+                    attached.extend(work for work in flight[1] if work in works)
+                    flight[1] = [work for work in flight[1] if work not in works]
+            retrying = [work for work in self.__retrying if work in works]
+            for work in retrying:
+                self.__delays.cancel(self.__retrying.pop(work))
+        if self.__run_qu is not None:
+            queued.extend(self.__run_qu.remove(works))
+        for th in threads:
+            queued.extend(th._call_by_wd_remove(works))
+        parked = self.__limiter.cancel(works, queued) if self.__limiter is not None else []
+        self.__capacity.release(len(waiting))
+        removed = queued + parked + waiting + attached + retrying
+        # the running ones, and the ones a thread popped meanwhile
+        for work in works.difference(removed):
+            work.cancel()
+        with self.__mutex:
+            self.__canceled += len(removed)
+            for work in removed:
+                self.__retired_stats.record(work, ST_CANCEL)
+        for work in removed:
+            work._call_by_work_thread_set_status(ST_CANCEL)
+        # as if a work thread had popped them, or ended them without a retry
+        for work in queued + parked + retrying:
+            if work.dedup_key is not None:
+                self._call_by_work_thread_flight_done(work, ST_CANCEL)
+            if work.lane_key is not None:
+                self._call_by_work_thread_lane_done(work)
+        return len(removed)
+
+    def _call_by_ws_expire(self, works, reason):
+        """ end the works which have not: time out the running ones, cancel the others """
+        running = dict((th.currWork, th) for th in self.mgr.threads())
+        for work in works:
+            work.setToStop()
+            th = running.get(work)
+            if th is not None and work.status == ST_WORKING:
+                self.__time_out(th, work, reason)
+            elif work._call_by_work_thread_set_status(ST_WORKING) == ST_WORKING:
+                work._call_by_work_thread_set_status(ST_ERROR, exception=TimeoutError(reason))
+
+    def __time_out(self, th, work, reason):
+        if th.currWork is not work or work.status != ST_WORKING:
+            return  # it returned already
+        self.log.warn('[ws] %s: %s', reason, work.name)
+        with self.__mutex:
+            self.__timeouts += 1
+        work.setToStop()
+        status = work._call_by_work_thread_set_status(ST_ERROR, exception=TimeoutError(reason))
+        if status == ST_ERROR and work.dedup_key is not None:
+            # its followers fail now, its lane and limit wait for the thread
+            self._call_by_work_thread_flight_done(work, ST_ERROR)
+        self.__delay_queue().put(self.timeout_grace, self.__hung, th, work)
+
+    def __hung(self, th, work):
+        """ work() did not return after its timeout, replace its thread """
+        with self.__mutex:
+            if th.currWork is not work or th not in self.mgr.threads():
+                return
+            self.log.warn('[ws] replace a work-line hung in: %s', work.name)
+            self.mgr.removeThread(th)
+            self.__size -= 1
+            self.__replaced += 1
+            self.__retired_stats.merge(th.stats)
+            works = th._call_by_wd_abandon()
+            new_th = None if self.__stopped else self.__new_th(standalone=th.isStandalone)
+        if new_th is not None:
+            if works:
+                new_th.add_works(works)
+            return
+        self.__capacity.release(len(works))
+        for work in works:
+            work._call_by_work_thread_set_status(ST_CANCEL)
+
+    def parkedSize(self):
+        """ works waiting for a limit, out of the queues """
+        return self.__limiter.parked() if self.__limiter else 0
+
+    def _call_by_work_thread_admit(self, work):
+        """ True if work may start now, else the limiter keeps it """
+        return self.__limiter is None or self.__limiter.admit(work)
+
+    def _call_by_work_thread_end(self, work):
+        if self.__limiter is not None:
+            self.__limiter.done(work)
 
-    def addWorks(self, works, standalone=False):
+    def _call_by_work_thread_done(self, seconds, watch=None):
+        if watch is not None:
+            self.__delays.cancel(watch)
+        if self.__latency is None:
+            self.__latency = seconds
+        else:
+            self.__latency += (seconds - self.__latency) * 0.2
+
+    def info(self):
+        """ idel/busy of each thread, and the pool size in 'pool' """
+        info = self.mgr.info()
+        info['pool'] = {'current': self.mgr.count(), 'peak': self.__peak,
+                        'retired': self.__retired, 'queued': self.__capacity.used,
+                        'queue_high': self.__capacity.high}
+        return info
+
+    def metrics(self):
+        """
+        snapshot: 'works' (queue wait, per class run time and outcome counts,
+        throughput per second of uptime, error and cancel rates), 'threads'
+        (utilization of each thread) and 'pool' (size, history, queue)
+        """
+        with self.__mutex:
+            threads = [self.mgr.getThread(i) for i in range(self.mgr.count())]
+            stats = WorkStats().merge(self.__retired_stats)
+            history = list(self.__pool_history)
+        for th in threads:
+            stats.merge(th.stats)
+        uptime = _time() - self.__started_at
+        return {'uptime': uptime,
+                'works': stats.snapshot(uptime),
+                'threads': dict((th.getName(), th.utilization()) for th in threads),
+                'pool': {'current': len(threads), 'tmin': self.tmin, 'tmax': self.tmax,
+                         'peak': self.__peak, 'retired': self.__retired,
+                         'queued': self.__capacity.used, 'queue_high': self.__capacity.high,
+                         'history': history},
+                'limits': self.__limiter.info() if self.__limiter else {},
+                'retrying': len(self.__retrying),
+                'timeouts': self.__timeouts,
+                'threads_replaced': self.__replaced,
+                'canceled_queued': self.__canceled,
+                'schedules': len(self.__schedules),
+                'dedup': {'flights': len(self.__flights), 'memo': len(self.__memo),
+                          'attached': sum(len(f[1]) for f in list(self.__flights.values())),
+                          'deduped': self.__deduped},
+                'lanes': {'active': len(self.__lanes),
+                          'waiting': sum(len(lane) for lane in list(self.__lanes.values()))},
+                'missed_deadlines': self.missedDeadlines()}
+
+    def metricsText(self, prefix='vavava_wd'):
+        """ metrics() in the Prometheus text format """
+        lines = []
+        _prom_metrics(lines, prefix, self.metrics())
+        return '\n'.join(lines) + '\n'
+
+    def addWorks(self, works, standalone=False, block=True, timeout=None):
+        """
+        addWork() for a batch: as much of it as the capacity allows is spread
+        over the threads under one lock, each queue is filled and notified once
+        """
+        works = list(works)
         for work in works:
-            self.addWork(work, standalone=standalone)
+            if not isinstance(work, WORK_TYPES):
+                raise ValueError('not a Work class')
+        if standalone or len(works) == 1:
+            return [self.addWork(work, standalone=standalone, block=block, timeout=timeout)
+                    for work in works]
+        futures = [work._call_by_wd_future() for work in works]
+        start = 0
+        while start < len(works):
+            n = self.__capacity.acquireMany(len(works) - start, block, timeout)
+            self.__queue_many(self.__lane_enter(self.__dedup(works[start:start + n])))
+            start += n
+        return futures
+
+    def __queue_many(self, works):
+        if not works:
+            return
+        with self.__mutex:
+            if self.__run_qu is not None:
+                while self.mgr.count() < self.tmax and self.__want_grow(len(works)):
+                    self.__new_th()
+                self.__run_qu.putMany(works)
+                return
+            # as addWork() would do one by one: a work for each idle thread,
+            # then for each new thread, the rest round-robin from a random one
+            first = [th for th in self.mgr.threads() if th.idel()]
+            while len(first) < len(works) and self.mgr.count() < self.tmax:
+                first.append(self.__new_th())
+            batches = {}
+            for th, work in zip(first, works):
+                batches[th] = [work]
+            rest = works[len(first):]
+            if rest:
+                threads = self.mgr.threads()
+                offset = randint(0, len(threads) - 1)
+                ring = threads[offset:] + threads[:offset]
+                for i, work in enumerate(rest):
+                    batches.setdefault(ring[i % len(ring)], []).append(work)
+            for th, batch in batches.items():
+                th.add_works(batch)
+
+    def queueSize(self):
+        if self.__run_qu is not None:
+            return self.__run_qu.size()
+        return sum(self.mgr.getThread(i).size() for i in range(self.mgr.count()))
+
+    def missedDeadlines(self):
+        """ number of works canceled because their deadline passed before start """
+        missed = sum(self.mgr.getThread(i).missedDeadlines() for i in range(self.mgr.count()))
+        if self.__run_qu is not None:
+            missed += self.__run_qu.missed
+        return missed
 
     def serve(self):
         self.mgr.startAll()
         self.__is_serving = True
 
+    def setToStop(self):
+        self.mgr.stopAll()
+        self.stopProfiler()
+        if self.__run_qu is not None:
+            self.__run_qu.clear(ST_CANCEL)
+        with self.__mutex:
+            self.__stopped = True
+            retrying, self.__retrying = list(self.__retrying), {}
+            lanes, self.__lanes = list(self.__lanes.values()), {}
+            schedules, self.__schedules = list(self.__schedules), set()
+            flights, self.__flights = list(self.__flights.values()), {}
+            for schedule in schedules:
+                schedule.canceled = True
+            if self.__delays is not None:
+                self.__delays.setToStop()
+        waiting = [work for lane in lanes for work in lane]
+        self.__capacity.release(len(waiting))
+        attached = [work for flight in flights for work in flight[1]]
+        for work in retrying + waiting + attached:
+            work._call_by_work_thread_set_status(ST_CANCEL)
+        for schedule in schedules:
+            if schedule.future is not None:
+                schedule.future.cancel()
+        if self.__limiter is not None:
+            self.__limiter.clear(ST_CANCEL)
+
     def joinAll(self, timeout=None):
         self.mgr.joinAll(timeout)
+        if self.__delays is not None:
+            self.__delays.join(timeout)
+        if self.__limiter is not None:
+            self.__limiter.clear(ST_CANCEL)  # parked while the threads stopped
+        if not self.mgr.allAlive():
+            self.__pool.shutdown()
+            if self.__broker is not None:
+                self.__broker.shutdown()
         self.__is_serving = False
 
 
 class TaskBase:
-    def __init__(self, parent=None, name='<task>',log=None):
+    # set by the TaskJournal of the shop the task was added to
+    journal_id = None
+
+    def __init__(self, parent=None, name='<task>',log=None, priority=PRI_NORMAL, deadline=None,
+                 retry=None, timeout=None):
+        """
+        subworks without a priority, deadline or retry policy of their own take the task's.
+        timeout: seconds the task may run from when the shop starts it, then its
+        subworks not ended are, with ST_ERROR and a TimeoutError, see WorkShop
+        """
         self.parent = parent
         self.name = name
         self.log = log
+        self.priority = priority
+        self.deadline = deadline
+        self.retry = retry
+        self.timeout = timeout
         self.__subworks = None
         self.__err_ev = threading.Event()
         # 0/1/2/3/4 init/processing/finish/canceled/error
         self.__status = ST_INIT
+        self.__future = None
+        self.__mutex = threading.Lock()
+        self.__pending = 0
+        self.__worst = ST_FINISHED
+        self.__on_done = None
+        self.__on_ready = None
+        self.__on_work = None
+        self.__on_cancel = None
+        self.__after = {}       # subwork: the subworks it waits for
+        self.__waiting = {}     # subwork not released yet: prerequisites left
+        self.__dependents = {}  # subwork: the subworks waiting for it
 
     # def makeSubWorks(self):
     #     """  """
@@ -375,13 +2447,23 @@ class TaskBase:
     #         self.__subworks = self.makeSubWorks()
     #     return self.__subworks
 
-    def addSubWorks(self, subworks):
+    def addSubWorks(self, subworks, after=None):
+        """
+        after: subworks added before, which must all finish before these are
+        dispatched. If one of them fails or is canceled, these are canceled
+        """
         if self.__subworks is None:
             self.__subworks = []
+        after = tuple(after or ())
+        for pre in after:
+            if pre not in self.__after:
+                raise ValueError('[task] a prerequisite must be added to the task before')
         for sw in subworks:
             self.__subworks.append(sw)
-        if not self.__subworks:
-            pass
+            self.__after[sw] = after
+
+    def addSubWork(self, subwork, after=None):
+        self.addSubWorks([subwork], after=after)
 
     @property
     def subWorks(self):
@@ -398,8 +2480,50 @@ class TaskBase:
     def status(self):
         return self.__status
 
+    @property
+    def future(self):
+        return self.__future
+
+    @property
+    def retries(self):
+        """ retries of all the subworks """
+        return sum(sw.retries for sw in self.__subworks or [])
+
+    _LOCAL_ATTRS = ('parent', 'log', '_TaskBase__err_ev', '_TaskBase__status',
+                    '_TaskBase__future', '_TaskBase__mutex', '_TaskBase__pending',
+                    '_TaskBase__worst', '_TaskBase__on_done', '_TaskBase__on_ready',
+                    '_TaskBase__on_work', '_TaskBase__on_cancel', '_TaskBase__waiting',
+                    '_TaskBase__dependents')
+
+    def __getstate__(self):
+        return dict((k, v) for k, v in self.__dict__.items()
+                    if k not in TaskBase._LOCAL_ATTRS)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.parent = None
+        self.log = None
+        self.__err_ev = threading.Event()
+        self.__status = ST_INIT
+        self.__future = None
+        self.__mutex = threading.Lock()
+        self.__pending = 0
+        self.__worst = ST_FINISHED
+        self.__on_done = self.__on_ready = self.__on_work = self.__on_cancel = None
+        self.__waiting, self.__dependents = {}, {}
+
+    def _call_by_ws_resume(self, finished):
+        """ (index, result) of the subworks a TaskJournal saw finish """
+        for index, result in finished:
+            sw = self.__subworks[index]
+            sw._call_by_wd_future()
+            sw._call_by_work_thread_set_status(ST_WORKING)
+            sw._call_by_work_thread_set_status(ST_FINISHED, result=result)
+
     def _call_by_ws_set_status(self, status):
         self.__status = status
+        if status > ST_WORKING and self.__future:
+            self.__future._resolve(status, *self.__outcome())
         # if self.__subtasks:
         #     for stsk in self.__subtasks:
         #         stsk._call_by_ws_set_status(status)
@@ -426,109 +2550,711 @@ class TaskBase:
             for work in self.__subworks:
                 work.waitForStop()
 
+    def __outcome(self):
+        """ (result, exception) for the task future """
+        results, exception = [], None
+        for sw in self.__subworks or []:
+            f = sw.future
+            # the status first: canceled subworks may be most of a failed task
+            if f is None or sw.status in (ST_CANCEL, ST_INIT) or not f.done() or f.cancelled():
+                results.append(None)
+            elif f.exception() is not None:
+                results.append(None)
+                exception = exception or f.exception()
+            else:
+                results.append(f.result())
+        if exception is None:
+            exception = RuntimeError('Task error: %s' % self.name)
+        return results, exception
+
+    def _call_by_ws_future(self):
+        if self.__future is None:
+            self.__future = TaskFuture(self)
+        return self.__future
+
+    def _call_by_ws_inherit(self):
+        for sw in self.__subworks:
+            if sw.priority is None:
+                sw.priority = self.priority
+            if sw.deadline is None:
+                sw.deadline = self.deadline
+            if sw.retry is None:
+                sw.retry = self.retry
+            if sw.parent is None:
+                sw.parent = self
+
+    def _call_by_ws_track(self, on_done, on_ready=None, on_work=None, on_cancel=None):
+        """
+        count down the subworks as they end, the first error or cancel stops
+        the others, on_done(task, status) is called once the last one ends.
+        Return the subworks to dispatch now, on_ready(subworks) is called with
+        the others as their prerequisites finish. on_work(task, subwork) is
+        called as each one ends. Subworks finished already (resumed) are skipped.
+        on_cancel(task, subworks) ends the subworks released and not ended
+        when the task stops, else they are set to stop; the ones not released
+        are canceled
+        """
+        self.__pending = 0
+        self.__worst = ST_FINISHED
+        self.__on_done = on_done
+        self.__on_ready = on_ready
+        self.__on_work = on_work
+        self.__on_cancel = on_cancel
+        self.__waiting, self.__dependents = {}, {}
+        ready = []
+        for sw in self.__subworks:
+            if sw.status == ST_FINISHED:
+                continue
+            self.__pending += 1
+            after = [pre for pre in self.__after.get(sw, ()) if pre.status != ST_FINISHED]
+            if after:
+                self.__waiting[sw] = len(after)
+                for pre in after:
+                    self.__dependents.setdefault(pre, []).append(sw)
+            else:
+                ready.append(sw)
+            sw._call_by_ws_on_done(self.__subwork_done)
+        return ready
+
+    def __subwork_done(self, work):
+        if self.__on_work:
+            self.__on_work(self, work)
+        ready, skipped = [], []
+        with self.__mutex:
+            self.__pending -= 1
+            failed = work.status > self.__worst
+            self.__worst = max(self.__worst, work.status)
+            done = self.__pending == 0
+            for dep in self.__dependents.pop(work, ()):
+                if dep not in self.__waiting:
+                    continue
+                if work.status != ST_FINISHED:
+                    self.__skip(dep, skipped)
+                    continue
+                self.__waiting[dep] -= 1
+                if self.__waiting[dep] == 0:
+                    del self.__waiting[dep]
+                    ready.append(dep)
+        if done:
+            self.__on_done(self, self.__worst)
+            return
+        if failed:
+            self.__stop()
+        for sw in skipped:
+            sw._call_by_work_thread_set_status(ST_CANCEL)
+        if ready:
+            self.__on_ready(ready)
+
+    def _call_by_ws_cancel(self):
+        """ stop the task being tracked, it ends ST_CANCEL. False if it ended """
+        with self.__mutex:
+            if self.__pending == 0:
+                return False
+            self.__worst = max(self.__worst, ST_CANCEL)
+        self.__stop()
+        return True
+
+    def __stop(self):
+        with self.__mutex:
+            skipped = list(self.__waiting)
+            self.__waiting, self.__dependents = {}, {}
+        waiting = set(skipped)
+        released = [sw for sw in self.__subworks
+                    if sw.status <= ST_WORKING and sw not in waiting]
+        if self.__on_cancel:
+            self.__on_cancel(self, released)
+        else:
+            for sw in released:
+                sw.setToStop()
+        for sw in skipped:
+            sw._call_by_work_thread_set_status(ST_CANCEL)
+
+    def __skip(self, work, skipped):
+        """ take work and all the subworks waiting on it off the graph """
+        stack = [work]
+        while stack:
+            sw = stack.pop()
+            if self.__waiting.pop(sw, None) is None:
+                continue
+            skipped.append(sw)
+            stack.extend(self.__dependents.get(sw, ()))
+
+
+class TaskJournal(ServeThreadBase):
+    """
+    SQLite journal of the tasks of a WorkShop, for the shop restarted on the
+    same file to resume the unfinished ones: the tasks added (pickled), the
+    end state (and result) of their subworks, and the tasks done, which are
+    dropped then. Its own thread commits the writes queued in `interval`
+    seconds as one transaction, so a crash loses that much of them at most
+    """
+    def __init__(self, path, interval=0.05, log=None):
+        ServeThreadBase.__init__(self, log=log)
+        self.interval = interval
+        from .sqliteutil import Sqlite3Helper
+        from sqlite3 import Binary
+        self.path = path
+        self.__helper = Sqlite3Helper
+        self.__binary = Binary
+        self.__none = Binary(_pickle.dumps(None, _pickle.HIGHEST_PROTOCOL))
+        self.__cond = threading.Condition()
+        self.__ops = []
+        self.__idle = False  # the thread waits for the first write of a batch
+        self.__queued = 0
+        self.__written = 0
+        self.__batches = 0
+        # subwork: (task journal_id, index in subWorks), dict calls are atomic
+        self.__works = {}
+        self.__prefix = '%x' % int(_time() * 1000000)
+        self.__seq = _count()
+        db = self.__helper(path)
+        db.get_connection()
+        try:
+            db.conn.execute('PRAGMA journal_mode=WAL')
+            db.conn.execute('CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, body BLOB)')
+            db.conn.execute('CREATE TABLE IF NOT EXISTS works (task_id TEXT, idx INTEGER, '
+                            'state INTEGER, result BLOB, PRIMARY KEY (task_id, idx))')
+            db.conn.commit()
+        finally:
+            db.close()
+
+    def load(self):
+        """ the unfinished tasks, their subworks finished already restored """
+        db = self.__helper(self.path)
+        db.get_connection()
+        try:
+            rows = db.fetch_all('SELECT id, body FROM tasks ORDER BY rowid')
+            finished = {}
+            for task_id, index, result in db.fetch_all(
+                    'SELECT task_id, idx, result FROM works WHERE state = ? AND result IS NOT NULL',
+                    (ST_FINISHED,)):
+                finished.setdefault(task_id, []).append((index, result))
+        finally:
+            db.close()
+        tasks = []
+        for task_id, body in rows:
+            try:
+                task = _pickle.loads(bytes(body))
+                task._call_by_ws_resume([(index, _pickle.loads(bytes(result)))
+                                         for index, result in finished.get(task_id, ())])
+            except Exception as e:
+                self.log.exception(e)  # its class is gone? the row is kept
+                continue
+            self.__index(task)
+            tasks.append(task)
+        return tasks
+
+    def taskAdded(self, tasks):
+        """ raise the pickling error of a task which can not be journaled """
+        ops, added = [], []
+        for task in tasks:
+            if task.journal_id is not None:
+                continue  # resumed
+            task.journal_id = '%s-%x' % (self.__prefix, next(self.__seq))
+            added.append(task)
+            try:
+                ops.append(('task', task.journal_id,
+                            self.__binary(_pickle.dumps(task, _pickle.HIGHEST_PROTOCOL))))
+            except Exception:
+                for task in added:
+                    task.journal_id = None
+                raise
+        for task in tasks:
+            self.__index(task)
+        self.__put(ops)
+
+    def workDone(self, task, work):
+        """ a subwork ended, the on_work callback of TaskBase._call_by_ws_track """
+        key = self.__works.pop(work, None)
+        if key is None:
+            return
+        status, result = work.status, None
+        if status == ST_FINISHED:
+            result = work.future.result()
+            try:
+                result = self.__none if result is None else \
+                    self.__binary(_pickle.dumps(result, _pickle.HIGHEST_PROTOCOL))
+            except Exception as e:
+                result = None
+                self.log.warn('[journal] result not saved, run again on resume: %s, %r',
+                              work.name, e)
+        self.__put([('work', key[0], key[1], status, result)])
+
+    def taskDone(self, task):
+        if task.journal_id is None:
+            return
+        for sw in task.subWorks:
+            self.__works.pop(sw, None)
+        self.__put([('done', task.journal_id)])
+
+    def flush(self, timeout=None):
+        """ wait until all the writes queued so far are committed """
+        end_at = None if timeout is None else _time() + timeout
+        with self.__cond:
+            target = self.__queued
+            while self.__written < target and self.isAlive():
+                if end_at is None:
+                    self.__cond.wait(0.1)
+                elif end_at <= _time():
+                    break
+                else:
+                    self.__cond.wait(min(0.1, end_at - _time()))
+            return self.__written >= target
+
+    def info(self):
+        return {'queued': self.__queued - self.__written, 'written': self.__written,
+                'batches': self.__batches, 'tasks': len(set(k[0] for k in list(self.__works.values())))}
+
+    def __index(self, task):
+        works, task_id = self.__works, task.journal_id
+        for index, sw in enumerate(task.subWorks):
+            works[sw] = (task_id, index)
+
+    def __put(self, ops):
+        if not ops:
+            return
+        with self.__cond:
+            self.__ops.extend(ops)
+            self.__queued += len(ops)
+            if self.__idle:
+                self.__cond.notify()
+
+    def setToStop(self):
+        """ the thread exits once the queued writes are committed """
+        with self.__cond:
+            ServeThreadBase.setToStop(self)
+            self.__cond.notify()
+
+    def run(self):
+        db = self.__helper(self.path)
+        db.get_connection()
+        db.conn.execute('PRAGMA synchronous=NORMAL')
+        self._set_server_available()
+        try:
+            while True:
+                with self.__cond:
+                    self.__idle = True
+                    while not self.__ops and not self.isSetStop():
+                        self.__cond.wait()
+                    self.__idle = False
+                    if not self.__ops:
+                        break
+                    end_at = _time() + self.interval  # let a batch build up
+                    while not self.isSetStop() and end_at > _time():
+                        self.__cond.wait(end_at - _time())
+                    batch, self.__ops = self.__ops, []
+                try:
+                    db.execute_many(self.__statements(batch))
+                except Exception as e:
+                    self.log.exception(e)
+                with self.__cond:
+                    self.__written += len(batch)
+                    self.__batches += 1
+                    self.__cond.notify_all()
+        finally:
+            db.close()
+            self._set_server_available(False)
+
+    @staticmethod
+    def __statements(batch):
+        done = set(op[1] for op in batch if op[0] == 'done')
+        # a task added and done in the same batch is not written at all
+        tasks = [op[1:] for op in batch if op[0] == 'task' and op[1] not in done]
+        works = [op[1:] for op in batch if op[0] == 'work' and op[1] not in done]
+        done = [(task_id,) for task_id in done]
+        statements = []
+        if tasks:
+            statements.append(('INSERT OR REPLACE INTO tasks (id, body) VALUES (?, ?)', tasks))
+        if works:
+            statements.append(('INSERT OR REPLACE INTO works (task_id, idx, state, result) '
+                               'VALUES (?, ?, ?, ?)', works))
+        if done:
+            statements.append(('DELETE FROM tasks WHERE id = ?', done))
+            statements.append(('DELETE FROM works WHERE task_id = ?', done))
+        return statements
+
+
+class _TaskBuffer(PriorityQueue):
+    """ the WorkShop's task buffer, putMany() fills it under one lock """
+    def putMany(self, items):
+        with self.not_empty:
+            for item in items:
+                self._put(item)
+            self.unfinished_tasks += len(items)
+            self.not_empty.notify()
+
 
 # TODO: needs add setStop(force) or shutdown(), to finish all tasks before shutdown
 class WorkShop(ServeThreadBase):
-    def __init__(self, tmin=10, tmax=20, log=None):
+    """
+    backend/processes/broker/aging: see WorkDispatcher, cleanup() always runs
+                   in a thread, the tasks are tracked in this process
+    task_capacity: max tasks buffered, addTask blocks, times out or raises Full
+    work_capacity: max subworks queued in the dispatcher, when reached the shop
+                   stops taking tasks out of its buffer
+    metrics()/metricsText(): task buffer wait, latency and outcomes, plus the
+                   metrics of the work and cleanup dispatchers
+    TaskBase.timeout: when a task runs longer, its running subworks time out
+                   (see WorkDispatcher for the hung threads) and the others
+                   are canceled, so the task ends at once
+    when a subwork fails, or cancelTask(), the queued subworks of the task
+                   are taken out of the dispatcher at once and the running
+                   ones set to stop. metrics() 'cancel': seconds from then
+                   until the task ended
+    journal: a TaskJournal, or the path of its SQLite file. The unfinished
+                   tasks found in it are buffered again, see `resumed`; tasks
+                   canceled by setToStop() stay in it to be resumed
+    """
+    def __init__(self, tmin=10, tmax=20, log=None, backend=BACKEND_THREAD, processes=None,
+                 aging=AGING, task_capacity=None, work_capacity=None, journal=None,
+                 broker=None):
         ServeThreadBase.__init__(self, log=log)
-        self.__task_buff = Queue()
-        self.__curr_tasks = []
-        self.__wd = WorkDispatcher(tmin=tmin, tmax=tmax, log=log)
+        self.__task_buff = _TaskBuffer()
+        self.__buff_capacity = Capacity(task_capacity)
+        self.__task_seq = _count()
+        self.__missed = 0
+        self.__curr_tasks = {}  # task: time added
+        self.__timers = {}  # task: the DelayQueue entry timing it out
+        self.__canceling = {}  # task: time its subworks were canceled
+        self.__cancel_latency = Histogram()  # written with self.__mutex held
+        self.__stats = WorkStats()  # of tasks, written with self.__mutex held
+        self.__started_at = _time()
+        self.__mutex = threading.RLock()
+        self.__cleaning = 0
+        self.__clean_cond = threading.Condition()
+        self.__wd = WorkDispatcher(tmin=tmin, tmax=tmax, log=log,
+                                   backend=backend, processes=processes, aging=aging,
+                                   capacity=work_capacity, broker=broker)
         self.__clean = WorkDispatcher(tmin=1, tmax=5, log=log)
-
-    def addTasks(self, tasks):
+        if journal is not None and not isinstance(journal, TaskJournal):
+            journal = TaskJournal(journal, log=log)
+        self.__journal = journal
+        self.resumed = []  # the tasks resumed from the journal
+        if journal is not None:
+            self.__resume()
+
+    def __resume(self):
+        added_at = _time()
+        for task in self.__journal.load():
+            task.log = task.log or self.log
+            task._call_by_ws_future()
+            self.resumed.append(task)
+            if all(sw.status == ST_FINISHED for sw in task.subWorks):
+                task.future._start()
+                task._call_by_ws_set_status(ST_FINISHED)
+                self.__add_cleanup(task, added_at)
+                continue
+            self.__buff_capacity.take()
+            self.__task_buff.put(self.__entry(task, added_at))
+        if self.resumed:
+            self.log.info('[ws] resume %d tasks from the journal', len(self.resumed))
+
+    def addTasks(self, tasks, block=True, timeout=None):
+        """
+        addTask() for a batch: as many tasks as the buffer has room for are
+        put in it under one lock, waking up the shop once
+        """
+        tasks = list(tasks)
+        for task in tasks:
+            self.__check(task)
+        futures, entries, added_at = [], [], _time()
         for task in tasks:
-            self.addTask(task)
+            futures.append(task._call_by_ws_future())
+            if self.__empty_task(task):
+                continue
+            entries.append(self.__entry(task, added_at))
+        start = 0
+        while start < len(entries):
+            n = self.__buff_capacity.acquireMany(len(entries) - start, block, timeout)
+            if not self.isAvailable():
+                self.__buff_capacity.release(n)
+                raise ValueError('[wd] can not add task, server is not available')
+            if self.__journal is not None:
+                # only the accepted tasks, before they can be run and journaled done
+                try:
+                    self.__journal.taskAdded([entry[-1] for entry in entries[start:start + n]])
+                except Exception:
+                    self.__buff_capacity.release(n)  # not picklable
+                    raise
+            self.__task_buff.putMany(entries[start:start + n])
+            start += n
+        self.log.debug('[ws] add %d tasks', len(tasks))
+        return futures
+
+    def tryAddTask(self, task):
+        """ return a TaskFuture, or None if the task buffer is full """
+        try:
+            return self.addTask(task, block=False)
+        except Full:
+            return None
+
+    def addTask(self, task, block=True, timeout=None):
+        """
+        return a TaskFuture of task. When the buffer is full, wait for room
+        (at most `timeout` seconds) or, with block=False, raise Full at once
+        """
+        self.__check(task)
+        future = task._call_by_ws_future()
+        if self.__empty_task(task):
+            return future
+        self.__buff_capacity.acquire(block, timeout)
+        if not self.isAvailable():
+            self.__buff_capacity.release()
+            raise ValueError('[wd] can not add task, server is not available')
+        if self.__journal is not None:
+            try:
+                self.__journal.taskAdded([task])
+            except Exception:
+                self.__buff_capacity.release()  # not picklable
+                raise
+        self.__task_buff.put(self.__entry(task, _time()))
+        self.log.debug('[ws] add a work: %s', task.name)
+        return future
 
-    def addTask(self, task):
+    def __check(self, task):
         assert isinstance(task, TaskBase)
         if task.subWorks is None:
             raise ValueError('[wd] can not add task, subwork is None (task not initialised)')
+        for sw in task.subWorks:
+            if not isinstance(sw, WORK_TYPES):
+                raise ValueError('[wd] can not add task, subwork is not a Work class')
         if not self.isAvailable():
             raise ValueError('[wd] can not add task, server is not available')
-        if len(task.subWorks) == 0:
-            # empty task
-            task._call_by_ws_set_status(ST_FINISHED)
-            self.__clean.addWork(WorkShop.SerWork(task))
-            return
-        self.__task_buff.put(task)
-        self.log.debug('[ws] add a work: %s', task.name)
+
+    def __empty_task(self, task):
+        """ a task without subworks is done at once, return True for it """
+        if len(task.subWorks) != 0:
+            return False
+        task.future._start()
+        task._call_by_ws_set_status(ST_FINISHED)
+        self.__add_cleanup(task, _time())
+        return True
+
+    def __entry(self, task, added_at):
+        priority = PRI_NORMAL if task.priority is None else task.priority
+        deadline = _INF if task.deadline is None else task.deadline
+        return priority, deadline, next(self.__task_seq), added_at, task
 
     def info(self):
         info = dict()
-        info['buffering'] = self.__task_buff.qsize()
+        info['buffering'] = self.__buff_capacity.used
+        info['buffer_high'] = self.__buff_capacity.high
         info['running'] = len(self.__curr_tasks)
         info['threads'] = self.__wd.info()
         info['sys'] = self.__clean.info()
+        info['missed_deadlines'] = self.missedDeadlines()
         return info
 
+    def metrics(self):
+        """
+        snapshot: 'tasks' (buffer wait, per class latency from addTask() to
+        done and outcome counts, rates), 'cancel' (seconds from a subwork
+        failed or cancelTask() to the task done), 'works' and 'cleanup' (the
+        WorkDispatcher.metrics() of the subworks and of the cleanups)
+        """
+        uptime = _time() - self.__started_at
+        with self.__mutex:
+            tasks = WorkStats().merge(self.__stats)
+            running = len(self.__curr_tasks)
+            cancel = Histogram().merge(self.__cancel_latency)
+        return {'uptime': uptime,
+                'tasks': tasks.snapshot(uptime),
+                'cancel': cancel.snapshot(),
+                'buffering': self.__buff_capacity.used,
+                'buffer_high': self.__buff_capacity.high,
+                'running': running,
+                'missed_deadlines': self.__missed,
+                'journal': self.__journal.info() if self.__journal else None,
+                'works': self.__wd.metrics(),
+                'cleanup': self.__clean.metrics()}
+
+    def metricsText(self, prefix='vavava_ws'):
+        """ metrics() in the Prometheus text format """
+        metrics = self.metrics()
+        lines = []
+        for name, kind, value in (('tasks_buffered', 'gauge', metrics['buffering']),
+                                  ('tasks_buffered_peak', 'gauge', metrics['buffer_high']),
+                                  ('tasks_running', 'gauge', metrics['running']),
+                                  ('tasks_missed_deadlines_total', 'counter',
+                                   metrics['missed_deadlines'])):
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            lines.append('%s_%s %s' % (prefix, name, value))
+        lines.append('# TYPE %s_buffer_wait_seconds histogram' % prefix)
+        _prom_histogram(lines, '%s_buffer_wait_seconds' % prefix, metrics['tasks']['wait'])
+        lines.append('# TYPE %s_cancel_seconds histogram' % prefix)
+        _prom_histogram(lines, '%s_cancel_seconds' % prefix, metrics['cancel'])
+        _prom_stats(lines, prefix, metrics['tasks'], 'task')
+        if metrics['journal'] is not None:
+            for name, kind, key in (('journal_queued', 'gauge', 'queued'),
+                                    ('journal_written_total', 'counter', 'written'),
+                                    ('journal_batches_total', 'counter', 'batches')):
+                lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+                lines.append('%s_%s %s' % (prefix, name, metrics['journal'][key]))
+        _prom_metrics(lines, prefix + '_wd', metrics['works'])
+        _prom_metrics(lines, prefix + '_cleanup', metrics['cleanup'])
+        return '\n'.join(lines) + '\n'
+
+    def missedDeadlines(self):
+        """ tasks and works canceled because their deadline passed before start """
+        return self.__missed + self.__wd.missedDeadlines()
+
+    def setLimit(self, key, concurrency=None, rate=None, burst=None):
+        """ limits of the subworks by limit_key, see WorkDispatcher.setLimit """
+        self.__wd.setLimit(key, concurrency, rate, burst)
+
+    def startProfiler(self, interval=0.01, trace=False, max_samples=100000):
+        """ profile the subworks, see WorkDispatcher.startProfiler """
+        return self.__wd.startProfiler(interval, trace, max_samples)
+
+    def stopProfiler(self):
+        return self.__wd.stopProfiler()
+
+    def scheduleAt(self, when, work):
+        """ works scheduled on the shop's dispatcher, see WorkDispatcher """
+        return self.__wd.scheduleAt(when, work)
+
+    def scheduleAfter(self, delay, work):
+        return self.__wd.scheduleAfter(delay, work)
+
+    def scheduleEvery(self, interval, factory, start=None, missed=MISSED_SKIP):
+        return self.__wd.scheduleEvery(interval, factory, start, missed)
+
+    def setToStop(self):
+        ServeThreadBase.setToStop(self)
+        self.__task_buff.put((-_INF, -_INF, -1, 0, None))  # wake up run()
+
     def run(self):
         self.log.debug('[ws] start serving')
         self.__wd.serve()
         self.__clean.serve()
+        if self.__journal is not None:
+            self.__journal.serve()
         self._set_server_available()
-        # monitor = _Moniter(self.log)
         while not self.isSetStop():
-            # monitor.report(self.info())
-            curr_task = None
-            start_at = _time()
+            added_at, curr_task = self.__task_buff.get()[-2:]
+            if curr_task is None:
+                continue
+            self.__buff_capacity.release()
+            with self.__mutex:
+                self.__stats.waited(_time() - added_at)
+            if curr_task.deadline is not None and curr_task.deadline < _time():
+                self.__missed += 1
+                curr_task._call_by_ws_set_status(ST_CANCEL)
+                self.__add_cleanup(curr_task, added_at)
+                self.log.debug('[ws] Task missed its deadline: %s', curr_task.name)
+                continue
+            if not curr_task.future._start():
+                curr_task._call_by_ws_set_status(ST_CANCEL)
+                self.__add_cleanup(curr_task, added_at)
+                self.log.debug('[ws] Task canceled: %s', curr_task.name)
+                continue
             try:
-                if not self.__task_buff.empty():
-                    curr_task = self.__task_buff.get()
-                    self.__curr_tasks.append(curr_task)
-                    curr_task._call_by_ws_set_status(ST_WORKING)
-                    self.__wd.addWorks(curr_task.subWorks)
-                    self.log.debug('[ws] pop a Task: %s', curr_task.name)
-                    curr_task = None
-
-                for i, tk in enumerate(self.__curr_tasks):
-                    wkarchvied = True
-                    for wk in tk.subWorks:
-                        if wk.status != ST_FINISHED:
-                            wkarchvied = False
-                        elif wk.status == ST_ERROR:
-                            tk._call_by_ws_set_status(ST_ERROR)
-                            tk.setToStop()
-                            tk.waitForStop()
-                            self.log.debug('[ws] Task err: %s', tk.name)
-                            del self.__curr_tasks[i]
-                        elif wk.status == ST_CANCEL:
-                            tk._call_by_ws_set_status(ST_CANCEL)
-                            tk.setToStop()
-                            tk.waitForStop()
-                            self.log.debug('[ws] Task canceled: %s', tk.name)
-                            del self.__curr_tasks[i]
-                    if wkarchvied:
-                        tk._call_by_ws_set_status(ST_FINISHED)
-                        self.log.debug('[ws] Task done: %s', tk.name)
-                        del self.__curr_tasks[i]
-                    if tk.status > ST_WORKING:
-                        self.log.debug('[ws] cleanup')
-                        self.__clean.addWork(WorkShop.SerWork(tk))
+                with self.__mutex:
+                    self.__curr_tasks[curr_task] = added_at
+                    if curr_task.timeout is not None:
+                        self.__timers[curr_task] = self.__wd._call_by_ws_delay(
+                            curr_task.timeout, self.__time_out, curr_task)
+                curr_task._call_by_ws_set_status(ST_WORKING)
+                curr_task._call_by_ws_inherit()
+                ready = curr_task._call_by_ws_track(
+                    self.__task_done, self.__wd._call_by_ws_release,
+                    self.__journal.workDone if self.__journal else None, self.__cancel)
+                self.__wd.addWorks(ready)
+                self.log.debug('[ws] pop a Task: %s', curr_task.name)
             except Exception as e:
                 # TODO: fetal err, need handle and report
-                if curr_task:
-                    curr_task._call_by_ws_set_status(ST_ERROR)
+                curr_task._call_by_ws_set_status(ST_ERROR)
                 self.log.exception(e)
-            finally:
-                duration = _time() - start_at
-                if duration < 0.8:
-                    _sleep(0.5)
 
         self._set_server_available(flag=False)
         self.__wd.setToStop()
         self.__wd.joinAll()
         self.__cleanUp()
+        with self.__clean_cond:
+            while self.__cleaning > 0:
+                self.__clean_cond.wait()
         self.__clean.setToStop()
         self.__clean.joinAll()
+        if self.__journal is not None:
+            self.__journal.setToStop()
+            self.__journal.join()
         self.log.debug('[ws] stop serving')
 
+    def __time_out(self, task):
+        with self.__mutex:
+            if self.__timers.pop(task, None) is None:
+                return
+        self.log.warn('[ws] Task timed out: %s', task.name)
+        self.__wd._call_by_ws_expire(
+            [sw for sw in task.subWorks if sw.status <= ST_WORKING],
+            'task timed out after %ss' % task.timeout)
+
+    def cancelTask(self, task):
+        """
+        cancel a task buffered or running, the running one ends ST_CANCEL
+        once its running subworks returned. False if it ended already
+        """
+        if task.future is not None and task.future.cancel():
+            return True
+        with self.__mutex:
+            if task not in self.__curr_tasks:
+                return False
+            self.__canceling.setdefault(task, _time())
+        return task._call_by_ws_cancel()
+
+    def __cancel(self, task, works):
+        """ a subwork of task failed, or it is canceled: end the others at once """
+        with self.__mutex:
+            self.__canceling.setdefault(task, _time())
+        removed = self.__wd._call_by_ws_cancel(works)
+        self.log.debug('[ws] Task stopped: %s, %d subworks dequeued', task.name, removed)
+
+    def __task_done(self, task, status):
+        """ called by the work thread which ended the last subwork of task """
+        with self.__mutex:
+            if task not in self.__curr_tasks:
+                self.__canceling.pop(task, None)
+                return
+            added_at = self.__curr_tasks.pop(task)
+            timer = self.__timers.pop(task, None)
+            canceled_at = self.__canceling.pop(task, None)
+            if canceled_at is not None:
+                self.__cancel_latency.observe(_time() - canceled_at)
+        if timer is not None:
+            self.__wd._call_by_ws_undelay(timer)
+        task._call_by_ws_set_status(status)
+        if status == ST_FINISHED:
+            self.log.debug('[ws] Task done: %s', task.name)
+        elif status == ST_ERROR:
+            self.log.debug('[ws] Task err: %s', task.name)
+        else:
+            self.log.debug('[ws] Task canceled: %s', task.name)
+        self.__add_cleanup(task, added_at)
+
+    def __add_cleanup(self, task, added_at):
+        """ every task ends here once, with its final status """
+        with self.__mutex:
+            self.__stats.record(task, task.status, _time() - added_at)
+        if self.__journal is not None and not (task.status == ST_CANCEL and self.isSetStop()):
+            self.__journal.taskDone(task)  # canceled by setToStop: resumed next time
+        with self.__clean_cond:
+            self.__cleaning += 1
+        ser = WorkShop.SerWork(task)
+        ser._call_by_ws_on_done(self.__cleanup_done)
+        self.__clean.addWork(ser)
+
+    def __cleanup_done(self, ser):
+        with self.__clean_cond:
+            self.__cleaning -= 1
+            self.__clean_cond.notify_all()
+
     def __cleanUp(self):
-        for i, tk in enumerate(self.__curr_tasks):
+        with self.__mutex:
+            tasks, self.__curr_tasks = self.__curr_tasks, {}
+        for tk, added_at in tasks.items():
             if tk.isError():
                 tk._call_by_ws_set_status(ST_ERROR)
                 tk.setToStop()
-                tk.waitForStop()
                 self.log.debug('[ws] Task err: %s', tk.name)
             elif tk.isArchived():
                 tk._call_by_ws_set_status(ST_FINISHED)
@@ -536,15 +3262,17 @@ class WorkShop(ServeThreadBase):
             else:
                 tk._call_by_ws_set_status(ST_CANCEL)
                 tk.setToStop()
-                tk.waitForStop()
                 self.log.debug('[ws] Task not finish: %s', tk.name)
 
-            self.__clean.addWork(WorkShop.SerWork(tk))
+            self.__add_cleanup(tk, added_at)
 
         while not self.__task_buff.empty():
-            tk = self.__task_buff.get()
+            added_at, tk = self.__task_buff.get()[-2:]
+            if tk is None:
+                continue
+            self.__buff_capacity.release()
             tk._call_by_ws_set_status(ST_CANCEL)
-            self.__clean.addWork(WorkShop.SerWork(tk))
+            self.__add_cleanup(tk, added_at)
             self.log.debug('[ws] cleanup')
 
     def allTasksDone(self):
@@ -645,6 +3373,319 @@ def wd_test_1(log):
         log.error('total=%d', WorkTest.TOTAL)
 
 
+class SleepWork(WorkBase):
+    def __init__(self, duration, name='_sleep_'):
+        WorkBase.__init__(self, name=name)
+        self.duration = duration
+        self.queued_at = self.started_at = self.stopped_at = None
+
+    def work(self, this_thread, log):
+        self.started_at = _time()
+        _sleep(self.duration)
+        self.stopped_at = _time()
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def wd_bench_placement(log, total=400, threads=8):
+    """ mixed short/long works: random per-thread placement vs shared run queue """
+    durations = [0.2 if i % 10 == 0 else 0.005 for i in range(total)]
+    for shared in (False, True):
+        works = [SleepWork(d, name='bench_%05d' % i) for i, d in enumerate(durations)]
+        wd = WorkDispatcher(tmin=threads, tmax=threads, log=log, shared_queue=shared)
+        wd.serve()
+        _sleep(0.1)
+        start_at = _time()
+        for wk in works:
+            wk.queued_at = _time()
+            wd.addWork(wk)
+        while [wk for wk in works if wk.status < ST_FINISHED]:
+            _sleep(0.01)
+        waits = [wk.started_at - wk.queued_at for wk in works]
+        log.error('[bench] shared_queue=%s makespan=%.3fs wait p50=%.3fs p99=%.3fs',
+                  shared, max(wk.stopped_at for wk in works) - start_at,
+                  _percentile(waits, 0.5), _percentile(waits, 0.99))
+        wd.setToStop()
+        wd.joinAll()
+
+
+class CpuWork(WorkBase):
+    def __init__(self, n=300000, name='_cpu_'):
+        WorkBase.__init__(self, name=name)
+        self.n = n
+
+    def work(self, this_thread, log):
+        total = 0
+        for i in range(self.n):
+            total += i * i
+        return total
+
+
+def wd_bench_processes(log, works=32, n=300000):
+    """ CPU-bound works on threads vs 1, 2, 4 .. cpu_count worker processes """
+    from multiprocessing import cpu_count
+    runs = []
+    size = 1
+    while size <= cpu_count():
+        runs.append((BACKEND_PROCESS, size))
+        size *= 2
+    runs.append((BACKEND_THREAD, cpu_count()))
+    base = None
+    for backend, size in runs:
+        wd = WorkDispatcher(tmin=size, tmax=size, log=log, shared_queue=True,
+                            backend=backend, processes=size)
+        wd.serve()
+        wait(wd.addWorks([CpuWork(1) for i in range(size)]))  # warm up the pool
+        start_at = _time()
+        wait(wd.addWorks([CpuWork(n) for i in range(works)]))
+        duration = _time() - start_at
+        if backend == BACKEND_PROCESS and size == 1:
+            base = duration
+        log.error('[bench] backend=%s size=%d %.3fs speedup=%.2f',
+                  backend, size, duration, base / duration)
+        wd.setToStop()
+        wd.joinAll()
+
+
+class NopWork(WorkBase):
+    def work(self, this_thread, log):
+        return None
+
+
+class NopLiteWork(LiteWorkBase):
+    __slots__ = ()
+
+    def work(self, this_thread, log):
+        return None
+
+
+def _rss_kb():
+    import os
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def _lite_bench_one(cls, n, queue):
+    rss = _rss_kb()
+    start_at = _time()
+    works = [cls() for i in range(n)]
+    queue.put((_time() - start_at, _rss_kb() - rss))
+
+
+def lite_bench_memory(log, n=1000000, dispatched=100000):
+    """ RSS and creation time of n WorkBase vs LiteWorkBase, one process each """
+    from multiprocessing import Process, Queue as _MpQueue
+    created = []
+    for cls in (NopWork, NopLiteWork):
+        queue = _MpQueue()
+        proc = Process(target=_lite_bench_one, args=(cls, n, queue))
+        proc.start()
+        created.append(queue.get())
+        proc.join()
+    for cls, (duration, kb) in zip((NopWork, NopLiteWork), created):
+        wd = WorkDispatcher(tmin=4, tmax=4, log=log, shared_queue=True)
+        wd.serve()
+        start_at = _time()
+        wait(wd.addWorks([cls() for i in range(dispatched)]))
+        wd_duration = _time() - start_at
+        wd.setToStop()
+        wd.joinAll()
+        log.error('[bench] %s x %d: create %.3fs, %d bytes/work, dispatch %d %.3fs',
+                  cls.__name__, n, duration, kb * 1024 // n, dispatched, wd_duration)
+
+
+def ws_bench_serve(log, shops=50, tmin=2):
+    """ wall and cpu time to start `shops` WorkShop one by one vs serveAll() """
+    import os
+    for batch in (False, True):
+        servers = [WorkShop(tmin=tmin, tmax=tmin, log=log) for i in range(shops)]
+        cpu, start_at = sum(os.times()[:2]), _time()
+        if batch:
+            assert serveAll(servers)
+        else:
+            for ws in servers:
+                assert ws.serve()
+        duration, cpu = _time() - start_at, sum(os.times()[:2]) - cpu
+        log.error('[bench] %s %d shops: %.1fms, cpu %.1fms', 'serveAll' if batch else 'serve',
+                  shops, duration * 1000, cpu * 1000)
+        for ws in servers:
+            ws.setToStop()
+        for ws in servers:
+            ws.join()
+
+
+def wd_bench_submit(log, sizes=(1, 10, 100, 1000, 10000, 100000, 1000000),
+                    threads=8, shared_queue=False):
+    """
+    submission throughput (works/s) of addWork() one by one vs addWorks(),
+    for batches of 1 to 1M works. Threads are paused while submitting, so
+    only the enqueue path is timed
+    """
+    wd = WorkDispatcher(tmin=threads, tmax=threads, log=log, shared_queue=shared_queue)
+    wd.serve()
+    try:
+        for size in sizes:
+            rounds = max(1, 10000 // size)
+            rates = []
+            for batch in (False, True):
+                duration = 0
+                for r in range(rounds):
+                    works = [NopLiteWork() for i in range(size)]
+                    wd.mgr.pauseAll()
+                    start_at = _time()
+                    if batch:
+                        futures = wd.addWorks(works)
+                    else:
+                        futures = [wd.addWork(work) for work in works]
+                    duration += _time() - start_at
+                    wd.mgr.resumeAll()
+                    wait(futures)
+                rates.append(size * rounds / duration)
+            log.error('[bench] batch of %7d: addWork %9.0f works/s, addWorks %9.0f works/s',
+                      size, rates[0], rates[1])
+    finally:
+        wd.setToStop()
+        wd.joinAll()
+
+
+class LagWork(LiteWorkBase):
+    """ records how late it started after time.time() `due` """
+    __slots__ = ('due', 'lag')
+
+    def __init__(self, due):
+        LiteWorkBase.__init__(self)
+        self.due = due
+        self.lag = None
+
+    def work(self, this_thread, log):
+        self.lag = _time() - self.due
+
+
+def wd_bench_timers(log, sizes=(1000, 10000, 50000), rate=5000, threads=4):
+    """
+    one-shot timers due `rate` per second, all scheduled before the first is
+    due: scheduling and canceling rates, and the start lag (p50/p99) of the
+    works, all on one timer thread
+    """
+    wd = WorkDispatcher(tmin=threads, tmax=threads, log=log)
+    wd.serve()
+    try:
+        for size in sizes:
+            base = _time() + 0.5 + size / 5000.0
+            works = [LagWork(base + float(i) / rate) for i in range(size)]
+            start_at = _time()
+            schedules = [wd.scheduleAt(wk.due, wk) for wk in works]
+            scheduled = _time() - start_at
+            wait([sc.future for sc in schedules])
+            lags = sorted(wk.lag for wk in works)
+            extra = [wd.scheduleAfter(60, LagWork(0)) for i in range(size)]
+            start_at = _time()
+            for sc in extra:
+                sc.cancel()
+            canceled = _time() - start_at
+            log.error('[bench] %6d timers: schedule %8.0f/s, cancel %8.0f/s, '
+                      'lag p50 %.4fs p99 %.4fs', size, size / scheduled, size / canceled,
+                      lags[len(lags) // 2], lags[int(len(lags) * 0.99)])
+    finally:
+        wd.setToStop()
+        wd.joinAll()
+
+
+def wd_bench_profiler(log, threads=8, works=400, n=100000, intervals=(None, 0.01, 0.001)):
+    """
+    CPU-bound works/s without and with a WorkProfiler sampling every
+    `interval` seconds, and the cost of a sample per busy thread
+    """
+    wd = WorkDispatcher(tmin=threads, tmax=threads, log=log)
+    wd.serve()
+    try:
+        wait(wd.addWorks([CpuWork(n) for i in range(threads)]))  # warm up
+        base = None
+        for interval in intervals:
+            if interval is not None:
+                wd.startProfiler(interval=interval)
+            start_at = _time()
+            wait(wd.addWorks([CpuWork(n) for i in range(works)]))
+            rate = works / (_time() - start_at)
+            if interval is None:
+                base = rate
+                log.error('[bench] %d threads, no profiler: %.1f works/s', threads, rate)
+                continue
+            profiler = wd.stopProfiler()
+            busy = sum(profiler.byWork().values())
+            log.error('[bench] %d threads, profiler every %.3fs: %.1f works/s (%+.1f%%), '
+                      '%d samples, %.1fus per busy thread', threads, interval, rate,
+                      (rate / base - 1) * 100, profiler.samples,
+                      profiler.sample_time / max(1, busy) * 1e6)
+    finally:
+        wd.setToStop()
+        wd.joinAll()
+
+
+def ws_bench_journal(log, tasks=20000, subworks=4, threads=4):
+    """
+    tasks/s of a WorkShop without and with a TaskJournal, and the writes per
+    journal transaction. The time includes flushing the journal
+    """
+    import os
+    import shutil
+    import tempfile
+    tmp = tempfile.mkdtemp()
+    try:
+        for journal in (None, os.path.join(tmp, 'journal.db')):
+            ws = WorkShop(tmin=threads, tmax=threads, log=log, journal=journal)
+            ws.serve()
+            batch = []
+            for i in range(tasks):
+                task = TaskBase(name='T_%d' % i, log=log)
+                task.addSubWorks([NopWork() for j in range(subworks)])
+                batch.append(task)
+            start_at = _time()
+            wait(ws.addTasks(batch))
+            ws.setToStop()
+            ws.join()
+            duration = _time() - start_at
+            info = ws.metrics()['journal']
+            if info is None:
+                log.error('[bench] %d tasks of %d works, no journal: %.0f tasks/s',
+                          tasks, subworks, tasks / duration)
+            else:
+                log.error('[bench] %d tasks of %d works, journal: %.0f tasks/s, '
+                          '%d writes in %d commits', tasks, subworks, tasks / duration,
+                          info['written'], info['batches'])
+    finally:
+        shutil.rmtree(tmp)
+
+
+class FailWork(SleepWork):
+    def work(self, this_thread, log):
+        SleepWork.work(self, this_thread, log)
+        raise ValueError('FailWork')
+
+
+def ws_bench_cancel(log, sizes=(1000, 10000, 100000), threads=1, delay=0.5):
+    """ seconds from a failed subwork to its task done, with `size` subworks queued """
+    for size in sizes:
+        ws = WorkShop(tmin=threads, tmax=threads, log=log)
+        ws.serve()
+        try:
+            task = TaskBase(name='cancel', log=log)
+            # the threads are busy until the others are queued, then one fails
+            delay += size / 20000.0
+            task.addSubWorks([FailWork(delay)] + [SleepWork(delay) for i in range(threads - 1)])
+            task.addSubWorks([SleepWork(0) for i in range(size)])
+            wait([ws.addTask(task)])
+            log.error('[bench] %d subworks queued: %d canceled in %.4fs', size,
+                      sum(1 for sw in task.subWorks if sw.status == ST_CANCEL),
+                      ws.metrics()['cancel']['sum'])
+        finally:
+            ws.setToStop()
+            ws.join()
+
+
 class TaskTest(TaskBase):
     TOTAL = 0
     EXEC_TOTAL = 0
@@ -679,6 +3720,40 @@ class TaskTest(TaskBase):
         self.log.error(' ========== Task cleanup: %s, %d, %d' % (self.name, self.status, self.sub_size))
 
 
+def ws_bench_dag(log, items=16, stages=4, unit=0.01, threads=4):
+    """
+    items x stages pipeline (download -> verify -> extract -> index), with
+    uneven durations: one task per stage waited in turn vs one task whose
+    subworks depend on the previous stage of the same item
+    """
+    durations = [[unit * (1 + (i * 3 + s) % 5) for s in range(stages)] for i in range(items)]
+    ws = WorkShop(tmin=threads, tmax=threads, log=log)
+    ws.serve()
+    try:
+        start_at = _time()
+        for s in range(stages):
+            task = TaskBase(name='stage_%d' % s, log=log)
+            task.addSubWorks([SleepWork(durations[i][s]) for i in range(items)])
+            ws.addTask(task).result()
+        staged = _time() - start_at
+        task = TaskBase(name='dag', log=log)
+        for i in range(items):
+            prev = None
+            for s in range(stages):
+                work = SleepWork(durations[i][s])
+                task.addSubWork(work, after=prev and [prev])
+                prev = work
+        start_at = _time()
+        ws.addTask(task).result()
+        dag = _time() - start_at
+        busy = sum(sum(d) for d in durations) / threads
+        log.error('[bench] %dx%d pipeline on %d threads: staged %.3fs, dag %.3fs, '
+                  'ideal %.3fs', items, stages, threads, staged, dag, busy)
+    finally:
+        ws.setToStop()
+        ws.join()
+
+
 def ws_test(log=None):
     if log is None:
         import util
@@ -745,6 +3820,16 @@ if __name__ == "__main__":
         log = util.get_logger(level=logging.DEBUG)
         # wd_test(log)
         # wd_test_1(log)
+        # wd_bench_placement(log)
+        # wd_bench_processes(log)
+        # lite_bench_memory(log)
+        # ws_bench_serve(log)
+        # ws_bench_dag(log)
+        # wd_bench_submit(log)
+        # wd_bench_timers(log)
+        # ws_bench_journal(log)
+        # wd_bench_profiler(log)
+        # ws_bench_cancel(log)
         ws_test(log)
     except KeyboardInterrupt as e:
         print('stop by user')